@@ -0,0 +1,188 @@
+import contextvars
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+import openai
+from langchain_core.embeddings import Embeddings
+
+from index_cache import embedding_model_name
+from rate_limiter import get_rate_limiter, rate_limited
+from spans import add_tokens, record_retry
+from token_count import count_tokens, count_tokens_batch
+
+logger = logging.getLogger("langchain_examples")
+
+# OpenAI accepts up to 2048 inputs per embedding request, batches are kept well inside the
+# per request token limit so one slow request does not hold back the rest
+MAX_BATCH_TOKENS = 50_000
+MAX_BATCH_TEXTS = 2048
+
+# Number of embedding requests in flight at once
+EMBEDDING_CONCURRENCY = 4
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+# Errors that are worth retrying, anything else is raised straight away
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+def retry_after_seconds(error):
+    """Read the server's retry hint from the retry-after-ms or retry-after response headers
+
+    :param error: The exception raised by the OpenAI client
+    :return: Seconds to wait or None if the server did not send a hint
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+
+    headers = response.headers
+
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    if "retry-after" in headers:
+        retry_after = headers["retry-after"]
+        try:
+            return float(retry_after)
+        except ValueError:
+            # retry-after may also be an HTTP date
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    return None
+
+
+def backoff_seconds(attempt: int, error) -> float:
+    """Time to wait before the next attempt.
+
+    The server's hint is used when there is one, otherwise exponential backoff with full
+    jitter. Jitter is added in both cases so concurrent batches do not retry in lockstep.
+
+    :param attempt: Number of attempts made so far, starting at 0
+    :type attempt: int
+    :param error: The exception raised by the last attempt
+    :return: Seconds to wait
+    :rtype: float
+    """
+    hint = retry_after_seconds(error)
+
+    if hint is not None:
+        return hint + random.uniform(0, BACKOFF_BASE)
+
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def call_with_retry(func, *args, max_retries: int = MAX_RETRIES, sleep=time.sleep, **kwargs):
+    """Call func, retrying rate limit, timeout, connection and server errors with backoff
+
+    :param func: The function that calls the OpenAI API
+    :param max_retries: Attempts made before the last error is raised
+    :type max_retries: int
+    :param sleep: Function used to wait, replaceable in tests
+    :return: The value returned by func
+    """
+    for attempt in range(max_retries):
+        try:
+            return func(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries - 1:
+                raise
+
+            wait_time = backoff_seconds(attempt, e)
+            logger.warning(f"{type(e).__name__}, retrying in {wait_time:.1f} seconds...")
+            record_retry()
+            sleep(wait_time)
+
+
+# Retry function to handle rate limit errors, with a limiter every attempt first waits for its share of the quota
+def embed_with_retry(texts, embeddings, limiter=None, tokens=0):
+    return call_with_retry(rate_limited(limiter, tokens, embeddings.embed_documents), texts)
+
+
+def pack_batches(token_counts: list, max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 max_batch_texts: int = MAX_BATCH_TEXTS) -> list:
+    """Group consecutive texts into batches that fit the token and input count limits.
+
+    A text bigger than max_batch_tokens on its own is given a batch of its own.
+
+    :param token_counts: Token count of each text
+    :type token_counts: list
+    :return: A range of text indexes for each batch, in order
+    :rtype: list
+    """
+    batches = []
+    start = 0
+    batch_tokens = 0
+
+    for i, tokens in enumerate(token_counts):
+        if i > start and (batch_tokens + tokens > max_batch_tokens or i - start >= max_batch_texts):
+            batches.append(range(start, i))
+            start = i
+            batch_tokens = 0
+        batch_tokens += tokens
+
+    if start < len(token_counts):
+        batches.append(range(start, len(token_counts)))
+
+    return batches
+
+
+class BatchedEmbeddings(Embeddings):
+    """Embed documents in token sized batches sent concurrently, with retries.
+
+    The vectors are returned in the same order as the texts, so FAISS.from_documents builds
+    one index from all of the batches. Every request goes through the model's process wide
+    rate limiter, see rate_limiter.py, so concurrent batches stay inside the quota.
+
+    :param embeddings: The langchain Embeddings that makes the API calls
+    :param max_batch_tokens: Upper bound on the tokens in one request
+    :type max_batch_tokens: int
+    :param max_concurrency: Number of requests in flight at once
+    :type max_concurrency: int
+    """
+
+    def __init__(self, embeddings, max_batch_tokens: int = MAX_BATCH_TOKENS,
+                 max_concurrency: int = EMBEDDING_CONCURRENCY):
+        self.embeddings = embeddings
+        self.model = embedding_model_name(embeddings)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        self.limiter = get_rate_limiter(self.model)
+
+    def embed_documents(self, texts: list) -> list:
+        token_counts = count_tokens_batch(texts, self.model)
+        add_tokens(embedding=sum(token_counts))
+        batches = pack_batches(token_counts, self.max_batch_tokens)
+
+        if len(batches) <= 1:
+            return embed_with_retry(texts, self.embeddings, self.limiter, sum(token_counts)) if texts else []
+
+        # Each batch runs in a copy of the caller's context so its retries count against the caller's span
+        contexts = [contextvars.copy_context() for _ in batches]
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            results = executor.map(
+                lambda context, batch: context.run(embed_with_retry, texts[batch.start:batch.stop], self.embeddings,
+                                                   self.limiter, sum(token_counts[batch.start:batch.stop])),
+                contexts, batches
+            )
+            return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def embed_query(self, text: str) -> list:
+        tokens = count_tokens(text, self.model)
+        return call_with_retry(rate_limited(self.limiter, tokens, self.embeddings.embed_query), text)
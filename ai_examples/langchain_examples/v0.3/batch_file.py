@@ -0,0 +1,115 @@
+import json
+import os
+
+from results_writer import NDJSONResultsWriter
+
+# Endpoint every request in the file is sent to, see https://platform.openai.com/docs/guides/batch
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def manifest_path(requests_path: str) -> str:
+    """Path of the manifest written next to a batch request file, e.g requests.manifest.ndjson
+
+    The manifest keeps what the request file has no room for, the assessment each custom id belongs
+    to and the citations and token report of its prompt, so results can be ingested without parsing
+    or embedding the assessments again.
+
+    :param requests_path: Path of the .jsonl request file
+    :type requests_path: str
+    :return: Path of the manifest
+    :rtype: str
+    """
+    return os.path.splitext(requests_path)[0] + ".manifest.ndjson"
+
+
+class BatchRequestWriter:
+    """Write chat completion requests in the Batch API's JSONL input format, with their manifest
+
+    :param requests_path: Path of the .jsonl request file
+    :type requests_path: str
+    :param model: Model name sent with every request
+    :type model: str
+    :param temperature: Temperature sent with every request, None to leave it to the API default
+    :type temperature: float
+    """
+
+    def __init__(self, requests_path: str, model: str, temperature: float = None):
+        self.model = model
+        self.temperature = temperature
+        self._requests = NDJSONResultsWriter(requests_path)
+        self._manifest = NDJSONResultsWriter(manifest_path(requests_path))
+
+    def write(self, custom_id: str, prompt: str, entry: dict):
+        """Add the request for one prompt
+
+        :param custom_id: Id matching the result to the request, unique within the file
+        :type custom_id: str
+        :param prompt: The rendered prompt, sent as the user message
+        :type prompt: str
+        :param entry: What the manifest keeps for this request, e.g the assessment path
+        :type entry: dict
+        """
+        body = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
+        if self.temperature is not None:
+            body["temperature"] = self.temperature
+
+        self._requests.write({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body})
+        self._manifest.write({"custom_id": custom_id, **entry})
+
+    def write_failure(self, custom_id: str, entry: dict):
+        """Record an assessment whose prompt could not be built, it only has a manifest entry
+
+        :param custom_id: Id the request would have had
+        :type custom_id: str
+        :param entry: What the manifest keeps for it, with its error under "error"
+        :type entry: dict
+        """
+        self._manifest.write({"custom_id": custom_id, **entry})
+
+    def close(self):
+        self._requests.close()
+        self._manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_manifest(requests_path: str) -> dict:
+    """Read the manifest of a batch request file
+
+    :param requests_path: Path of the .jsonl request file
+    :type requests_path: str
+    :return: Manifest entries keyed by custom id
+    :rtype: dict
+    """
+    with open(manifest_path(requests_path), "r", encoding="utf-8") as manifest_file:
+        entries = (json.loads(line) for line in manifest_file if line.strip())
+        return {entry["custom_id"]: entry for entry in entries}
+
+
+def read_batch_results(results_path: str):
+    """Read a Batch API output or error file, in whatever order the requests finished
+
+    :param results_path: Path of the .jsonl results file
+    :type results_path: str
+    :return: A generator of (custom_id, answer, error), answer is the message content and error
+        None for a successful request, answer is None for a failed one
+    """
+    with open(results_path, "r", encoding="utf-8") as results_file:
+        for line in results_file:
+            if not line.strip():
+                continue
+
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error"):
+                error = result["error"]
+                yield result["custom_id"], None, f"{error.get('code')}: {error.get('message')}"
+            elif response.get("status_code") != 200:
+                body_error = (response.get("body") or {}).get("error") or {}
+                yield result["custom_id"], None, f"HTTP {response.get('status_code')}: {body_error.get('message')}"
+            else:
+                yield result["custom_id"], response["body"]["choices"][0]["message"]["content"], None
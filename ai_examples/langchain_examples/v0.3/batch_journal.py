@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+
+from index_cache import file_sha256
+from results_writer import NDJSONResultsWriter
+
+
+class BatchAbortedError(RuntimeError):
+    """Raised when more assessments in a batch have failed than the batch allows"""
+
+
+def journal_key(assessment_pdf_path: str, settings: dict) -> str:
+    """Key an assessment by the contents of its PDF and the settings it is scored with
+
+    :param assessment_pdf_path: Path to the assessment PDF
+    :type assessment_pdf_path: str
+    :param settings: Everything else that decides the result, e.g the model, prompt and scoring system
+    :type settings: dict
+    :return: The hex digest used as the journal key
+    :rtype: str
+    """
+    key = json.dumps({"pdf": file_sha256(assessment_pdf_path), "settings": settings}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class BatchJournal:
+    """Append only journal of the assessments a batch has finished or failed, one JSON line each.
+
+    A resumed batch skips every assessment the journal holds a result for and scores the rest,
+    including the ones that failed. Each line is flushed as it is written, so at most the
+    assessment being written when the process died is lost.
+
+    :param journal_path: Path of the journal file
+    :type journal_path: str
+    :param resume: Keep the results of earlier runs, False starts a new journal
+    :type resume: bool
+    """
+
+    def __init__(self, journal_path: str, resume: bool = True):
+        self.journal_path = journal_path
+        self.completed = {}
+        self.failed = {}
+
+        if resume and os.path.exists(journal_path):
+            self._load()
+        elif os.path.exists(journal_path):
+            os.remove(journal_path)
+
+        os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+        self._writer = NDJSONResultsWriter(journal_path, append=True)
+
+    def _load(self):
+        with open(self.journal_path, "r+", encoding="utf-8", newline="") as journal_file:
+            complete_length = 0
+            for line in journal_file:
+                if not line.endswith("\n"):
+                    break
+                complete_length += len(line.encode("utf-8"))
+
+                entry = json.loads(line)
+                if entry["status"] == "done":
+                    self.completed[entry["key"]] = entry["record"]
+                    self.failed.pop(entry["key"], None)
+                else:
+                    self.failed[entry["key"]] = entry["error"]
+
+            # Drop a line left half written by a crash so the next entry starts on a line of its own
+            journal_file.truncate(complete_length)
+
+    def get(self, key: str):
+        """Return the record of a finished assessment, or None if it still has to be scored"""
+        return self.completed.get(key)
+
+    def record_done(self, key: str, record: dict):
+        self._writer.write({"key": key, "status": "done", "record": record})
+        self.completed[key] = record
+        self.failed.pop(key, None)
+
+    def record_failure(self, key: str, assessment: str, error: str):
+        self._writer.write({"key": key, "status": "failed", "assessment": assessment, "error": error})
+        self.failed[key] = error
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
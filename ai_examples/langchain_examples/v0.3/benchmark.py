@@ -0,0 +1,704 @@
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import faiss
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents import Document
+from langchain_openai import ChatOpenAI
+
+import criteria_measure
+from batch_journal import BatchJournal
+from chunking import chunk_documents
+from fakes import EMBEDDING_SIZE, fake_chat_model, fake_embeddings, write_synthetic_pdf
+from context_packing import pack_context
+from criteria_registry import CriteriaRegistry, find_criteria_pdfs
+from index_cache import load_cached_index, save_cached_index
+from index_types import build_faiss_index, build_vector_store
+import pdf_cache
+from pdf_cache import load_pdf_pages
+from retrieval import retrieve_for_sections
+from token_count import count_tokens_batch
+from work_queue import WorkQueue, merge_results
+
+# Benchmarks for criteria_measure.py that run against local fakes, run from the repository root:
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py concurrency
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py setup
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py parsing
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py indexes
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py chunking
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py pipeline --output report.json
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py memory
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py grades
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py queue
+#   poetry run python ai_examples/langchain_examples/v0.3/benchmark.py shared
+
+DATA_DIR = "ai_examples/langchain_examples/data"
+CRITERIA_PDF = "ai_examples/langchain_examples/data/criteria/lead/LeadAssessmentRequirements.pdf"
+ASSESSMENT_PDF = "ai_examples/langchain_examples/data/assessment/lead/ChaswickJohnLeadSoftwareEngineer.pdf"
+
+SCORING_SYSTEM = {
+    "4": "Does not meet criteria",
+    "5": "Partially meets criteria",
+    "6": "Mostly meets criteria",
+    "7": "Fully meets criteria"
+}
+
+
+def benchmark_concurrency(assessments: int, latency: float, levels: list):
+    """Time process_multiple_assessments at each concurrency level against a fake LLM
+
+    :param assessments: Number of assessments in the batch
+    :type assessments: int
+    :param latency: Simulated LLM round trip in seconds
+    :type latency: float
+    :param levels: Concurrency levels to time
+    :type levels: list
+    """
+    criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, fake_embeddings(), cache_dir=None)
+    assessment_pdfs = [ASSESSMENT_PDF] * assessments
+
+    print(f"{assessments} assessments, simulated LLM latency {latency}s")
+    print(f"{'concurrency':>12} {'seconds':>10} {'per second':>12} {'speedup':>10}")
+
+    baseline = None
+    for level in levels:
+        start = time.perf_counter()
+        criteria_measure.process_multiple_assessments(criteria_vector, assessment_pdfs, SCORING_SYSTEM,
+                                                      max_concurrency=level, llm=fake_chat_model(latency))
+        elapsed = time.perf_counter() - start
+
+        baseline = baseline or elapsed
+        print(f"{level:>12} {elapsed:>10.2f} {assessments / elapsed:>12.2f} {baseline / elapsed:>9.1f}x")
+
+
+def benchmark_setup(assessments: int):
+    """Compare per-assessment overhead of building the prompt and chain for every assessment
+    against scoring with one AssessmentScorer, using a fake LLM with no latency
+
+    :param assessments: Number of assessments scored in each loop
+    :type assessments: int
+    """
+    criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, fake_embeddings(), cache_dir=None)
+    assessment_docs = criteria_measure.process_assessment(ASSESSMENT_PDF)
+    llm = fake_chat_model()
+
+    start = time.perf_counter()
+    for _ in range(assessments):
+        criteria_measure.load_prompt_config(criteria_measure.PROMPT_FILE, criteria_measure.RESPONSE_STRUCTURE_FILE)
+    uncached_prompt = (time.perf_counter() - start) / assessments
+
+    start = time.perf_counter()
+    for _ in range(assessments):
+        criteria_measure.load_prompt()
+    cached_prompt = (time.perf_counter() - start) / assessments
+
+    start = time.perf_counter()
+    for _ in range(assessments):
+        criteria_measure.compare_assessment_to_criteria(criteria_vector, assessment_docs, SCORING_SYSTEM, llm)
+    per_call = (time.perf_counter() - start) / assessments
+
+    # Building the OpenAI client does not make any calls, so it can be timed with a dummy key
+    start = time.perf_counter()
+    for _ in range(assessments):
+        ChatOpenAI(temperature=criteria_measure.TEMPERATURE, model_name=criteria_measure.MODEL_NAME,
+                   api_key="benchmark")
+    client_setup = (time.perf_counter() - start) / assessments
+
+    scorer = criteria_measure.AssessmentScorer(criteria_vector, SCORING_SYSTEM, llm)
+    start = time.perf_counter()
+    for _ in range(assessments):
+        scorer.score(assessment_docs)
+    reused = (time.perf_counter() - start) / assessments
+
+    print(f"{assessments} assessments, fake LLM with no latency, milliseconds per assessment")
+    print(f"{'load_prompt_config':>32} {uncached_prompt * 1000:>8.3f}")
+    print(f"{'load_prompt (mtime memoized)':>32} {cached_prompt * 1000:>8.3f}")
+    print(f"{'ChatOpenAI construction':>32} {client_setup * 1000:>8.3f}")
+    print(f"{'compare_assessment_to_criteria':>32} {per_call * 1000:>8.3f}")
+    print(f"{'AssessmentScorer.score':>32} {reused * 1000:>8.3f}")
+
+
+def benchmark_parsing(assessments: int, pages: int, latency: float, concurrency: int, parse_workers: int):
+    """Compare parsing assessments on the scoring threads against a process pool pipelined
+    ahead of scoring, over synthetic assessment PDFs
+
+    :param assessments: Number of synthetic assessment PDFs
+    :type assessments: int
+    :param pages: Pages in each PDF
+    :type pages: int
+    :param latency: Simulated LLM round trip in seconds
+    :type latency: float
+    :param concurrency: Number of scoring threads
+    :type concurrency: int
+    :param parse_workers: Number of parsing processes
+    :type parse_workers: int
+    """
+    criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, fake_embeddings(), cache_dir=None)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        assessment_pdfs = []
+        for i in range(assessments):
+            assessment_pdfs.append(os.path.join(tmp_dir, f"assessment{i}.pdf"))
+            write_synthetic_pdf(assessment_pdfs[-1], pages, seed=i)
+
+        print(f"{assessments} assessments of {pages} pages, {concurrency} scoring threads, "
+              f"simulated LLM latency {latency}s")
+
+        for label, workers in (("parse on scoring threads", None), (f"{parse_workers} parse processes", parse_workers)):
+            start = time.perf_counter()
+            criteria_measure.process_multiple_assessments(criteria_vector, assessment_pdfs, SCORING_SYSTEM,
+                                                          max_concurrency=concurrency, llm=fake_chat_model(latency),
+                                                          parse_workers=workers)
+            print(f"{label:>28} {time.perf_counter() - start:>8.2f}s")
+
+
+def synthetic_vectors(count: int, dimension: int, seed: int = 0) -> np.ndarray:
+    # Like real text embeddings the vectors sit near a low dimensional subspace, clustered by topic
+    projection = np.random.default_rng(42).normal(size=(64, dimension)).astype(np.float32)
+    centres = np.random.default_rng(43).normal(size=(256, 64)).astype(np.float32)
+
+    rng = np.random.default_rng(seed)
+    latent = centres[rng.integers(0, len(centres), count)] + rng.normal(scale=0.5, size=(count, 64))
+    noise = rng.normal(scale=0.05, size=(count, dimension))
+    return (latent.astype(np.float32) @ projection + noise).astype(np.float32)
+
+
+def benchmark_indexes(vectors: int, queries: int, dimension: int, k: int):
+    """Report the recall vs latency vs memory trade off of each index type, recall is measured
+    against the exact results of the flat index
+
+    :param vectors: Number of criteria chunk vectors indexed
+    :type vectors: int
+    :param queries: Number of queries searched
+    :type queries: int
+    :param dimension: Dimension of the vectors
+    :type dimension: int
+    :param k: Results per query
+    :type k: int
+    """
+    data = synthetic_vectors(vectors, dimension)
+    query_vectors = synthetic_vectors(queries, dimension, seed=1)
+
+    print(f"{vectors} vectors of {dimension} dimensions, {queries} queries, recall@{k} against flat")
+    print(f"{'index':>18} {'build s':>9} {'query ms':>9} {'recall':>7} {'memory MB':>10}")
+
+    exact = None
+    for label, index_type, reduce_dim in (("flat", "flat", None), ("ivf", "ivf", None), ("ivfpq", "ivfpq", None),
+                                          ("pca256 + ivfpq", "ivfpq", 256)):
+        start = time.perf_counter()
+        index = build_faiss_index(data, index_type, reduce_dim)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, found = index.search(query_vectors, k)
+        latency = (time.perf_counter() - start) / queries
+
+        if exact is None:
+            exact = found
+        recall = np.mean([len(set(row) & set(exact_row)) / k for row, exact_row in zip(found, exact)])
+        memory = faiss.serialize_index(index).nbytes / 1e6
+
+        print(f"{label:>18} {build:>9.2f} {latency * 1000:>9.3f} {recall:>7.3f} {memory:>10.1f}")
+
+
+def benchmark_chunking(pdf_paths: list, chunk_size: int, overlap: int, chunk_tokens: int):
+    """Compare the chunks and embedding tokens of the character splitter and the structure aware chunker
+
+    :param pdf_paths: PDFs to chunk
+    :type pdf_paths: list
+    :param chunk_size: Character chunk size of the character splitter
+    :type chunk_size: int
+    :param overlap: Character overlap of the character splitter
+    :type overlap: int
+    :param chunk_tokens: Largest chunk in tokens of the structure aware chunker
+    :type chunk_tokens: int
+    """
+    model = "text-embedding-ada-002"
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap)
+
+    print(f"characters {chunk_size}/{overlap} vs structure aware {chunk_tokens} tokens, {model} tokens")
+    print(f"{'pdf':>40} {'chunks':>7} {'tokens':>7} {'chunks':>7} {'tokens':>7} {'saved':>6}")
+
+    for pdf_path in pdf_paths:
+        pages = load_pdf_pages(pdf_path)
+        before = [doc.page_content for doc in splitter.split_documents(pages)]
+        after = [doc.page_content for doc in chunk_documents(pages, model, chunk_tokens)]
+
+        before_tokens = sum(count_tokens_batch(before, model))
+        after_tokens = sum(count_tokens_batch(after, model))
+        saved = 1 - after_tokens / before_tokens
+
+        print(f"{os.path.basename(pdf_path):>40} {len(before):>7} {before_tokens:>7} {len(after):>7} "
+              f"{after_tokens:>7} {saved:>6.0%}")
+
+
+# Stages of criteria_measure.py timed by benchmark_pipeline, in pipeline order
+PIPELINE_STAGES = ("pdf_load", "split", "embed", "index_build", "retrieval", "prompt_render", "llm_call",
+                   "clean_response")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_pipeline(criteria_pdf: str, assessment_pdfs: list) -> dict:
+    """Run each stage of criteria_measure.py once over the PDFs with the offline fakes
+
+    :param criteria_pdf: Path to the criteria PDF
+    :type criteria_pdf: str
+    :param assessment_pdfs: Paths to the assessment PDFs
+    :type assessment_pdfs: list
+    :return: Seconds spent in each stage, keyed by stage
+    :rtype: dict
+    """
+    timings = dict.fromkeys(PIPELINE_STAGES, 0.0)
+    model = criteria_measure.MODEL_NAME
+    embeddings = fake_embeddings()
+    llm = fake_chat_model()
+    prompt = criteria_measure.load_prompt()
+    overhead = criteria_measure.count_tokens(prompt.template + json.dumps(SCORING_SYSTEM), model)
+
+    def timed(stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[stage] += time.perf_counter() - start
+        return result
+
+    # The page cache is bypassed so every run parses the PDFs
+    criteria_pages = timed("pdf_load", load_pdf_pages, criteria_pdf, cache_dir=None)
+    assessment_pages = [timed("pdf_load", load_pdf_pages, path, cache_dir=None) for path in assessment_pdfs]
+
+    criteria_docs = timed("split", chunk_documents, criteria_pages, model, criteria_measure.CHUNK_SIZE)
+    assessments = [timed("split", chunk_documents, pages, model, criteria_measure.CHUNK_SIZE)
+                   for pages in assessment_pages]
+
+    vectors = timed("embed", embeddings.embed_documents, [doc.page_content for doc in criteria_docs])
+    vector_store = timed("index_build", build_vector_store, criteria_docs, embeddings, criteria_measure.INDEX_TYPE,
+                         criteria_measure.REDUCE_DIM, vectors)
+
+    for assessment_docs in assessments:
+        assessment_texts = [doc.page_content for doc in assessment_docs]
+        found = timed("retrieval", retrieve_for_sections, vector_store, assessment_texts)
+
+        packed = timed("prompt_render", pack_context, assessment_texts, found, model,
+                       criteria_measure.CONTEXT_TOKEN_BUDGET, criteria_measure.CRITERIA_TOKEN_SHARE, overhead,
+                       criteria_measure.OVERLAP)
+        rendered = timed("prompt_render", prompt.format, assessment=packed["assessment"], scoring_system=SCORING_SYSTEM,
+                         context="\n\n".join(doc.page_content for doc in packed["criteria_docs"]))
+
+        answer = timed("llm_call", llm.invoke, rendered).content
+        timed("clean_response", criteria_measure.clean_response, answer)
+
+    return timings
+
+
+def benchmark_pipeline(sizes: list, assessments: int, assessment_pages: int, repeat: int, output: str,
+                       baseline: str):
+    """Time every stage of the pipeline with the offline fakes over synthetic criteria PDFs of growing
+    size, and write a JSON report that can be compared with the report of another commit
+
+    :param sizes: Pages in each synthetic criteria PDF
+    :type sizes: list
+    :param assessments: Number of synthetic assessments scored at each size
+    :type assessments: int
+    :param assessment_pages: Pages in each synthetic assessment
+    :type assessment_pages: int
+    :param repeat: Runs at each size, the median is reported
+    :type repeat: int
+    :param output: Path of the JSON report, None to only print it
+    :type output: str
+    :param baseline: Path of an earlier JSON report to compare against, None for no comparison
+    :type baseline: str
+    """
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "settings": {
+            "chunk_size": criteria_measure.CHUNK_SIZE,
+            "index_type": criteria_measure.INDEX_TYPE,
+            "reduce_dim": criteria_measure.REDUCE_DIM,
+            "assessments": assessments,
+            "assessment_pages": assessment_pages,
+            "repeat": repeat,
+        },
+        "runs": [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        assessment_pdfs = []
+        for i in range(assessments):
+            assessment_pdfs.append(os.path.join(tmp_dir, f"assessment{i}.pdf"))
+            write_synthetic_pdf(assessment_pdfs[-1], assessment_pages, seed=i)
+
+        for pages in sizes:
+            criteria_pdf = os.path.join(tmp_dir, f"criteria{pages}.pdf")
+            write_synthetic_pdf(criteria_pdf, pages, seed=pages)
+
+            runs = [time_pipeline(criteria_pdf, assessment_pdfs) for _ in range(repeat)]
+            stages = {stage: statistics.median(run[stage] for run in runs) for stage in PIPELINE_STAGES}
+            report["runs"].append({"criteria_pages": pages, "seconds": stages, "total": sum(stages.values())})
+
+    previous = {}
+    if baseline is not None:
+        with open(baseline, "r") as baseline_file:
+            previous = {run["criteria_pages"]: run for run in json.load(baseline_file)["runs"]}
+
+    print(f"{assessments} assessments of {assessment_pages} pages, median of {repeat} runs, milliseconds")
+    print(f"{'pages':>6} " + " ".join(f"{stage:>14}" for stage in PIPELINE_STAGES + ("total",)))
+    for run in report["runs"]:
+        print(f"{run['criteria_pages']:>6} " + " ".join(
+            f"{run['seconds'][stage] * 1000:>14.2f}" for stage in PIPELINE_STAGES) + f" {run['total'] * 1000:>14.2f}")
+
+        before = previous.get(run["criteria_pages"])
+        if before is not None:
+            # Below 1 the stage got faster than in the baseline report
+            ratios = [run["seconds"][stage] / before["seconds"][stage] if before["seconds"].get(stage) else float("nan")
+                      for stage in PIPELINE_STAGES] + [run["total"] / before["total"]]
+            print(f"{'ratio':>6} " + " ".join(f"{ratio:>14.2f}" for ratio in ratios))
+
+    if output is not None:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Report written to {output}")
+
+
+def peak_memory(func, *args) -> tuple:
+    """Run func and return its result with the peak Python memory it allocated, in MB"""
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        return result, tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_memory(sizes: list, lines_per_page: int):
+    """Compare the peak memory of loading, splitting and embedding an assessment eagerly, every page
+    and chunk at once as PyPDFLoader.load did, against the streaming process_assessment, over synthetic
+    assessment PDFs of growing length. Both keep the same chunks, up to the token limit and then for
+    the whole document, and the page cache is off so both parse every page they read.
+
+    :param sizes: Pages in each synthetic PDF
+    :type sizes: list
+    :param lines_per_page: Lines of text on each page
+    :type lines_per_page: int
+    """
+    embeddings = fake_embeddings()
+
+    def eager(pdf_path, token_limit):
+        docs = chunk_documents(PyPDFLoader(pdf_path).load(), criteria_measure.MODEL_NAME, criteria_measure.CHUNK_SIZE)
+        # The same chunks process_assessment keeps, up to and including the one that passes the limit
+        tokens = itertools.accumulate(criteria_measure.count_tokens(doc.page_content, criteria_measure.MODEL_NAME)
+                                      for doc in docs)
+        kept = next((count for count, total in enumerate(tokens, 1) if total > token_limit), len(docs))
+        docs = docs[:kept]
+        return docs, embeddings.embed_documents([doc.page_content for doc in docs])
+
+    def streaming(pdf_path, token_limit):
+        docs = criteria_measure.process_assessment(pdf_path, token_limit)
+        return docs, embeddings.embed_documents([doc.page_content for doc in docs])
+
+    print("Peak Python memory of load, split and embed, page cache off")
+    print(f"{'pages':>6} {'PDF MB':>7} {'token limit':>12} {'chunks':>7} {'eager MB':>9} {'stream MB':>10}")
+
+    page_cache_dir = pdf_cache.PAGE_CACHE_DIR
+    pdf_cache.PAGE_CACHE_DIR = None
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for pages in sizes:
+                pdf_path = os.path.join(tmp_dir, f"assessment{pages}.pdf")
+                write_synthetic_pdf(pdf_path, pages, lines_per_page, seed=pages)
+
+                for token_limit in (criteria_measure.CONTEXT_TOKEN_BUDGET, math.inf):
+                    (eager_docs, _), eager_peak = peak_memory(eager, pdf_path, token_limit)
+                    (stream_docs, _), stream_peak = peak_memory(streaming, pdf_path, token_limit)
+                    assert len(stream_docs) == len(eager_docs)
+
+                    label = "whole" if token_limit == math.inf else token_limit
+                    print(f"{pages:>6} {os.path.getsize(pdf_path) / 1e6:>7.2f} {label:>12} {len(eager_docs):>7} "
+                          f"{eager_peak:>9.1f} {stream_peak:>10.1f}")
+    finally:
+        pdf_cache.PAGE_CACHE_DIR = page_cache_dir
+
+
+def benchmark_grades(assessments: int, latency: float, concurrency: int):
+    """Compare scoring a cohort once per grade, as separate runs of criteria_measure.py did, against
+    process_multiple_grades scoring every grade in one pass
+
+    :param assessments: Number of assessments in the cohort
+    :type assessments: int
+    :param latency: Simulated LLM round trip in seconds
+    :type latency: float
+    :param concurrency: Number of scoring threads
+    :type concurrency: int
+    """
+    embeddings = fake_embeddings()
+    registry = CriteriaRegistry(find_criteria_pdfs(os.path.join(DATA_DIR, "criteria")),
+                                lambda pdf: criteria_measure.embed_criteria(pdf, embeddings, cache_dir=None))
+    for grade in registry.grades:
+        registry.get(grade)
+
+    assessment_pdfs = [ASSESSMENT_PDF] * assessments
+    calls = {}
+
+    def counted(name, func):
+        def call(*args, **kwargs):
+            calls[name] = calls.get(name, 0) + 1
+            return func(*args, **kwargs)
+        return call
+
+    embed_documents = embeddings.embed_documents
+    process_assessment = criteria_measure.process_assessment
+    embeddings.embed_documents = counted("embed", embed_documents)
+    criteria_measure.process_assessment = counted("parse", process_assessment)
+
+    print(f"{assessments} assessments against {', '.join(registry.grades)}, {concurrency} scoring threads, "
+          f"simulated LLM latency {latency}s")
+    print(f"{'':>22} {'seconds':>8} {'parses':>7} {'embeds':>7}")
+
+    try:
+        calls.clear()
+        start = time.perf_counter()
+        for grade in registry.grades:
+            criteria_measure.process_multiple_assessments(registry.get(grade), assessment_pdfs, SCORING_SYSTEM,
+                                                          max_concurrency=concurrency, llm=fake_chat_model(latency))
+        elapsed = time.perf_counter() - start
+        print(f"{'one run per grade':>22} {elapsed:>8.2f} {calls['parse']:>7} {calls['embed']:>7}")
+
+        calls.clear()
+        start = time.perf_counter()
+        criteria_measure.process_multiple_grades(registry, assessment_pdfs, SCORING_SYSTEM,
+                                                 max_concurrency=concurrency, llm=fake_chat_model(latency))
+        elapsed = time.perf_counter() - start
+        print(f"{'one pass, all grades':>22} {elapsed:>8.2f} {calls['parse']:>7} {calls['embed']:>7}")
+    finally:
+        embeddings.embed_documents = embed_documents
+        criteria_measure.process_assessment = process_assessment
+
+
+
+def queue_worker(queue_path: str, results_dir: str, worker: str, latency: float, concurrency: int):
+    """One worker process of benchmark_queue, as criteria_measure.py --queue runs on each machine"""
+    criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, fake_embeddings(), cache_dir=None)
+    with WorkQueue(queue_path) as queue, \
+            BatchJournal(os.path.join(results_dir, f"journal-{worker}.ndjson")) as journal:
+        criteria_measure.process_queue(criteria_vector, queue, SCORING_SYSTEM, worker,
+                                       os.path.join(results_dir, f"results-{worker}.ndjson"), journal,
+                                       max_concurrency=concurrency, llm=fake_chat_model(latency))
+
+
+def benchmark_queue(assessments: int, latency: float, concurrency: int, workers: list):
+    """Throughput of worker processes sharing one SQLite work queue, each standing in for a machine
+
+    :param assessments: Number of assessments in the cohort
+    :type assessments: int
+    :param latency: Simulated LLM round trip in seconds
+    :type latency: float
+    :param concurrency: Number of scoring threads in each worker
+    :type concurrency: int
+    :param workers: The worker counts to compare
+    :type workers: list
+    """
+    print(f"{assessments} assessments, {concurrency} scoring threads per worker, simulated LLM latency {latency}s")
+    print(f"{'workers':>8} {'seconds':>8} {'per second':>11} {'speed up':>9} {'merged':>7}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Each assessment has content of its own, the workers' journals would skip repeats
+        assessment_pdfs = []
+        for index in range(assessments):
+            assessment_pdfs.append(os.path.join(tmp_dir, f"assessment-{index}.pdf"))
+            write_synthetic_pdf(assessment_pdfs[-1], pages=2, seed=index)
+
+        baseline = None
+        for count in workers:
+            run_dir = os.path.join(tmp_dir, f"workers-{count}")
+            queue_path = os.path.join(run_dir, "queue.db")
+            with WorkQueue(queue_path) as queue:
+                queue.add(assessment_pdfs)
+
+            processes = [multiprocessing.Process(target=queue_worker,
+                                                 args=(queue_path, run_dir, f"worker-{index}", latency, concurrency))
+                         for index in range(count)]
+            start = time.perf_counter()
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            elapsed = time.perf_counter() - start
+
+            merged = merge_results([os.path.join(run_dir, f"results-worker-{index}.ndjson") for index in range(count)],
+                                   os.path.join(run_dir, "results.ndjson"))
+            baseline = baseline or elapsed
+            print(f"{count:>8} {elapsed:>8.2f} {assessments / elapsed:>11.1f} {baseline / elapsed:>8.2f}x "
+                  f"{merged:>7}")
+
+
+
+def private_memory() -> float:
+    """Resident memory of this process that no other process shares, in MB, Linux only"""
+    with open("/proc/self/status") as status_file:
+        return next(int(line.split()[1]) for line in status_file if line.startswith("RssAnon")) / 1000
+
+
+def shared_index_worker(cache_dir: str, key: str, mmap: bool, queries: np.ndarray, results):
+    """One worker process of benchmark_shared, opens the criteria index and retrieves for a few assessments"""
+    before = private_memory()
+    start = time.perf_counter()
+    vector_store = load_cached_index(cache_dir, key, fake_embeddings(), mmap)
+    load = time.perf_counter() - start
+
+    for assessment in np.array_split(queries, 8):
+        retrieve_for_sections(vector_store, [""] * len(assessment), queries=assessment)
+
+    results.put((load, private_memory() - before))
+
+
+def benchmark_shared(vectors: int, workers: list):
+    """Compare the memory of worker processes that each read their own copy of a saved criteria index
+    against ones opening it memory mapped, sharing one copy
+
+    :param vectors: Number of criteria chunks in the index
+    :type vectors: int
+    :param workers: The worker counts to compare
+    :type workers: list
+    """
+    docs = [Document(page_content=f"Criteria chunk {i} " + "describes the skill level in detail. " * 12,
+                     metadata={"source": CRITERIA_PDF, "page": i % 40, "skill": f"Skill {i % 12}"})
+            for i in range(vectors)]
+    vector_store = build_vector_store(docs, fake_embeddings(), "flat",
+                                      vectors=synthetic_vectors(vectors, EMBEDDING_SIZE))
+    queries = synthetic_vectors(64, EMBEDDING_SIZE, seed=1)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        save_cached_index(cache_dir, "shared", vector_store, CRITERIA_PDF)
+        del vector_store, docs
+        entry_size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(cache_dir, "shared"))) / 1e6
+
+        print(f"{vectors} criteria chunks, {entry_size:.0f}MB saved, private memory per worker in MB")
+        print(f"{'':>10} {'workers':>8} {'load s':>7} {'per worker':>11} {'all workers':>12}")
+
+        for mmap in (False, True):
+            for count in workers:
+                results = multiprocessing.Queue()
+                processes = [multiprocessing.Process(target=shared_index_worker,
+                                                     args=(cache_dir, "shared", mmap, queries, results))
+                             for _ in range(count)]
+                for process in processes:
+                    process.start()
+                measured = [results.get() for _ in processes]
+                for process in processes:
+                    process.join()
+
+                load = statistics.mean(load for load, _ in measured)
+                memory = [private for _, private in measured]
+                label = "mmap" if mmap else "read"
+                print(f"{label:>10} {count:>8} {load:>7.2f} {statistics.mean(memory):>11.1f} {sum(memory):>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for criteria_measure.py")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    concurrency_parser = subparsers.add_parser("concurrency", help="Serial vs concurrent assessment scoring")
+    concurrency_parser.add_argument("--assessments", type=int, default=32)
+    concurrency_parser.add_argument("--latency", type=float, default=0.5)
+    concurrency_parser.add_argument("--levels", type=int, nargs="+", default=[1, 4, 8, 16])
+
+    setup_parser = subparsers.add_parser("setup", help="Per-assessment chain setup vs a reused AssessmentScorer")
+    setup_parser.add_argument("--assessments", type=int, default=200)
+
+    parsing_parser = subparsers.add_parser("parsing", help="Threaded vs process pool PDF parsing")
+    parsing_parser.add_argument("--assessments", type=int, default=16)
+    parsing_parser.add_argument("--pages", type=int, default=30)
+    parsing_parser.add_argument("--latency", type=float, default=0.5)
+    parsing_parser.add_argument("--concurrency", type=int, default=8)
+    parsing_parser.add_argument("--parse-workers", type=int, default=os.cpu_count())
+
+    indexes_parser = subparsers.add_parser("indexes", help="Recall, latency and memory of each faiss index type")
+    indexes_parser.add_argument("--vectors", type=int, default=10000)
+    indexes_parser.add_argument("--queries", type=int, default=500)
+    indexes_parser.add_argument("--dimension", type=int, default=EMBEDDING_SIZE)
+    indexes_parser.add_argument("--k", type=int, default=10)
+
+    chunking_parser = subparsers.add_parser("chunking", help="Character vs structure aware chunking")
+    chunking_parser.add_argument("pdfs", nargs="*", default=sorted(
+        os.path.join(root, name) for root, _, names in os.walk(DATA_DIR) for name in names if name.endswith(".pdf")
+    ))
+    chunking_parser.add_argument("--chunk-size", type=int, default=500)
+    chunking_parser.add_argument("--overlap", type=int, default=100)
+    chunking_parser.add_argument("--chunk-tokens", type=int, default=criteria_measure.CHUNK_SIZE)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Time every pipeline stage, written as a JSON report")
+    pipeline_parser.add_argument("--sizes", type=int, nargs="+", default=[5, 20, 80])
+    pipeline_parser.add_argument("--assessments", type=int, default=8)
+    pipeline_parser.add_argument("--assessment-pages", type=int, default=2)
+    pipeline_parser.add_argument("--repeat", type=int, default=3)
+    pipeline_parser.add_argument("--output", default="benchmark_report.json")
+    pipeline_parser.add_argument("--baseline", help="An earlier report to compare against")
+
+    memory_parser = subparsers.add_parser("memory", help="Peak memory of eager vs streaming assessment loading")
+    memory_parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 800])
+    memory_parser.add_argument("--lines-per-page", type=int, default=40)
+
+    grades_parser = subparsers.add_parser("grades", help="One run per grade vs one pass scoring every grade")
+    grades_parser.add_argument("--assessments", type=int, default=16)
+    grades_parser.add_argument("--latency", type=float, default=0.5)
+    grades_parser.add_argument("--concurrency", type=int, default=8)
+
+    queue_parser = subparsers.add_parser("queue", help="Throughput of worker processes sharing a work queue")
+    queue_parser.add_argument("--assessments", type=int, default=64)
+    queue_parser.add_argument("--latency", type=float, default=0.5)
+    queue_parser.add_argument("--concurrency", type=int, default=4)
+    queue_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+
+    shared_parser = subparsers.add_parser("shared", help="Worker memory reading vs memory mapping the index")
+    shared_parser.add_argument("--vectors", type=int, default=20000)
+    shared_parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+
+    args = parser.parse_args()
+
+    # Pages parsed by the benchmarks, most of them synthetic PDFs, are cached in a temporary folder for the run
+    # rather than the page cache next to criteria_measure.py
+    with tempfile.TemporaryDirectory() as page_cache_dir:
+        pdf_cache.PAGE_CACHE_DIR = page_cache_dir
+
+        if args.benchmark == "concurrency":
+            benchmark_concurrency(args.assessments, args.latency, args.levels)
+        elif args.benchmark == "setup":
+            benchmark_setup(args.assessments)
+        elif args.benchmark == "parsing":
+            benchmark_parsing(args.assessments, args.pages, args.latency, args.concurrency, args.parse_workers)
+        elif args.benchmark == "indexes":
+            benchmark_indexes(args.vectors, args.queries, args.dimension, args.k)
+        elif args.benchmark == "chunking":
+            benchmark_chunking(args.pdfs, args.chunk_size, args.overlap, args.chunk_tokens)
+        elif args.benchmark == "pipeline":
+            benchmark_pipeline(args.sizes, args.assessments, args.assessment_pages, args.repeat, args.output,
+                               args.baseline)
+        elif args.benchmark == "memory":
+            benchmark_memory(args.sizes, args.lines_per_page)
+        elif args.benchmark == "grades":
+            benchmark_grades(args.assessments, args.latency, args.concurrency)
+        elif args.benchmark == "queue":
+            benchmark_queue(args.assessments, args.latency, args.concurrency, args.workers)
+        elif args.benchmark == "shared":
+            benchmark_shared(args.vectors, args.workers)
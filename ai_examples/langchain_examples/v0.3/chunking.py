@@ -0,0 +1,161 @@
+import re
+
+from langchain_core.documents import Document
+
+from token_count import count_tokens_batch
+
+# Largest chunk in tokens, a criteria level description or an assessment skill fits in one
+CHUNK_TOKENS = 300
+
+# Headings inside a skill, the grade description, each level of the criteria and the scores of an assessment
+LEVEL_HEADING = re.compile(
+    r"^((\w+ ){1,3}Description:|(Awareness|Working|Practitioner|Expert|Developing|Proficient|Accomplished)\b.*\(\d+\)$"
+    r"|Assess(ee|or)'s Score:)"
+)
+# The table of contents, a title with dot leaders to its page number, only repeats the headings
+CONTENTS_ENTRY = re.compile(r"^Contents$|\.{4,}\s*\d*\s*$")
+
+SKILL_HEADING_MAX_WORDS = 8
+
+
+def is_skill_heading(line: str, previous_line: str) -> bool:
+    """Guess whether a line is a skill title, such as "Service Support"
+
+    A title is a short capitalised line starting after a blank line, another heading or a finished
+    sentence, a wrapped paragraph line follows a line that does not end in punctuation.
+
+    :param line: The stripped line
+    :type line: str
+    :param previous_line: The stripped line before it, empty after a blank line or a heading
+    :type previous_line: str
+    :return: True if the line starts a new skill
+    :rtype: bool
+    """
+    return (
+        line[:1].isupper()
+        and len(line.split()) <= SKILL_HEADING_MAX_WORDS
+        and not line.endswith((",", ":", ";"))
+        and (not previous_line or previous_line.endswith((".", ":", ")", "?", "!")))
+    )
+
+
+def iter_sections(pages):
+    """Split the text of the pages into sections, each starting at a heading, reading one page at a time.
+
+    :param pages: One Document per page, e.g as yielded by iter_pdf_pages
+    :return: A generator of sections as dicts of skill (the skill heading), new_skill (the section starts
+        the skill), lines and metadata (of the page the section starts on)
+    """
+    section = None
+    skill = None
+    previous_line = ""
+    after_skill_heading = False
+
+    for page in pages:
+        for line in page.page_content.splitlines():
+            line = line.strip()
+            if not line:
+                previous_line = ""
+                continue
+            if CONTENTS_ENTRY.search(line):
+                continue
+
+            title = section is None
+            level_heading = bool(LEVEL_HEADING.match(line))
+            # The first line under a skill title is its description however short, the document
+            # title is treated as a skill of its own
+            skill_heading = title or (
+                not level_heading and not after_skill_heading and is_skill_heading(line, previous_line)
+            )
+
+            if skill_heading:
+                skill = line
+            if skill_heading or level_heading:
+                if section is not None:
+                    yield section
+                section = {"skill": skill, "new_skill": skill_heading, "lines": [], "metadata": page.metadata}
+
+            section["lines"].append(line)
+            # The title and level headings end a block just as a blank line does
+            previous_line = "" if level_heading or title else line
+            after_skill_heading = skill_heading and not title
+
+    if section is not None:
+        yield section
+
+
+def split_sections(pages: list) -> list:
+    """Split the text of the pages into sections, see iter_sections
+
+    :param pages: One Document per page, as returned by load_pdf_pages
+    :type pages: list
+    :return: The sections in document order
+    :rtype: list
+    """
+    return list(iter_sections(pages))
+
+
+def iter_chunks(pages, model: str, chunk_tokens: int = CHUNK_TOKENS):
+    """Chunk PDF pages along their skill and level headings, sized in tokens, yielding each chunk
+    as soon as it is complete.
+
+    Consecutive sections of the same skill are joined while they fit in chunk_tokens, a chunk
+    never spans two skills. Sections longer than chunk_tokens are split between lines. Chunks
+    that do not start at the skill heading repeat it on their first line so they can be
+    retrieved and read on their own. The lines of each section are counted in one batched
+    tiktoken call, so only the page and the section being chunked are held in memory.
+
+    :param pages: One Document per page, e.g as yielded by iter_pdf_pages
+    :param model: The model whose encoding is used to count tokens
+    :type model: str
+    :param chunk_tokens: Largest chunk in tokens
+    :type chunk_tokens: int
+    :return: A generator of chunk Documents with the page metadata of where they start and their skill
+    """
+    chunk = None
+    skill_tokens = 0
+
+    for section in iter_sections(pages):
+        skill = section["skill"]
+        # +1 for the newline joining each line to the one before
+        section_tokens = [tokens + 1 for tokens in count_tokens_batch(section["lines"], model)]
+
+        if section["new_skill"]:
+            # A new skill always starts a new chunk
+            skill_tokens = section_tokens[0]
+            split = True
+        else:
+            split = chunk is not None and chunk["tokens"] + sum(section_tokens) > chunk_tokens
+
+        for line, tokens in zip(section["lines"], section_tokens):
+            if chunk is not None and (split or chunk["tokens"] + tokens > chunk_tokens):
+                yield Document(page_content="\n".join(chunk["lines"]), metadata=chunk["metadata"])
+                chunk = None
+            split = False
+
+            if chunk is None:
+                chunk = {"lines": [], "tokens": 0, "metadata": {**section["metadata"], "section": skill}}
+                if line != skill:
+                    chunk["lines"].append(skill)
+                    chunk["tokens"] += skill_tokens
+
+            chunk["lines"].append(line)
+            chunk["tokens"] += tokens
+
+    if chunk is not None:
+        yield Document(page_content="\n".join(chunk["lines"]), metadata=chunk["metadata"])
+
+
+def chunk_documents(pages: list, model: str, chunk_tokens: int = CHUNK_TOKENS) -> list:
+    """Chunk PDF pages along their skill and level headings, see iter_chunks
+
+    :param pages: One Document per page, as returned by load_pdf_pages
+    :type pages: list
+    :param model: The model whose encoding is used to count tokens
+    :type model: str
+    :param chunk_tokens: Largest chunk in tokens
+    :type chunk_tokens: int
+    :return: The chunk Documents with the page metadata of where they start and their skill
+    :rtype: list
+    """
+    return list(iter_chunks(pages, model, chunk_tokens))
@@ -0,0 +1,113 @@
+from token_count import count_tokens_batch
+
+# Overlaps shorter than this many characters are not stripped
+MIN_OVERLAP = 20
+
+
+def merge_overlapping_chunks(texts: list, max_overlap: int = None, min_overlap: int = MIN_OVERLAP) -> list:
+    """Strip the text each chunk repeats from the end of the chunk before it.
+
+    A character text splitter overlaps consecutive chunks, so joining them as they are sends the
+    overlap to the model twice. Chunks that do not overlap are started on a new line, so
+    joining the result with "" rebuilds the document text.
+
+    :param texts: Chunk texts in document order
+    :type texts: list
+    :param max_overlap: Longest overlap between chunks, None if not known and 0 if they do not overlap
+    :type max_overlap: int
+    :param min_overlap: Shorter matches are treated as coincidence rather than overlap
+    :type min_overlap: int
+    :return: The chunks with the repeated prefix of each one removed
+    :rtype: list
+    """
+    merged = []
+    previous = ""
+
+    for text in texts:
+        overlap = 0
+        longest = min(len(previous), len(text), len(text) if max_overlap is None else max_overlap)
+        for size in range(longest, min_overlap - 1, -1):
+            if previous.endswith(text[:size]):
+                overlap = size
+                break
+
+        if overlap:
+            merged.append(text[overlap:])
+        else:
+            merged.append("\n" + text if merged else text)
+        previous = text
+
+    return merged
+
+
+def pack_context(assessment_texts: list, criteria_docs: list, model: str, token_budget: int,
+                 criteria_share: float, overhead_tokens: int = 0, max_overlap: int = None) -> dict:
+    """Fit the assessment and the retrieved criteria into a token budget.
+
+    Criteria are guaranteed up to criteria_share of the budget, the assessment gets the rest
+    and any share the criteria do not need. Chunks are kept in order (assessment) or rank
+    order (criteria) until the next one does not fit.
+
+    :param assessment_texts: Assessment chunk texts in document order
+    :type assessment_texts: list
+    :param criteria_docs: Retrieved criteria Documents, most relevant first
+    :type criteria_docs: list
+    :param model: The chat model whose encoding is used to count tokens
+    :type model: str
+    :param token_budget: Tokens available for the whole prompt
+    :type token_budget: int
+    :param criteria_share: Fraction of the budget reserved for the criteria
+    :type criteria_share: float
+    :param overhead_tokens: Tokens used by the rest of the prompt
+    :type overhead_tokens: int
+    :param max_overlap: Longest overlap between chunks, None if not known and 0 if they do not overlap
+    :type max_overlap: int
+    :return: The packed assessment text, the criteria documents that fit and a token report
+    :rtype: dict
+    """
+    sections = merge_overlapping_chunks(assessment_texts, max_overlap)
+    criteria_texts = [doc.page_content for doc in criteria_docs]
+
+    # One batched encode for every text in the prompt
+    counts = count_tokens_batch(["\n".join(assessment_texts)] + sections + criteria_texts, model)
+    unpacked_assessment_tokens = counts[0]
+    section_tokens = counts[1:len(sections) + 1]
+    criteria_tokens = counts[len(sections) + 1:]
+
+    available = max(0, token_budget - overhead_tokens)
+    criteria_reserve = min(sum(criteria_tokens), int(available * criteria_share))
+
+    assessment_sections = []
+    assessment_used = 0
+    for section, tokens in zip(sections, section_tokens):
+        if assessment_used + tokens > available - criteria_reserve:
+            break
+        assessment_sections.append(section)
+        assessment_used += tokens
+
+    packed_criteria = []
+    criteria_used = 0
+    for doc, tokens in zip(criteria_docs, criteria_tokens):
+        if assessment_used + criteria_used + tokens > available:
+            break
+        packed_criteria.append(doc)
+        criteria_used += tokens
+
+    report = {
+        "budget": token_budget,
+        "overhead": overhead_tokens,
+        "assessment_before": unpacked_assessment_tokens,
+        "assessment_after": assessment_used,
+        "criteria_before": sum(criteria_tokens),
+        "criteria_after": criteria_used,
+        "assessment_truncated": len(assessment_sections) < len(sections),
+        "criteria_dropped": len(criteria_docs) - len(packed_criteria),
+    }
+    report["saved"] = (report["assessment_before"] + report["criteria_before"]
+                       - report["assessment_after"] - report["criteria_after"])
+
+    return {
+        "assessment": "".join(assessment_sections),
+        "criteria_docs": packed_criteria,
+        "report": report,
+    }
@@ -1,31 +1,104 @@
+import argparse
+import contextvars
+import functools
+import glob
+import itertools
 import json
+import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from string import Template
 
-from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 #from langchain_community.chat_models import ChatOpenAI
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.chains import RetrievalQA
-from langchain_community.vectorstores import FAISS
 from langchain.prompts import PromptTemplate
 from langchain_community.llms import OpenAI
 
-CHUNK_SIZE = 500
-OVERLAP = 100
+from batch_embedding import BatchedEmbeddings, call_with_retry
+from batch_file import BatchRequestWriter, read_batch_results, read_manifest
+from batch_journal import BatchAbortedError, BatchJournal, journal_key
+from chunking import chunk_documents, iter_chunks
+from context_packing import pack_context
+from criteria_registry import MAX_RESIDENT_INDEXES, CriteriaRegistry, find_criteria_pdfs
+from embedding_cache import CachedEmbeddings
+from folder_watch import WATCH_INTERVAL, FolderWatcher, find_pdfs
+from index_types import build_vector_store
+from index_cache import (INDEX_CACHE_DIR, embedding_model_name, file_sha256, index_cache_key, load_cached_index,
+                         save_cached_index)
+from pdf_cache import iter_pdf_pages
+from rate_limiter import COMPLETION_TOKEN_ESTIMATE, UsageCallback, get_rate_limiter, rate_limited
+from response_cache import ResponseCache, response_cache_key
+from results_writer import open_results_writer
+from retrieval import embed_sections, retrieve_for_sections
+from skill_scoring import match_skill, summarise_skills
+from spans import MemorySpanExporter, SpanRecorder, add_tokens, open_span_exporter, span, span_iter
+from token_count import count_tokens
+from work_queue import HEARTBEAT_SECONDS, WorkQueue, merge_results, parse_shard, shard_paths, worker_id
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPT_FILE = os.path.join(BASE_DIR, "example_prompt.txt")
+# Prompt asking for one skill of the response structure, used by SkillScorer
+SKILL_PROMPT_FILE = os.path.join(BASE_DIR, "skill_prompt.txt")
+# One folder per grade, each holding the criteria PDF of that grade
+CRITERIA_DIR = os.path.join(os.path.dirname(BASE_DIR), "data", "criteria")
+RESPONSE_STRUCTURE_FILE = os.path.join(BASE_DIR, "response_structure.json")
+
+MODEL_NAME = "gpt-4o-mini"  # Specify your desired model here
+TEMPERATURE = 0.7
+
+# Largest chunk in tokens, PDFs are chunked along their skill and level headings so chunks do not overlap
+CHUNK_SIZE = 300
+OVERLAP = 0
+# faiss index used for the criteria, one of flat, ivf or ivfpq, optionally PCA reduced to REDUCE_DIM dimensions
+INDEX_TYPE = "flat"
+REDUCE_DIM = None
+
+# Tokens available for the prompt sent to the model, and the share of them kept for the retrieved criteria
+CONTEXT_TOKEN_BUDGET = 16000
+CRITERIA_TOKEN_SHARE = 0.4
+
+# Number of assessments scored at the same time by process_multiple_assessments
+MAX_CONCURRENCY = 8
+# Number of processes parsing assessment PDFs ahead of scoring
+PARSE_WORKERS = os.cpu_count()
+
+# Journal of the assessments each batch has finished, a rerun of the batch only scores the rest
+JOURNAL_FILE = os.path.join(BASE_DIR, ".cache", "journal.ndjson")
+# A batch stops once more than this many assessments have failed, None to never stop
+MAX_FAILURES = 10
+
+# Results of the assessments scored by --watch, each scan appends the new and changed assessments,
+# and of a batch file ingested with --ingest-batch
+RESULTS_FILE = os.path.join(BASE_DIR, ".cache", "results.ndjson")
+# Results and journal of each worker of a --queue or --shard run, results-<worker>.ndjson and journal-<worker>.ndjson,
+# on the filesystem the workers share so --merge can read them all
+WORKERS_DIR = os.path.join(BASE_DIR, ".cache", "workers")
+
+# Per stage timings, tokens and retries of each assessment, .prom for a Prometheus text file, anything else JSON lines
+SPANS_FILE = os.path.join(BASE_DIR, ".cache", "spans.jsonl")
 
 # Load the prompt template
-def load_prompt_config(template_file, response_file=None):
+# With skill set the prompt asks for that skill alone, [skill] is replaced with its name and the response
+# structure is the skill's entry in the response file
+def load_prompt_config(template_file, response_file=None, skill=None):
     # Load the prompt template from a file
     with open(template_file, 'r') as file:
         prompt_template = file.read()
+
+    if skill is not None:
+        prompt_template = prompt_template.replace("[skill]", skill)
     
     if response_file is not None:
         # Load the response structure from a JSON file
         with open(response_file, 'r') as json_file:
             response_structure_data = json.load(json_file)
+            if skill is not None:
+                response_structure_data = response_structure_data["skills"][skill]
             response_structure = json.dumps(response_structure_data, indent=2)  
 
             # Not sure how parenthesis work in prompt templates, but adding 4 for each 
@@ -49,164 +122,937 @@ def load_prompt_config(template_file, response_file=None):
     return prompt
 
 
-# Retry function to handle rate limit errors
-def embed_with_retry(texts, embeddings):
-    max_retries = 5
-    for attempt in range(max_retries):
-        try:
-            # Embed documents using OpenAI
-            return embeddings.embed_documents(texts)
-        except Exception as e:  # Catch all OpenAI API-related errors
-            if "rate limit" in str(e).lower():
-                if attempt < max_retries - 1:
-                    # Wait and retry
-                    wait_time = 5 * (attempt + 1)  # Exponential backoff
-                    print(f"Rate limit error, retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
-                else:
-                    raise e  # Exceeded retries
-            else:
-                raise e  # Reraise other exceptions
+# OpenAI embeddings behind the persistent embedding cache, used for both the criteria chunks
+# and the retriever's query embeddings so unchanged text is never re-embedded.
+# Cache misses are embedded in token sized batches sent concurrently, BatchedEmbeddings owns
+# the retries so the OpenAI client's own retries are turned off.
+def default_embeddings():
+    return CachedEmbeddings(BatchedEmbeddings(OpenAIEmbeddings(max_retries=0)))
+
 
 # Embed and store the criteria once
-def embed_criteria(criteria_pdf_path):
-    # Load the criteria PDF document
-    loader = PyPDFLoader(criteria_pdf_path)
-    pages = loader.load_and_split()
-
-    # Extract criteria text
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=OVERLAP)
-    criteria_docs = text_splitter.split_documents(pages)
+# The index is cached on disk keyed by the PDF contents, chunk settings, embedding model and index type,
+# a warm start loads the saved index without any embedding calls. Pass cache_dir=None to disable.
+# index_type and reduce_dim choose a compressed index for large criteria libraries, see index_types.py,
+# and mmap opens the saved index and its documents memory mapped, so they are not read into memory and every
+# worker process scoring with the same criteria shares one copy of them.
+def embed_criteria(criteria_pdf_path, embeddings=None, cache_dir=INDEX_CACHE_DIR, index_type=INDEX_TYPE,
+                   reduce_dim=REDUCE_DIM, mmap=False):
+    if embeddings is None:
+        embeddings = default_embeddings()
+
+    if cache_dir is not None:
+        cache_key = index_cache_key(criteria_pdf_path, CHUNK_SIZE, OVERLAP, embedding_model_name(embeddings),
+                                    index_type, reduce_dim)
+        criteria_vector_store = load_cached_index(cache_dir, cache_key, embeddings, mmap)
+
+        if criteria_vector_store is not None:
+            if debug:
+                print(f"Loaded cached criteria index {cache_key} for {criteria_pdf_path}")
+            return criteria_vector_store
+
+    # Load the criteria PDF document a page at a time
+    pages = iter_pdf_pages(criteria_pdf_path)
+
+    # Extract criteria text, one chunk per skill level description
+    criteria_docs = chunk_documents(pages, MODEL_NAME, CHUNK_SIZE)
     
     # Embed the criteria
-    embeddings = OpenAIEmbeddings()
-    criteria_vector_store = FAISS.from_documents(criteria_docs, embeddings)
+    criteria_vector_store = build_vector_store(criteria_docs, embeddings, index_type, reduce_dim)
+
+    if cache_dir is not None:
+        save_cached_index(cache_dir, cache_key, criteria_vector_store, criteria_pdf_path)
+
+        if mmap:
+            # Swap the in memory index for the memory mapped copy just saved
+            criteria_vector_store = load_cached_index(cache_dir, cache_key, embeddings, mmap)
 
     return criteria_vector_store  # Store the criteria
 
 
+# The criteria of every grade in criteria_dir, each index embedded or read from the index cache the first time an
+# assessment of that grade is scored, with at most max_resident of them in memory, see criteria_registry.py
+def criteria_registry(criteria_dir=CRITERIA_DIR, embeddings=None, max_resident=MAX_RESIDENT_INDEXES,
+                      cache_dir=INDEX_CACHE_DIR, mmap=False):
+    load_index = functools.partial(embed_criteria, embeddings=embeddings, cache_dir=cache_dir, mmap=mmap)
+    return CriteriaRegistry(find_criteria_pdfs(criteria_dir), load_index, max_resident)
+
+
 # Step 2: Upload and process the assessment
-def process_assessment(assessment_pdf_path):
-    loader = PyPDFLoader(assessment_pdf_path)
-    pages = loader.load_and_split()  # Split pages to analyze the assessment
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=OVERLAP)
-    assessment_docs = text_splitter.split_documents(pages)
+# Pages are parsed and chunked one at a time and reading stops once the chunks overflow token_limit,
+# more than the prompt could ever hold, so memory depends on the chunk size and the budget rather
+# than on the length of the PDF. One chunk past the limit is kept so pack_context still reports
+# the assessment as truncated.
+# With skills, for SkillScorer, each skill keeps token_limit of the chunks under its heading, wherever they are in
+# the document, and the chunks under no skill's heading share one more token_limit. Reading stops once every one
+# of those budgets is full, so a skill near the end of a long document is still read.
+def process_assessment(assessment_pdf_path, token_limit=CONTEXT_TOKEN_BUDGET, skills=None):
+    # Cached page text, pypdf only runs for new or changed files
+    pages = span_iter("load", iter_pdf_pages(assessment_pdf_path))
+    chunks = span_iter("split", iter_chunks(pages, MODEL_NAME, CHUNK_SIZE))
+
+    assessment_docs = []
+    # Tokens kept for each skill, None for the chunks under no skill's heading
+    kept_tokens = dict.fromkeys([*(skills or []), None], 0)
+    try:
+        for doc in chunks:
+            owner = match_skill(doc.metadata.get("section"), skills) if skills else None
+            if kept_tokens[owner] > token_limit:
+                continue
+
+            assessment_docs.append(doc)
+            kept_tokens[owner] += count_tokens(doc.page_content, MODEL_NAME)
+            if all(tokens > token_limit for tokens in kept_tokens.values()):
+                break
+    finally:
+        # Stops pypdf and records the load and split spans before the documents are returned, the rest of the PDF
+        # is then read into the page cache in the background
+        chunks.close()
+        pages.close()
+
     return assessment_docs
 
 
-def process_multiple_assessments(criteria_vector_store, assessment_pdf_paths, scoring_system):
-    results = []
+# process_assessment for the parsing processes, the load and split spans are sent back with the documents
+def process_assessment_traced(assessment_pdf_path, skills=None):
+    recorder = SpanRecorder(MemorySpanExporter())
+    with recorder.assessment(assessment_pdf_path):
+        assessment_docs = process_assessment(assessment_pdf_path, skills=skills)
+    return assessment_docs, [record for record in recorder.exporter.spans if record["stage"] != "assessment"]
 
-    for i, assessment_pdf_path in enumerate(assessment_pdf_paths):
 
-        # Process each assessment
-        assessment_docs = process_assessment(assessment_pdf_path)
+# Submit func for each item of iterables with at most window of them queued or running at once, yielding the
+# futures in input order. A future is only held until it has been yielded, where Executor.map submits every item
+# up front and keeps every result until the last one is done, so memory grows with the cohort.
+def submit_window(executor, window, func, *iterables):
+    futures = deque()
+    try:
+        for args in zip(*iterables):
+            if len(futures) >= window:
+                yield futures.popleft()
+            futures.append(executor.submit(func, *args))
 
-        # Compare assessment with the pre-embedded criteria
-        result = compare_assessment_to_criteria(criteria_vector_store, assessment_docs, scoring_system)
-        result = clean_response(result)
+        while futures:
+            yield futures.popleft()
+    finally:
+        # Closed early, e.g the batch was aborted
+        for future in futures:
+            future.cancel()
 
-        # Append comma directly to result except for the last one
-        if i < len(assessment_pdf_paths) - 1:
-            result += ','
 
-        results.append(result)
+# Parse and chunk assessments ahead of scoring, yielding (path, docs) in input order.
+# With parse_workers set the PDFs are parsed in a pool of processes, pypdf is pure Python so
+# parsing in threads would hold the GIL. Without it docs is None and each assessment is parsed
+# by the thread that scores it.
+# With a recorder the spans of the parsing processes are added to it. A PDF that fails to parse in
+# the pool is yielded with docs None, so the scoring thread parses it again and the error is raised there.
+# At most twice parse_workers assessments are parsed ahead of the one being yielded.
+# skills is passed on to process_assessment.
+def parse_assessments(assessment_pdf_paths, parse_workers=None, recorder=None, skills=None):
+    if not parse_workers:
+        for assessment_pdf_path in assessment_pdf_paths:
+            yield assessment_pdf_path, None
+        return
 
-    return results
+    parse = process_assessment if recorder is None else process_assessment_traced
+    if skills:
+        parse = functools.partial(parse, skills=skills)
 
+    with ProcessPoolExecutor(max_workers=parse_workers) as executor:
+        futures = submit_window(executor, 2 * parse_workers, parse, assessment_pdf_paths)
 
-# Step 3: Define the comparison function (NLP model)
-def compare_assessment_to_criteria(criteria_vector_store, assessment_docs, scoring_system):
- 
-    embeddings = OpenAIEmbeddings()
+        for assessment_pdf_path, future in zip(assessment_pdf_paths, futures):
+            try:
+                assessment_docs = future.result()
+            except Exception:
+                yield assessment_pdf_path, None
+                continue
 
-    assessment_texts = [doc.page_content for doc in assessment_docs]
+            if recorder is not None:
+                assessment_docs, spans = assessment_docs
+                for record in spans:
+                    recorder.record(record)
 
-    # Build prompt from config
-    prompt = load_prompt_config("ai_examples/langchain_examples/v0.3/example_prompt.txt",
-                                "ai_examples/langchain_examples/v0.3/response_structure.json")
+            yield assessment_pdf_path, assessment_docs
 
-    if debug:
-        for i in range(15):
-            print("PROMPT FOLLOWS")
-        print(f"PROMPT {prompt}")
-        print("PROMPTEND")
 
-    model_name = "gpt-4o-mini"  # Specify your desired model here
-    # Initialize the LLM chain
-    llm = ChatOpenAI(temperature=0.7, model_name=model_name)
+# Assessments are scored on a bounded pool of worker threads, max_concurrency=1 scores them one after another.
+# The work is dominated by waiting on the LLM so threads keep that many requests in flight.
+# With parse_workers set, parsing runs in separate processes and each assessment is handed to the
+# scoring threads as soon as it is parsed, so parsing overlaps the waits on the LLM.
+# With output_path set each result is written to the file as soon as it is scored, see results_writer.py,
+# and nothing is returned, so the batch runs in constant memory.
+# With a response_cache, assessments whose prompt has not changed since an earlier run are not sent to the model.
+# With a SpanRecorder each assessment is traced as load, split, embed, retrieve, generate and parse spans,
+# see spans.py, the caller closes the recorder to export the p50/p95 summary of the batch.
+# With a BatchJournal, see batch_journal.py, assessments finished by an earlier run of the batch are not scored
+# again and an assessment that raises is recorded as failed, with its error in place of its result, instead of
+# aborting the batch. BatchAbortedError is raised once more than max_failures have failed.
+# With append the results are added to an existing NDJSON output_path, the records already in the journal are
+# not written again since the run that scored them wrote them.
+# With per_skill each skill is scored by a call of its own and the summary is worked out locally, see SkillScorer.
+# Each skill gets a token budget of its own over the whole document, and an assessment with a skill left unscored,
+# e.g because its answer was not valid JSON, is written with the skills that were scored but journalled as failed,
+# so a resumed batch scores it again.
+# on_result is called with each record as soon as it is scored, from the scoring thread, e.g to update a work queue.
+# criteria_vector_store may also be a CriteriaRegistry, for a cohort of mixed grades each assessment is then
+# scored against the criteria of the grade folder it is in, e.g assessment/senior.
+def process_multiple_assessments(criteria_vector_store, assessment_pdf_paths, scoring_system,
+                                 max_concurrency=1, llm=None, output_path=None, parse_workers=None,
+                                 response_cache=None, recorder=None, journal=None, max_failures=None,
+                                 append=False, per_skill=False, on_result=None):
 
-    print(f"Using OpenAI model: {model_name}")  # Print the model being used
+    # The prompt, model and chain are built once and shared by every assessment in the batch
+    scorer_class = SkillScorer if per_skill else AssessmentScorer
+    scorer = scorer_class(criteria_vector_store, scoring_system, llm, response_cache=response_cache)
 
-    # Create a chain to combine documents using the provided prompt
-    combine_docs_chain = create_stuff_documents_chain(llm, prompt)
-    
-    retriever = criteria_vector_store.as_retriever(search_type="similarity", return_source_documents=True)
+    registry = criteria_vector_store if isinstance(criteria_vector_store, CriteriaRegistry) else None
+    grades = [None] * len(assessment_pdf_paths)
+    grade_errors = {}
+    if registry is not None:
+        for index, assessment_pdf_path in enumerate(assessment_pdf_paths):
+            try:
+                grades[index] = registry.grade_for(assessment_pdf_path)
+            except ValueError as e:
+                # An assessment outside every grade folder fails on its own when it is scored, the rest of the
+                # batch is still scored
+                grade_errors[index] = e
 
-    # Create the retrieval chain
-    rag_chain = create_retrieval_chain(retriever, combine_docs_chain)
+    journal_keys = [None] * len(assessment_pdf_paths)
+    journalled = {}
+    if journal is not None:
+        settings = scorer.settings()
+        if registry is not None:
+            criteria_hashes = {grade: file_sha256(registry.criteria_pdfs[grade]) for grade in set(grades) - {None}}
+            journal_keys = [journal_key(path, {**settings, "grade": grade, "criteria": criteria_hashes.get(grade)})
+                            for path, grade in zip(assessment_pdf_paths, grades)]
+        else:
+            journal_keys = [journal_key(path, settings) for path in assessment_pdf_paths]
+        journalled = {index: journal.get(key) for index, key in enumerate(journal_keys)
+                      if journal.get(key) is not None}
 
-    # Prepare the input for the chain
-    input_data = {
-        "input": "\n".join(assessment_texts),
-        "assessment": "\n".join(assessment_texts),
-        "context": "managed by RAG",
-        "scoring_system": scoring_system
-    }
+    # Only the assessments without a journalled result are parsed and scored
+    pending = [index for index in range(len(assessment_pdf_paths)) if index not in journalled]
+    failures = itertools.count(1)
+    aborted = threading.Event()
+    skills = scorer.skills() if per_skill else None
 
-    if debug:
-        # log the input data to the console
-        print(f"INPUT DATA: {input_data}")
+    def record_failure(index, error, cause=None):
+        journal.record_failure(journal_keys[index], assessment_pdf_paths[index], error)
 
-    # Run comparison between criteria and assessment using the RAG chain
-    response = rag_chain.invoke(input_data)
+        if max_failures is not None and next(failures) > max_failures:
+            aborted.set()
+            raise BatchAbortedError(f"More than {max_failures} assessments failed, last error {error}") from cause
 
-    if debug:
-        for i in range(15):
-            print("RESPONSE FOLLOWS")
-        print(f"RESPONSE:{response}")
-
-# Extract citations from source documents
-    sources = response['source_documents']  # Metadata about where the information was retrieved
-    citations = []
-    for source in sources:
-        page = source.metadata.get('page', 'N/A')
-        source_info = f"(page {page})"
-        citations.append(source_info)
-
-    # Combine response with citations
-    result_with_citations = {
-        "answer": response['answer'],
-        "citations": citations
-    }
+    def score_assessment(index, parsed_assessment):
+        assessment_pdf_path, assessment_docs = parsed_assessment
 
-    return result_with_citations
+        # The assessments already queued when the batch is aborted are skipped
+        if aborted.is_set():
+            return None
 
-def clean_response(comparison_result):
-    if isinstance(comparison_result, str):
-     # Remove the surrounding backticks and extra spaces
-        comparison_result = comparison_result.strip()
+        try:
+            with recorder.assessment(assessment_pdf_path) if recorder is not None else nullcontext():
+                if index in grade_errors:
+                    raise grade_errors[index]
 
-        # Check if it starts with ``` followed by a newline and json
-        if comparison_result.startswith("```json\n"):
-            # Extract the JSON part by splitting the string
-            comparison_result = comparison_result.split("```")[1].strip()  # Get the JSON part
-            comparison_result = comparison_result.split("json\n")[1].strip()  # Get the JSON part
+                # Process each assessment
+                if assessment_docs is None:
+                    if skills:
+                        assessment_docs = process_assessment(assessment_pdf_path, skills=skills)
+                    else:
+                        assessment_docs = process_assessment(assessment_pdf_path)
 
-            if debug is False:
-                print(comparison_result)
+                # Compare assessment with the pre-embedded criteria
+                if registry is not None:
+                    result = scorer.score(assessment_docs, registry.get(grades[index]))
+                else:
+                    result = scorer.score(assessment_docs)
+
+                with span("parse"):
+                    response = parse_response(result)
+        except Exception as e:
+            if journal is None:
+                raise
+
+            error = f"{type(e).__name__}: {e}"
+            record_failure(index, error, e)
+
+            record = {"index": index, "assessment": assessment_pdf_path, "error": error}
+            if on_result is not None:
+                on_result(record)
+            return record
+
+        record = {
+            "index": index,
+            "assessment": assessment_pdf_path,
+            **response,
+            "citations": result["citations"],
+            "tokens": result["tokens"]
+        }
+
+        unscored = (response["summary"] or {}).get("unscored_skills") if per_skill else None
+        if unscored:
+            # Partly scored, the scored skills are kept alongside the error
+            record["error"] = f"Skills not scored: {', '.join(unscored)}"
+            if journal is not None:
+                record_failure(index, record["error"])
+        elif journal is not None:
+            journal.record_done(journal_keys[index], record)
+        if on_result is not None:
+            on_result(record)
+
+        return record
+
+    parsed_assessments = parse_assessments([assessment_pdf_paths[index] for index in pending], parse_workers,
+                                           recorder, skills)
+
+    if output_path is not None:
+        with open_results_writer(output_path, append) as results_writer:
+            if not append:
+                for record in journalled.values():
+                    results_writer.write(record)
+
+            def write_assessment(index, parsed_assessment):
+                # Records are written in completion order, index gives the position in assessment_pdf_paths
+                record = score_assessment(index, parsed_assessment)
+                if record is not None:
+                    results_writer.write(record)
+
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                # Only a few parsed assessments wait for a scoring thread, errors from the workers are raised here
+                for future in submit_window(executor, 2 * max_concurrency, write_assessment, pending,
+                                            parsed_assessments):
+                    future.result()
+
+        return None
+
+    # The futures come back in the same order as pending
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        records = dict(journalled)
+        futures = submit_window(executor, 2 * max_concurrency, score_assessment, pending, parsed_assessments)
+        records.update(zip(pending, (future.result() for future in futures)))
+
+    results = []
+    for index in range(len(assessment_pdf_paths)):
+        record = records[index]
+        if "error" in record:
+            results.append(json.dumps([{"assessment": record["assessment"], "error": record["error"]}], indent=4))
         else:
-            raise ValueError("The comparison result does not contain valid JSON format.")
+            # The same JSON clean_response gives for the model answer
+            results.append(json.dumps([{"skills": record["skills"], "summary": record["summary"]}], indent=4))
+
+    # Append comma directly to result except for the last one
+    for i in range(len(results) - 1):
+        results[i] += ','
 
+    return results
+
+
+# Score each assessment against several grades in one pass, e.g to decide between senior and lead.
+# The assessment is parsed, chunked and embedded once, then every grade's criteria are searched with the same
+# query vectors and scored concurrently with the same prompt and chain, so a cross grade comparison costs one
+# parse and one embedding call per assessment instead of one per grade. The indexes in the registry are built
+# with the same embeddings, which the shared query vectors rely on.
+# Returns one record per assessment, in order, with the result of each grade, or its error if that grade failed.
+def process_multiple_grades(criteria_registry, assessment_pdf_paths, scoring_system, grades=None,
+                            max_concurrency=1, llm=None, response_cache=None, recorder=None):
+    grades = list(grades or criteria_registry.grades)
+    scorer = AssessmentScorer(None, scoring_system, llm, response_cache=response_cache)
+
+    def score_grade(assessment_docs, queries, grade):
         try:
-            comparison_result = json.loads(comparison_result)
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Failed to decode JSON: {e}")
-        
-    return json.dumps([{
+            result = scorer.score(assessment_docs, criteria_registry.get(grade), queries)
+            with span("parse"):
+                response = parse_response(result)
+        except Exception as e:
+            # The other grades are still worth returning
+            return {"error": f"{type(e).__name__}: {e}"}
+
+        return {**response, "citations": result["citations"], "tokens": result["tokens"]}
+
+    def score_assessment(assessment_pdf_path):
+        with recorder.assessment(assessment_pdf_path) if recorder is not None else nullcontext():
+            assessment_docs = process_assessment(assessment_pdf_path)
+            assessment_texts = [doc.page_content for doc in assessment_docs]
+            queries = embed_sections(criteria_registry.get(grades[0]), assessment_texts) if assessment_texts else None
+
+            # Each grade runs in a copy of this thread's context so its spans belong to this assessment
+            contexts = [contextvars.copy_context() for _ in grades]
+            with ThreadPoolExecutor(max_workers=len(grades)) as executor:
+                results = executor.map(lambda context, grade: context.run(score_grade, assessment_docs, queries, grade),
+                                       contexts, grades)
+                return {"assessment": assessment_pdf_path, "grades": dict(zip(grades, results))}
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(score_assessment, assessment_pdf_paths))
+
+
+# Score the assessments in a WorkQueue shared with other workers, see work_queue.py, until it has none left.
+# The worker claims batch_size assessments at a time, scores them with process_multiple_assessments and marks
+# each done or failed as soon as it is scored, its heartbeat renews the leases meanwhile. The records are appended
+# to output_path, one file per worker, merge them with merge_results once every worker has finished.
+# The journal records failures instead of aborting the batch, a failed assessment goes back in the queue until
+# it has used up its attempts. Stopping the worker hands its unfinished claims back to the queue.
+# Returns the number of assessments this worker scored and the number it failed on its last attempt, counted
+# apart as the journal does.
+def process_queue(criteria_vector_store, queue, scoring_system, worker, output_path, journal, batch_size=None,
+                  max_concurrency=1, llm=None, parse_workers=None, response_cache=None, recorder=None,
+                  max_failures=None, per_skill=False, heartbeat_interval=HEARTBEAT_SECONDS):
+    batch_size = batch_size or 2 * max_concurrency
+    # The error of the last attempt at each assessment, None once it is scored, a retried one is counted once
+    outcomes = {}
+    reported = []
+
+    def finish(record):
+        queue.finish(worker, record["assessment"], record.get("error"))
+        outcomes[record["assessment"]] = record.get("error")
+        reported.append(record["assessment"])
+
+    with queue.heartbeat(worker, heartbeat_interval):
+        try:
+            while True:
+                claimed = queue.claim(worker, batch_size)
+                if not claimed:
+                    failed = sum(error is not None for error in outcomes.values())
+                    return len(outcomes) - failed, failed
+
+                reported.clear()
+                process_multiple_assessments(criteria_vector_store, claimed, scoring_system, max_concurrency, llm,
+                                             output_path, parse_workers, response_cache, recorder, journal,
+                                             max_failures, append=True, per_skill=per_skill, on_result=finish)
+
+                # Scored by an earlier run of this worker, the journal held their result
+                for assessment_pdf_path in set(claimed) - set(reported):
+                    finish({"assessment": assessment_pdf_path})
+        finally:
+            queue.release(worker)
+
+
+# Write the prompt of every assessment to a Batch API request file instead of calling the model, for overnight
+# runs where throughput and cost matter more than latency. Each request's custom_id is assessment-<index>, and
+# the manifest written next to the file, see batch_file.py, records the assessment, citations and token report
+# of each one. Send the file with the Batch API, or any stand-in producing the same output format, then pass
+# the results file to ingest_batch_results. The prompts are built on max_concurrency threads.
+# An assessment whose prompt can not be built, e.g a PDF that does not parse or is outside every grade folder,
+# gets no request, only a manifest entry holding its error, which ingest_batch_results writes as its result.
+# Returns the number of requests written and the number of assessments that failed.
+def write_batch_requests(criteria_vector_store, assessment_pdf_paths, scoring_system, requests_path,
+                         max_concurrency=1, llm=None, recorder=None):
+    scorer = AssessmentScorer(criteria_vector_store, scoring_system, llm)
+    registry = criteria_vector_store if isinstance(criteria_vector_store, CriteriaRegistry) else None
+    written = failed = 0
+
+    def render(assessment_pdf_path):
+        with recorder.assessment(assessment_pdf_path) if recorder is not None else nullcontext():
+            try:
+                assessment_docs = process_assessment(assessment_pdf_path)
+                store = registry.get(registry.grade_for(assessment_pdf_path)) if registry is not None else None
+                return scorer.render_prompt(assessment_docs, store), None
+            except Exception as e:
+                return None, f"{type(e).__name__}: {e}"
+
+    with BatchRequestWriter(requests_path, scorer.model_name, scorer.temperature) as requests_writer, \
+            ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        # map returns the prompts in input order, so the file lists the assessments in order
+        for index, (assessment_pdf_path, (rendered, error)) in enumerate(
+                zip(assessment_pdf_paths, executor.map(render, assessment_pdf_paths))):
+            if error is not None:
+                requests_writer.write_failure(f"assessment-{index}", {
+                    "index": index,
+                    "assessment": assessment_pdf_path,
+                    "error": error,
+                })
+                failed += 1
+                continue
+
+            prompt, packed = rendered
+            citations = [f"(page {doc.metadata.get('page', 'N/A')})" for doc in packed["criteria_docs"]]
+            requests_writer.write(f"assessment-{index}", prompt, {
+                "index": index,
+                "assessment": assessment_pdf_path,
+                "citations": citations,
+                "tokens": packed["report"],
+            })
+            written += 1
+
+    return written, failed
+
+
+# Read the results file of a batch written by write_batch_requests and write each assessment's result to
+# output_path, the same records process_multiple_assessments writes. An answer that clean_response can not parse,
+# or a request the batch failed, is written with its error in place of the result. The Batch API puts the
+# requests it could not run in an error file of its own, pass it as errors_path to have them written too.
+# A line for a custom_id the request file does not have, or has already been answered, is only counted as an error.
+# With append the records are added to an existing output_path, e.g the results of --watch.
+# Returns the number of results written and the number of errors.
+def ingest_batch_results(requests_path, results_path, output_path, errors_path=None, append=False):
+    manifest = read_manifest(requests_path)
+    written = errors = 0
+
+    results_paths = [results_path] if errors_path is None else [results_path, errors_path]
+    with open_results_writer(output_path, append) as results_writer:
+        for custom_id, answer, error in itertools.chain.from_iterable(map(read_batch_results, results_paths)):
+            entry = manifest.pop(custom_id, None)
+            if entry is None:
+                errors += 1
+                continue
+
+            record = {"index": entry["index"], "assessment": entry["assessment"]}
+
+            if error is None:
+                try:
+                    record.update(json.loads(clean_response(answer))[0])
+                    record.update(citations=entry["citations"], tokens=entry["tokens"])
+                except (ValueError, AttributeError) as e:
+                    error = f"{type(e).__name__}: {e}"
+
+            if error is not None:
+                record["error"] = error
+                errors += 1
+
+            results_writer.write(record)
+            written += 1
+
+        # Requests the results file has no line for, e.g the batch expired before reaching them, and the
+        # assessments whose prompt write_batch_requests could not build
+        for entry in sorted(manifest.values(), key=lambda entry: entry["index"]):
+            results_writer.write({"index": entry["index"], "assessment": entry["assessment"],
+                                  "error": entry.get("error", "No result in the batch output")})
+            written += 1
+            errors += 1
+
+    return written, errors
+
+
+# Watch a folder and score the PDFs added to or changed in it, appending their results to output_path.
+# The folder is scanned every interval seconds, see folder_watch.py, and the new or modified files are scored
+# as one batch. The journal keys assessments by content hash, so a file scored by an earlier scan or an earlier
+# run is never scored again, and a failed one is retried when it changes or the watch is restarted.
+# Runs until interrupted, or for max_scans scans.
+def watch_assessments(criteria_vector_store, directory, scoring_system, journal, output_path,
+                      interval=WATCH_INTERVAL, max_concurrency=1, llm=None, parse_workers=None, response_cache=None,
+                      recorder=None, max_failures=None, max_scans=None, sleep=time.sleep, per_skill=False):
+    watcher = FolderWatcher(directory)
+
+    for scan in itertools.count(1):
+        changed = watcher.changed()
+        if changed:
+            scored = len(journal.completed)
+            process_multiple_assessments(criteria_vector_store, changed, scoring_system, max_concurrency, llm,
+                                         output_path, parse_workers, response_cache, recorder, journal,
+                                         max_failures, append=True, per_skill=per_skill)
+            print(f"{len(changed)} new or changed PDFs in {directory}, "
+                  f"{len(journal.completed) - scored} scored, results in {output_path}")
+
+        if max_scans is not None and scan >= max_scans:
+            return
+
+        sleep(interval)
+
+
+# Compiled prompts keyed by their files, each entry holds the file mtimes it was compiled from
+_compiled_prompts = {}
+
+
+# Load the prompt template, only re-reading the files when one of them has changed on disk
+def load_prompt(template_file=PROMPT_FILE, response_file=RESPONSE_STRUCTURE_FILE, skill=None):
+    key = (template_file, response_file, skill)
+    mtimes = tuple(os.stat(file).st_mtime_ns for file in (template_file, response_file) if file is not None)
+
+    compiled = _compiled_prompts.get(key)
+    if compiled is None or compiled[0] != mtimes:
+        compiled = (mtimes, load_prompt_config(template_file, response_file, skill))
+        _compiled_prompts[key] = compiled
+
+    return compiled[1]
+
+
+# Step 3: Define the comparison function (NLP model)
+class AssessmentScorer:
+    """Scores assessments against the pre-embedded criteria.
+
+    The LLM and document chain are built once, so scoring an assessment only
+    costs the model call. The chain is rebuilt if the prompt files change on disk.
+
+    The assessment is sent once, with the chunk overlap removed, and together with the
+    retrieved criteria is packed into token_budget tokens, see context_packing.py.
+
+    :param criteria_vector_store: The FAISS store returned by embed_criteria
+    :param scoring_system: The scoring system passed to the prompt
+    :type scoring_system: dict
+    :param llm: The chat model, defaults to MODEL_NAME on OpenAI
+    :param token_budget: Tokens available for the prompt
+    :type token_budget: int
+    :param response_cache: A ResponseCache, answers for byte identical prompts are returned from it
+    """
+
+    def __init__(self, criteria_vector_store, scoring_system, llm=None,
+                 template_file=PROMPT_FILE, response_file=RESPONSE_STRUCTURE_FILE,
+                 token_budget=CONTEXT_TOKEN_BUDGET, criteria_share=CRITERIA_TOKEN_SHARE, response_cache=None):
+        self.scoring_system = scoring_system
+        self.response_cache = response_cache
+        self.template_file = template_file
+        self.response_file = response_file
+        self.token_budget = token_budget
+        self.criteria_share = criteria_share
+
+        if llm is None:
+            # Initialize the LLM chain
+            llm = ChatOpenAI(temperature=TEMPERATURE, model_name=MODEL_NAME, max_retries=0)
+
+            print(f"Using OpenAI model: {MODEL_NAME}")  # Print the model being used
+
+        self.llm = llm
+        self.model_name = getattr(llm, "model_name", MODEL_NAME)
+        self.temperature = getattr(llm, "temperature", None)
+        self.limiter = get_rate_limiter(self.model_name)
+        self.criteria_vector_store = criteria_vector_store
+
+        self._prompt = None
+        self._combine_docs_chain = None
+        self._overhead_tokens = 0
+
+    def chain(self):
+        # Build prompt from config
+        prompt = load_prompt(self.template_file, self.response_file)
+
+        if prompt is not self._prompt:
+            if debug:
+                for i in range(15):
+                    print("PROMPT FOLLOWS")
+                print(f"PROMPT {prompt}")
+                print("PROMPTEND")
+
+            # Create a chain to combine documents using the provided prompt
+            self._combine_docs_chain = create_stuff_documents_chain(self.llm, prompt)
+
+            # Tokens used by the prompt around the assessment and criteria
+            self._overhead_tokens = count_tokens(prompt.template + json.dumps(self.scoring_system), self.model_name)
+            self._prompt = prompt
+
+        return self._combine_docs_chain
+
+    def settings(self):
+        """Everything besides the assessment that decides its result, used to key the batch journal"""
+        self.chain()
+        return {
+            "model": self.model_name,
+            "temperature": self.temperature,
+            "prompt": self._prompt.template,
+            "scoring_system": self.scoring_system,
+            "chunk_size": CHUNK_SIZE,
+            "token_budget": self.token_budget,
+            "criteria_share": self.criteria_share,
+        }
+
+    def render(self, prompt, packed):
+        """The prompt text the stuff documents chain sends for a packed context"""
+        context_texts = [doc.page_content for doc in packed["criteria_docs"]]
+        return prompt.format(assessment=packed["assessment"], context="\n\n".join(context_texts),
+                             scoring_system=self.scoring_system)
+
+    def render_prompt(self, assessment_docs, criteria_vector_store=None):
+        """Retrieve and pack the criteria for an assessment and render the prompt score would send,
+        for sending it later through a batch file
+
+        :param assessment_docs: The assessment chunks from process_assessment
+        :type assessment_docs: list
+        :param criteria_vector_store: Criteria to score against in place of the scorer's own, e.g another grade's
+        :return: The prompt text and the pack_context result
+        :rtype: tuple
+        """
+        if criteria_vector_store is None:
+            criteria_vector_store = self.criteria_vector_store
+
+        assessment_texts = [doc.page_content for doc in assessment_docs]
+        self.chain()
+
+        criteria_docs = retrieve_for_sections(criteria_vector_store, assessment_texts)
+        packed = pack_context(assessment_texts, criteria_docs, self.model_name, self.token_budget,
+                              self.criteria_share, self._overhead_tokens, OVERLAP)
+
+        return self.render(self._prompt, packed), packed
+
+    def generate(self, chain, prompt, overhead_tokens, assessment_texts, criteria_docs):
+        """Pack the prompt and get the model's answer, from the response cache when it has it.
+        Answers that are not a JSON object are neither cached nor returned from the cache.
+
+        :param chain: The stuff documents chain built from prompt
+        :param prompt: The PromptTemplate, used to key the response cache
+        :param overhead_tokens: Tokens used by the prompt around the assessment and criteria
+        :type overhead_tokens: int
+        :param assessment_texts: Assessment chunk texts in document order
+        :type assessment_texts: list
+        :param criteria_docs: Retrieved criteria Documents, most relevant first
+        :type criteria_docs: list
+        :return: The pack_context result, the answer and whether it came from the cache
+        :rtype: tuple
+        """
+        packed = pack_context(assessment_texts, criteria_docs, self.model_name, self.token_budget,
+                              self.criteria_share, overhead_tokens, OVERLAP)
+
+        # Prepare the input for the chain
+        input_data = {
+            "assessment": packed["assessment"],
+            "context": packed["criteria_docs"],
+            "scoring_system": self.scoring_system
+        }
+
+        if debug:
+            # log the input data to the console
+            print(f"INPUT DATA: {input_data}")
+            print(f"TOKENS: {packed['report']}")
+
+        answer = None
+        use_cache = self.response_cache is not None and self.response_cache.enabled_for(self.temperature)
+
+        if use_cache:
+            # Render the prompt the way the stuff documents chain does to key the cache on it
+            context_texts = [doc.page_content for doc in packed["criteria_docs"]]
+            rendered_prompt = self.render(prompt, packed)
+            cache_key = response_cache_key(self.model_name, self.temperature, rendered_prompt, context_texts)
+            answer = self.response_cache.get(cache_key)
+
+            if answer is not None and not is_json_object_answer(answer):
+                # Cached before answers were checked, the model is asked again rather than failing again
+                answer = None
+
+        cached = answer is not None
+
+        if not cached:
+            report = packed["report"]
+            prompt_tokens = report["overhead"] + report["assessment_after"] + report["criteria_after"]
+            estimate = prompt_tokens + COMPLETION_TOKEN_ESTIMATE
+            usage = UsageCallback()
+
+            # Run comparison between criteria and assessment
+            # The OpenAI client's own retries are turned off so retries are made, and counted, here,
+            # each attempt first waits for its share of the model's rate limits
+            answer = call_with_retry(rate_limited(self.limiter, estimate, chain.invoke), input_data,
+                                     config={"callbacks": [usage]})
+
+            # Only an answer that parses is cached, a rejected one is asked for again when the assessment is retried
+            if use_cache and is_json_object_answer(answer):
+                self.response_cache.put(cache_key, answer)
+
+            completion_tokens = count_tokens(answer, self.model_name)
+            if self.limiter is not None:
+                actual = usage.total_tokens if usage.total_tokens is not None else prompt_tokens + completion_tokens
+                self.limiter.reconcile(estimate, actual)
+
+            add_tokens(prompt=prompt_tokens, completion=completion_tokens)
+
+        return packed, answer, cached
+
+    def score(self, assessment_docs, criteria_vector_store=None, queries=None):
+        """Score one assessment
+
+        :param assessment_docs: The assessment chunks from process_assessment
+        :type assessment_docs: list
+        :param criteria_vector_store: Criteria to score against in place of the scorer's own, e.g another grade's
+        :param queries: The assessment chunks already embedded by embed_sections, None to embed them
+        :return: The model answer with its citations and token report
+        :rtype: dict
+        """
+        assessment_texts = [doc.page_content for doc in assessment_docs]
+        if criteria_vector_store is None:
+            criteria_vector_store = self.criteria_vector_store
+
+        combine_docs_chain = self.chain()
+
+        # Retrieve the criteria relevant to each section of the assessment, one embedding call and one search
+        criteria_docs = retrieve_for_sections(criteria_vector_store, assessment_texts, queries=queries)
+
+        # Packing, the cache lookup and the model call
+        with span("generate") as generate_span:
+            packed, answer, cached = self.generate(combine_docs_chain, self._prompt, self._overhead_tokens,
+                                                   assessment_texts, criteria_docs)
+
+            if generate_span is not None:
+                generate_span.attributes["cached"] = cached
+
+        if debug:
+            for i in range(15):
+                print("RESPONSE FOLLOWS")
+            print(f"RESPONSE:{answer}")
+
+        # Extract citations from source documents
+        sources = packed["criteria_docs"]  # The criteria sent to the model, with metadata about where they came from
+        citations = []
+        for source in sources:
+            page = source.metadata.get('page', 'N/A')
+            source_info = f"(page {page})"
+            citations.append(source_info)
+
+        # Combine response with citations
+        result_with_citations = {
+            "answer": answer,
+            "citations": citations,
+            "tokens": packed["report"],
+            "cached": cached
+        }
+
+        return result_with_citations
+
+
+class SkillScorer(AssessmentScorer):
+    """Scores each skill of the response structure as a model call of its own, map-reduce style.
+
+    Every skill gets the assessment chunks under its heading and the criteria retrieved for them,
+    so each call is smaller and the calls run concurrently, the assessment takes as long as its
+    slowest skill. The summary is worked out from the skill scores, see skill_scoring.py, rather
+    than generated, and a skill whose answer is not valid JSON holds its error without losing the others.
+
+    :param max_concurrency: Skills scored at the same time, None for all of them
+    :type max_concurrency: int
+
+    The other parameters are those of AssessmentScorer, with the prompt defaulting to SKILL_PROMPT_FILE.
+    """
+
+    def __init__(self, criteria_vector_store, scoring_system, llm=None,
+                 template_file=SKILL_PROMPT_FILE, response_file=RESPONSE_STRUCTURE_FILE,
+                 token_budget=CONTEXT_TOKEN_BUDGET, criteria_share=CRITERIA_TOKEN_SHARE, response_cache=None,
+                 max_concurrency=None):
+        super().__init__(criteria_vector_store, scoring_system, llm, template_file, response_file, token_budget,
+                         criteria_share, response_cache)
+        self.max_concurrency = max_concurrency
+        self._skill_chains = {}
+
+    def skills(self):
+        """The skill names in the response structure, in order"""
+        with open(self.response_file, "r") as json_file:
+            return list(json.load(json_file)["skills"])
+
+    def skill_chain(self, skill):
+        """The prompt, chain and prompt overhead tokens of one skill, rebuilt if the prompt files change"""
+        prompt = load_prompt(self.template_file, self.response_file, skill)
+
+        built = self._skill_chains.get(skill)
+        if built is None or built[0] is not prompt:
+            overhead_tokens = count_tokens(prompt.template + json.dumps(self.scoring_system), self.model_name)
+            built = (prompt, create_stuff_documents_chain(self.llm, prompt), overhead_tokens)
+            self._skill_chains[skill] = built
+
+        return built
+
+    def settings(self):
+        return {**super().settings(), "per_skill": True}
+
+    def score(self, assessment_docs, criteria_vector_store=None, queries=None):
+        """Score every skill of one assessment
+
+        :param assessment_docs: The assessment chunks from process_assessment
+        :type assessment_docs: list
+        :param criteria_vector_store: Criteria to score against in place of the scorer's own, e.g another grade's
+        :param queries: The assessment chunks already embedded by embed_sections, None to embed them
+        :return: The skills and summary as the answer, with the citations and the token report of each skill
+        :rtype: dict
+        """
+        assessment_texts = [doc.page_content for doc in assessment_docs]
+        if criteria_vector_store is None:
+            criteria_vector_store = self.criteria_vector_store
+
+        skills = self.skills()
+        # The assessment is embedded once, each skill searches with the rows of its own chunks
+        if queries is None and assessment_texts:
+            queries = embed_sections(criteria_vector_store, assessment_texts)
+        owners = [match_skill(doc.metadata.get("section"), skills) for doc in assessment_docs]
+
+        def score_skill(skill):
+            # The chunks under the skill's heading, the whole assessment if none are
+            rows = [i for i, owner in enumerate(owners) if owner == skill] or list(range(len(assessment_texts)))
+            skill_texts = [assessment_texts[i] for i in rows]
+
+            criteria_docs = retrieve_for_sections(criteria_vector_store, skill_texts,
+                                                  queries=queries[rows] if queries is not None else None)
+            # Only the skill's own criteria, unless none of those retrieved are under its heading
+            criteria_docs = [doc for doc in criteria_docs
+                             if match_skill(doc.metadata.get("section"), skills) == skill] or criteria_docs
+
+            prompt, chain, overhead_tokens = self.skill_chain(skill)
+            with span("generate", skill=skill) as generate_span:
+                packed, answer, cached = self.generate(chain, prompt, overhead_tokens, skill_texts, criteria_docs)
+
+                if generate_span is not None:
+                    generate_span.attributes["cached"] = cached
+
+            try:
+                result = load_json_answer(answer)
+                if not isinstance(result, dict):
+                    raise ValueError(f"Expected a JSON object for {skill}")
+            except ValueError as e:
+                result = {"error": str(e)}
+
+            return packed, cached, result
+
+        # Each skill runs in a copy of this thread's context so its spans belong to this assessment
+        contexts = [contextvars.copy_context() for _ in skills]
+        with ThreadPoolExecutor(max_workers=self.max_concurrency or len(skills)) as executor:
+            scored = list(executor.map(lambda context, skill: context.run(score_skill, skill), contexts, skills))
+
+        skill_results = {skill: result for skill, (_, _, result) in zip(skills, scored)}
+
+        return {
+            "answer": {"skills": skill_results, "summary": summarise_skills(skill_results)},
+            "citations": [f"(page {doc.metadata.get('page', 'N/A')})"
+                          for packed, _, _ in scored for doc in packed["criteria_docs"]],
+            "tokens": {skill: packed["report"] for skill, (packed, _, _) in zip(skills, scored)},
+            "cached": all(cached for _, cached, _ in scored),
+        }
+
+
+# Score a single assessment, use AssessmentScorer directly to score several with the same setup
+def compare_assessment_to_criteria(criteria_vector_store, assessment_docs, scoring_system, llm=None):
+    return AssessmentScorer(criteria_vector_store, scoring_system, llm).score(assessment_docs)
+
+# Decode the JSON object in a model answer, gpt-4o-mini wraps it in a ```json block
+def load_json_answer(answer):
+    # Remove the surrounding backticks and extra spaces
+    answer = answer.strip()
+
+    # Check if it starts with ``` followed by a newline and json
+    if answer.startswith("```json\n"):
+        # Extract the JSON part by splitting the string
+        answer = answer.split("```")[1].strip()  # Get the JSON part
+        answer = answer.split("json\n")[1].strip()  # Get the JSON part
+
+        if debug:
+            print(answer)
+    else:
+        raise ValueError("The comparison result does not contain valid JSON format.")
+
+    try:
+        return json.loads(answer)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Failed to decode JSON: {e}")
+
+
+# Whether a model answer holds the JSON object parse_response and SkillScorer expect, only those are cached
+def is_json_object_answer(answer):
+    try:
+        return isinstance(load_json_answer(answer), dict)
+    except ValueError:
+        return False
+
+
+# Extract the skills and summary from the model answer
+def parse_response(comparison_result):
+    # compare_assessment_to_criteria returns the model answer alongside its citations
+    if isinstance(comparison_result, dict) and 'answer' in comparison_result:
+        comparison_result = comparison_result['answer']
+
+    if isinstance(comparison_result, str):
+        comparison_result = load_json_answer(comparison_result)
+
+    return {
         "skills": comparison_result.get('skills'),
         "summary": comparison_result.get('summary')
-    }], indent=4)
+    }
+
+
+def clean_response(comparison_result):
+    return json.dumps([parse_response(comparison_result)], indent=4)
 
     
 def generate_json_response(criteria, assessment, scoring_system):
@@ -246,11 +1092,55 @@ def generate_json_response(criteria, assessment, scoring_system):
 # Step 5: Running the AI agent
 debug = False
 if __name__ == "__main__":
-    # Define paths
-    criteria_pdf = "ai_examples/langchain_examples/data/criteria/lead/LeadAssessmentRequirements.pdf"
-    
-    # Load documents
-    criteria_vector = embed_criteria(criteria_pdf)
+    parser = argparse.ArgumentParser(description="Score assessment PDFs against the criteria")
+    parser.add_argument("--watch", metavar="FOLDER",
+                        help="Keep scoring the PDFs added to or changed in FOLDER, e.g "
+                             "ai_examples/langchain_examples/data/assessment")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="Seconds between scans of --watch")
+    parser.add_argument("--grades", nargs="+", metavar="GRADE",
+                        help="Score every assessment against each of these grades in one pass, e.g lead senior")
+    parser.add_argument("--per-skill", action="store_true",
+                        help="Score each skill with a model call of its own and work out the summary locally")
+    parser.add_argument("--write-batch", metavar="REQUESTS",
+                        help="Write the prompts to a Batch API request file REQUESTS.jsonl instead of scoring")
+    parser.add_argument("--ingest-batch", nargs="+", metavar="FILE",
+                        help="REQUESTS RESULTS [ERRORS], add the results of a batch written by --write-batch, and of "
+                             "its error file if there is one, to " + RESULTS_FILE)
+    parser.add_argument("assessments", nargs="*", metavar="ASSESSMENT",
+                        help="Assessment PDFs, or folders searched for them, to score instead of the examples")
+    parser.add_argument("--shard", metavar="I/N",
+                        help="Score only shard I of N of the assessments, e.g 0/4 on the first of four machines")
+    parser.add_argument("--queue", metavar="QUEUE",
+                        help="Share the assessments with the other workers using the SQLite work queue QUEUE")
+    parser.add_argument("--worker", default=worker_id(),
+                        help="Name of this worker, reuse it to resume its journal, defaults to host-pid")
+    parser.add_argument("--results-dir", default=WORKERS_DIR,
+                        help="Folder of the results and journal of each --queue or --shard worker")
+    parser.add_argument("--merge", metavar="OUTPUT",
+                        help="Merge the results of every worker in --results-dir into OUTPUT, .json or .ndjson")
+    args = parser.parse_args()
+
+    if args.ingest_batch is not None:
+        if len(args.ingest_batch) not in (2, 3):
+            parser.error("--ingest-batch takes REQUESTS RESULTS and optionally ERRORS")
+
+        # Needs neither the criteria nor the model, the prompts were built when the request file was written.
+        # Appended, RESULTS_FILE also holds the results of --watch
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        requests_path, results_path, *errors_path = args.ingest_batch
+        written, errors = ingest_batch_results(requests_path, results_path, RESULTS_FILE, *errors_path, append=True)
+        print(f"{written} results, {errors} errors, added to {RESULTS_FILE}")
+        raise SystemExit(0)
+
+    if args.merge is not None:
+        results_paths = glob.glob(os.path.join(args.results_dir, "results-*.ndjson"))
+        merged = merge_results(results_paths, args.merge)
+        print(f"{merged} results from {len(results_paths)} workers merged into {args.merge}")
+        raise SystemExit(0)
+
+    # The criteria of each grade, loaded when the first assessment of that grade is scored, memory mapped so the
+    # workers of a --queue or --shard run on one machine share a copy
+    criteria_vector = criteria_registry(mmap=True)
 
     # Define scoring system (for example, 1-4 scale)
     scoring_system = {
@@ -260,14 +1150,71 @@ if __name__ == "__main__":
         "7": "Fully meets criteria"
     }
     
-    # List of assessment PDF files
+    # List of assessment PDF files, each is scored against the criteria of the grade folder it is in
     assessment_pdfs = [
         "ai_examples/langchain_examples/data/assessment/lead/ChaswickJohnLeadSoftwareEngineer.pdf",
-        "ai_examples/langchain_examples/data/assessment/exclude/GibbardSteveGrade7SoftwareEngineer.pdf"
+        "ai_examples/langchain_examples/data/assessment/senior/SmithMauriceSeniorSoftwareEngineer.pdf"
     ]
+    if args.assessments:
+        assessment_pdfs = [pdf for path in args.assessments
+                           for pdf in (find_pdfs(path) if os.path.isdir(path) else [path])]
+    if args.shard is not None:
+        assessment_pdfs = shard_paths(assessment_pdfs, *parse_shard(args.shard))
+
+    # Compare multiple assessments against the criteria, timing each stage of each assessment
+    os.makedirs(os.path.dirname(SPANS_FILE), exist_ok=True)
+    # Each worker of a sharded run keeps its own journal and results, the shared ones are for a single process
+    distributed = args.queue is not None or args.shard is not None
+    journal_file = os.path.join(args.results_dir, f"journal-{args.worker}.ndjson") if distributed else JOURNAL_FILE
+    worker_results_file = os.path.join(args.results_dir, f"results-{args.worker}.ndjson")
+    with SpanRecorder(open_span_exporter(SPANS_FILE)) as recorder, BatchJournal(journal_file) as journal:
+        if args.queue is not None:
+            with WorkQueue(args.queue) as queue:
+                # Every worker adds the whole cohort, the ones already queued are left as they are
+                queue.add(assessment_pdfs)
+                try:
+                    finished, failed = process_queue(criteria_vector, queue, scoring_system, args.worker,
+                                                     worker_results_file, journal, max_concurrency=MAX_CONCURRENCY,
+                                                     parse_workers=PARSE_WORKERS, response_cache=ResponseCache(),
+                                                     recorder=recorder, max_failures=MAX_FAILURES,
+                                                     per_skill=args.per_skill)
+                except KeyboardInterrupt:
+                    finished = failed = None
+                print(f"{args.worker} scored {finished} assessments, {failed} failed, queue {queue.counts()}")
+            results = []
+        elif args.shard is not None:
+            process_multiple_assessments(criteria_vector, assessment_pdfs, scoring_system, MAX_CONCURRENCY,
+                                         output_path=worker_results_file, parse_workers=PARSE_WORKERS,
+                                         response_cache=ResponseCache(), recorder=recorder, journal=journal,
+                                         max_failures=MAX_FAILURES, per_skill=args.per_skill)
+            print(f"Shard {args.shard}, {len(assessment_pdfs)} assessments written to {worker_results_file}")
+            results = []
+        elif args.watch is not None:
+            try:
+                watch_assessments(criteria_vector, args.watch, scoring_system, journal, RESULTS_FILE,
+                                  args.interval, MAX_CONCURRENCY, parse_workers=PARSE_WORKERS,
+                                  response_cache=ResponseCache(), recorder=recorder, max_failures=MAX_FAILURES,
+                                  per_skill=args.per_skill)
+            except KeyboardInterrupt:
+                pass
+            results = []
+        elif args.write_batch is not None:
+            written, failed = write_batch_requests(criteria_vector, assessment_pdfs, scoring_system, args.write_batch,
+                                                   MAX_CONCURRENCY, recorder=recorder)
+            print(f"{written} requests written to {args.write_batch}, {failed} assessments failed")
+            results = []
+        elif args.grades is not None:
+            records = process_multiple_grades(criteria_vector, assessment_pdfs, scoring_system, args.grades,
+                                              MAX_CONCURRENCY, response_cache=ResponseCache(), recorder=recorder)
+            results = [json.dumps(record, indent=4) for record in records]
+        else:
+            results = process_multiple_assessments(criteria_vector, assessment_pdfs, scoring_system,
+                                                   MAX_CONCURRENCY, parse_workers=PARSE_WORKERS,
+                                                   response_cache=ResponseCache(), recorder=recorder,
+                                                   journal=journal, max_failures=MAX_FAILURES,
+                                                   per_skill=args.per_skill)
 
-    # Compare multiple assessments against the criteria
-    results = process_multiple_assessments(criteria_vector, assessment_pdfs, scoring_system)
+    print(recorder.format_summary())
 
 
     for result in results:
@@ -0,0 +1,119 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Criteria indexes kept in memory at once, the least recently used is dropped to load another
+MAX_RESIDENT_INDEXES = 2
+
+
+def find_criteria_pdfs(criteria_dir: str) -> dict:
+    """Find the criteria PDF of each grade, each grade has a folder of its own, e.g criteria/lead
+
+    :param criteria_dir: The folder holding a sub folder per grade
+    :type criteria_dir: str
+    :return: The criteria PDF path keyed by grade
+    :rtype: dict
+    """
+    criteria_pdfs = {}
+
+    for grade in sorted(os.listdir(criteria_dir)):
+        grade_dir = os.path.join(criteria_dir, grade)
+        if not os.path.isdir(grade_dir):
+            continue
+
+        pdfs = sorted(name for name in os.listdir(grade_dir) if name.lower().endswith(".pdf"))
+        if len(pdfs) > 1:
+            raise ValueError(f"Expected one criteria PDF for {grade}, found {', '.join(pdfs)}")
+        if pdfs:
+            criteria_pdfs[grade] = os.path.join(grade_dir, pdfs[0])
+
+    return criteria_pdfs
+
+
+class CriteriaRegistry:
+    """Criteria indexes by grade, each loaded on first use with at most max_resident kept in memory.
+
+    Indexes are dropped least recently used first, and loaded again by load_index when a later
+    assessment needs them, with the on disk index cache that is a read rather than a rebuild.
+    The registry is shared by the threads scoring a batch, each grade is only loaded by one of them.
+
+    :param criteria_pdfs: The criteria PDF path keyed by grade, see find_criteria_pdfs
+    :type criteria_pdfs: dict
+    :param load_index: Builds the vector store of a criteria PDF, e.g embed_criteria
+    :param max_resident: Most indexes kept in memory at once
+    :type max_resident: int
+    """
+
+    def __init__(self, criteria_pdfs: dict, load_index, max_resident: int = MAX_RESIDENT_INDEXES):
+        if max_resident < 1:
+            raise ValueError("max_resident must be at least 1")
+
+        self.criteria_pdfs = dict(criteria_pdfs)
+        self.load_index = load_index
+        self.max_resident = max_resident
+        self.loads = 0
+
+        self._lock = threading.Lock()
+        self._loading = {grade: threading.Lock() for grade in self.criteria_pdfs}
+        self._indexes = OrderedDict()
+
+    @property
+    def grades(self) -> list:
+        return list(self.criteria_pdfs)
+
+    @property
+    def resident(self) -> list:
+        """The grades whose index is in memory, least recently used first"""
+        with self._lock:
+            return list(self._indexes)
+
+    def grade_for(self, assessment_pdf_path: str) -> str:
+        """The grade of an assessment, from the nearest folder above it named after a grade, e.g assessment/lead
+
+        :param assessment_pdf_path: Path to the assessment PDF
+        :type assessment_pdf_path: str
+        :return: The grade
+        :rtype: str
+        """
+        folder = os.path.dirname(os.path.abspath(assessment_pdf_path))
+        while True:
+            if os.path.basename(folder) in self.criteria_pdfs:
+                return os.path.basename(folder)
+
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                raise ValueError(f"No grade folder ({', '.join(self.grades)}) above {assessment_pdf_path}")
+            folder = parent
+
+    def get(self, grade: str):
+        """Return the criteria vector store of a grade, loading it if it is not in memory
+
+        :param grade: One of grades
+        :type grade: str
+        :return: The FAISS vector store
+        """
+        if grade not in self.criteria_pdfs:
+            raise KeyError(f"No criteria for grade {grade}, expected one of {', '.join(self.grades)}")
+
+        with self._lock:
+            if grade in self._indexes:
+                self._indexes.move_to_end(grade)
+                return self._indexes[grade]
+
+        # Other grades stay available while this one loads, a second thread asking for it waits for the first
+        with self._loading[grade]:
+            with self._lock:
+                if grade in self._indexes:
+                    self._indexes.move_to_end(grade)
+                    return self._indexes[grade]
+
+            index = self.load_index(self.criteria_pdfs[grade])
+
+            with self._lock:
+                self.loads += 1
+                self._indexes[grade] = index
+                while len(self._indexes) > self.max_resident:
+                    # Scorers still using an evicted index keep it alive until they finish
+                    self._indexes.popitem(last=False)
+
+        return index
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+from index_cache import embedding_model_name
+
+# Default location for the embedding cache database, kept next to this script
+EMBEDDING_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "embeddings.sqlite")
+
+# Least recently used vectors are evicted once the cache holds more than this many
+MAX_CACHED_EMBEDDINGS = 100_000
+
+# SQLite limits the number of parameters in one statement
+LOOKUP_BATCH_SIZE = 500
+
+
+def text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wrap an embeddings object with a persistent SQLite cache.
+
+    Vectors are stored as float32 blobs keyed by (model, sha256(text)), so identical text is
+    only sent to the embedding API once across runs. Both documents and queries are cached.
+
+    :param embeddings: The langchain Embeddings used for cache misses
+    :param cache_path: Path of the SQLite database
+    :type cache_path: str
+    :param max_entries: Number of vectors kept before the least recently used are evicted
+    :type max_entries: int
+    """
+
+    def __init__(self, embeddings, cache_path: str = EMBEDDING_CACHE_PATH,
+                 max_entries: int = MAX_CACHED_EMBEDDINGS):
+        self.embeddings = embeddings
+        self.model = embedding_model_name(embeddings)
+        self.max_entries = max_entries
+
+        # Hits and misses since the cache was opened, useful to check how many API calls were saved
+        self.hits = 0
+        self.misses = 0
+
+        if cache_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+
+        # The connection is shared between the worker threads in process_multiple_assessments
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+
+    def embed_documents(self, texts: list) -> list:
+        hashes = [text_sha256(text) for text in texts]
+        cached = self._lookup(set(hashes))
+
+        # Embed each distinct missing text once, in a single call to the wrapped embeddings
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in cached:
+                missing.setdefault(text_hash, text)
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = dict(zip(missing.keys(), vectors))
+            self._store(new_vectors)
+            cached.update(new_vectors)
+
+        return [list(cached[text_hash]) for text_hash in hashes]
+
+    def embed_query(self, text: str) -> list:
+        text_hash = text_sha256(text)
+        cached = self._lookup({text_hash})
+
+        if text_hash in cached:
+            self.hits += 1
+            return list(cached[text_hash])
+
+        self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        self._store({text_hash: vector})
+        return vector
+
+    def _lookup(self, hashes: set) -> dict:
+        hashes = list(hashes)
+        found = {}
+        now = time.time()
+
+        with self._lock:
+            for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+                batch = hashes[start:start + LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [self.model, *batch],
+                ).fetchall()
+
+                for text_hash, blob in rows:
+                    found[text_hash] = array("f", blob)
+
+                # Touch the hits so eviction removes the least recently used vectors
+                self._connection.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash IN ({placeholders})",
+                    [now, self.model, *batch],
+                )
+            self._connection.commit()
+
+        return found
+
+    def _store(self, vectors: dict):
+        now = time.time()
+        rows = [(self.model, text_hash, array("f", vector).tobytes(), now) for text_hash, vector in vectors.items()]
+
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+# Offline stand-ins for OpenAI used by the benchmarks, no API key or network is needed
+
+RESPONSE_STRUCTURE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "response_structure.json")
+
+# Same dimension as the OpenAI embedding models so index sizes are realistic
+EMBEDDING_SIZE = 1536
+
+
+def canned_response() -> str:
+    """Build a model answer shaped like response_structure.json, wrapped in a ```json block
+    the way gpt-4o-mini returns it so it passes through clean_response.
+
+    :return: The canned answer
+    :rtype: str
+    """
+    with open(RESPONSE_STRUCTURE_FILE, "r") as json_file:
+        response_structure = json.load(json_file)
+
+    return "```json\n" + json.dumps(response_structure, indent=2) + "\n```"
+
+
+def canned_skill_response(moderated_score: int = 4) -> str:
+    """Build a model answer for one skill, shaped like a skill of response_structure.json, for SkillScorer
+
+    :param moderated_score: The moderated_score in the answer
+    :type moderated_score: int
+    :return: The canned answer
+    :rtype: str
+    """
+    with open(RESPONSE_STRUCTURE_FILE, "r") as json_file:
+        skill = next(iter(json.load(json_file)["skills"].values()))
+
+    return "```json\n" + json.dumps({**skill, "moderated_score": moderated_score}, indent=2) + "\n```"
+
+
+def echo_batch(requests_path: str, results_path: str, answer: str = None):
+    """A local stand-in for the Batch API, answers every request in a request file with a canned
+    answer and writes the results file the Batch API would
+
+    :param requests_path: Path of the .jsonl request file
+    :type requests_path: str
+    :param results_path: Path of the .jsonl results file to write
+    :type results_path: str
+    :param answer: The answer to every request, defaults to canned_response
+    :type answer: str
+    """
+    if answer is None:
+        answer = canned_response()
+
+    with open(requests_path, "r", encoding="utf-8") as requests_file, \
+            open(results_path, "w", encoding="utf-8") as results_file:
+        for number, line in enumerate(requests_file):
+            request = json.loads(line)
+            body = {
+                "id": f"chatcmpl-{number}",
+                "object": "chat.completion",
+                "model": request["body"]["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            }
+            results_file.write(json.dumps({
+                "id": f"batch_req_{number}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": f"req_{number}", "body": body},
+                "error": None,
+            }) + "\n")
+
+
+class FakeChatModel(FakeListChatModel):
+    """FakeListChatModel with the model_name and temperature fields ChatOpenAI has"""
+
+    model_name: str = "fake-chat-model"
+    temperature: float = 0.7
+
+
+def fake_chat_model(latency: float = 0.0, temperature: float = 0.7):
+    """A chat model that always returns the canned response after sleeping for latency seconds
+
+    :param latency: Simulated round trip time of the model call in seconds
+    :type latency: float
+    :param temperature: Reported temperature, the answer is the same either way
+    :type temperature: float
+    :return: The fake chat model
+    """
+    return FakeChatModel(responses=[canned_response()], sleep=latency or None, temperature=temperature)
+
+
+class HashEmbeddings(Embeddings):
+    """Embeddings that hash each text to a repeatable vector.
+
+    langchain's DeterministicFakeEmbedding seeds numpy's global random state, so it returns
+    the wrong vectors when called from several threads at once. This uses a generator per text.
+
+    :param size: Dimension of the vectors
+    :type size: int
+    """
+
+    def __init__(self, size: int = EMBEDDING_SIZE):
+        self.size = size
+
+    def _embed(self, text: str) -> list:
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+        return np.random.default_rng(seed).normal(size=self.size).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self._embed(text)
+
+
+def fake_embeddings(size: int = EMBEDDING_SIZE):
+    """Embeddings that hash each text to a repeatable vector
+
+    :param size: Dimension of the vectors
+    :type size: int
+    :return: The fake embeddings
+    """
+    return HashEmbeddings(size)
+
+
+# Sentences used to fill synthetic assessments, loosely following the real assessment layout
+SYNTHETIC_SKILLS = [
+    "Communicating Between Technical & Non-Technical",
+    "Functional & Non-Functional Testing",
+    "Programming & Build (Software Engineering)",
+    "Service Support",
+]
+SYNTHETIC_EVIDENCE = (
+    "I led the migration of a legacy service to cloud infrastructure, explaining load balancing, "
+    "security and scaling decisions to stakeholders and automating the regression test suite."
+)
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_synthetic_pdf(pdf_path: str, pages: int, lines_per_page: int = 40, seed: int = 0):
+    """Write a plain text PDF shaped like an assessment, for benchmarks that need larger files
+    than the samples in the data folder. Only the PDF syntax pypdf needs to extract text is written.
+
+    :param pdf_path: Path of the PDF to write
+    :type pdf_path: str
+    :param pages: Number of pages
+    :type pages: int
+    :param lines_per_page: Lines of text on each page
+    :type lines_per_page: int
+    :param seed: Varies the text so different files have different content hashes
+    :type seed: int
+    """
+    objects = []
+
+    def add_object(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog_id = add_object(b"")
+    pages_id = add_object(b"")
+    font_id = add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    page_ids = []
+    for page in range(pages):
+        lines = []
+        for line in range(lines_per_page):
+            if line % 10 == 0:
+                skill = SYNTHETIC_SKILLS[(page + line // 10 + seed) % len(SYNTHETIC_SKILLS)]
+                lines.append(skill)
+            else:
+                lines.append(f"{SYNTHETIC_EVIDENCE[:90]} ({seed}.{page}.{line})")
+
+        text = "".join(f"({_pdf_escape(line)}) Tj T* " for line in lines)
+        stream = f"BT /F1 9 Tf 12 TL 40 800 Td {text}ET".encode("latin-1")
+        content_id = add_object(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add_object(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (pages_id, font_id, content_id)
+        ))
+
+    objects[catalog_id - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode()
+    objects[pages_id - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    with open(pdf_path, "wb") as pdf_file:
+        pdf_file.write(b"%PDF-1.4\n")
+        offsets = []
+        for object_id, body in enumerate(objects, start=1):
+            offsets.append(pdf_file.tell())
+            pdf_file.write(b"%d 0 obj\n" % object_id + body + b"\nendobj\n")
+
+        xref_offset = pdf_file.tell()
+        pdf_file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            pdf_file.write(b"%010d 00000 n \n" % offset)
+        pdf_file.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                       % (len(objects) + 1, catalog_id, xref_offset))
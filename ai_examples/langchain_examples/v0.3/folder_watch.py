@@ -0,0 +1,75 @@
+import os
+import time
+
+# Seconds between scans of the watched folder
+WATCH_INTERVAL = 60
+# A PDF is only picked up once it has not been modified for this long, so files still being copied are skipped
+SETTLE_SECONDS = 5
+
+
+def find_pdfs(directory: str) -> list:
+    """Find every PDF under a directory, including its sub folders
+
+    :param directory: The folder to search
+    :type directory: str
+    :return: The PDF paths in sorted order
+    :rtype: list
+    """
+    return sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name.lower().endswith(".pdf")
+    )
+
+
+class FolderWatcher:
+    """Find the PDFs in a folder that are new or modified since the last scan.
+
+    Only the size and modification time of each file are compared, the content hashes are left
+    to the batch journal, so a file that was touched or copied in again without changing is
+    found here but not scored again.
+
+    :param directory: The folder to watch
+    :type directory: str
+    :param settle_seconds: Seconds a file must go unmodified before it is picked up
+    :type settle_seconds: float
+    :param clock: Wall clock in seconds, replaceable in tests
+    """
+
+    def __init__(self, directory: str, settle_seconds: float = SETTLE_SECONDS, clock=time.time):
+        self.directory = directory
+        self.settle_seconds = settle_seconds
+        self.clock = clock
+        self._seen = {}
+
+    def changed(self) -> list:
+        """Scan the folder once
+
+        :return: Paths of the PDFs added or modified since the last scan, in sorted order
+        :rtype: list
+        """
+        now = self.clock()
+        changed = []
+        present = set()
+
+        for pdf_path in find_pdfs(self.directory):
+            try:
+                stat = os.stat(pdf_path)
+            except FileNotFoundError:
+                # Removed between listing the folder and reading it
+                continue
+
+            present.add(pdf_path)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self._seen.get(pdf_path) == signature or now - stat.st_mtime < self.settle_seconds:
+                continue
+
+            self._seen[pdf_path] = signature
+            changed.append(pdf_path)
+
+        # Forget removed files, one copied back in is new again
+        for pdf_path in set(self._seen) - present:
+            del self._seen[pdf_path]
+
+        return changed
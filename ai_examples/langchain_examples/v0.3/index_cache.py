@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import faiss
+from langchain_community.vectorstores import FAISS
+
+from mapped_docstore import MappedDocstore, PositionIds, has_mapped_docstore, save_mapped_docstore
+
+# Default location for saved criteria indexes, kept next to this script
+INDEX_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "indexes")
+
+INDEX_NAME = "index"
+META_FILE = "meta.json"
+
+# Reads the index vectors in place from the memory mapped file, where IO_FLAG_MMAP still copies a flat index into
+# memory, added in faiss 1.11
+MMAP_FLAGS = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+
+
+def embedding_model_name(embeddings) -> str:
+    """Return the model name used by an embeddings object, falling back to the class name
+    for embeddings (such as the langchain fakes) that do not expose one.
+
+    :param embeddings: A langchain Embeddings instance
+    :return: The model name used as part of the cache key
+    :rtype: str
+    """
+    return getattr(embeddings, "model", None) or type(embeddings).__name__
+
+
+def file_sha256(file_path: str) -> str:
+    """Hash the bytes of a file in 1MB blocks
+
+    :param file_path: Path to the file to hash
+    :type file_path: str
+    :return: The hex digest of the file contents
+    :rtype: str
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def index_cache_key(pdf_path: str, chunk_size: int, overlap: int, model: str, index_type: str = "flat",
+                    reduce_dim: int = None) -> str:
+    """Build the cache key for a criteria index.
+
+    The key changes whenever the PDF contents, the chunking settings, the embedding model
+    or the index type change, so an out of date index can never be returned. It is made of
+    a hash of the settings and a hash of the PDF, so entries built with the same settings
+    from an older version of the PDF can be found and removed.
+
+    :param pdf_path: Path to the criteria PDF
+    :type pdf_path: str
+    :param chunk_size: Largest chunk in tokens, see chunking.py
+    :type chunk_size: int
+    :param overlap: Overlap between chunks
+    :type overlap: int
+    :param model: Name of the embedding model
+    :type model: str
+    :param index_type: The faiss index type, see index_types.py
+    :type index_type: str
+    :param reduce_dim: Dimensions the vectors are reduced to, None if they are not
+    :type reduce_dim: int
+    :return: The cache entry directory name
+    :rtype: str
+    """
+    settings = json.dumps({"chunk_size": chunk_size, "overlap": overlap, "model": model,
+                           "index_type": index_type, "reduce_dim": reduce_dim}, sort_keys=True)
+    settings_hash = hashlib.sha256(settings.encode()).hexdigest()[:16]
+    return f"{settings_hash}-{file_sha256(pdf_path)}"
+
+
+def load_cached_index(cache_dir: str, key: str, embeddings, mmap: bool = False):
+    """Load a saved FAISS index and docstore, no embedding calls are made.
+
+    :param cache_dir: Directory holding the cache entries
+    :type cache_dir: str
+    :param key: Cache key from index_cache_key
+    :type key: str
+    :param embeddings: Embeddings used for query embedding once the index is loaded
+    :param mmap: Memory map the index and docstore read only instead of reading them into memory, every process
+        opening the entry shares one copy through the page cache
+    :type mmap: bool
+    :return: The vector store or None if there is no entry for the key
+    """
+    entry_dir = os.path.join(cache_dir, key)
+
+    if not os.path.exists(os.path.join(entry_dir, META_FILE)):
+        return None
+
+    # The docstore is pickled by langchain, the cache directory is only written by save_cached_index
+    if not mmap:
+        return FAISS.load_local(entry_dir, embeddings, INDEX_NAME, allow_dangerous_deserialization=True)
+
+    # The same index file FAISS.load_local reads, with the index pages left on disk until a search touches them
+    index = faiss.read_index(os.path.join(entry_dir, f"{INDEX_NAME}.faiss"), MMAP_FLAGS)
+    if has_mapped_docstore(entry_dir):
+        docstore, index_to_docstore_id = MappedDocstore(entry_dir), PositionIds(index.ntotal)
+    else:
+        with open(os.path.join(entry_dir, f"{INDEX_NAME}.pkl"), "rb") as docstore_file:
+            docstore, index_to_docstore_id = pickle.load(docstore_file)
+
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+def save_cached_index(cache_dir: str, key: str, vector_store, source: str):
+    """Save a FAISS index under its cache key and remove stale entries for the same source.
+
+    The entry is written to a temporary directory first and renamed into place so a reader
+    never sees a partially written index. When several processes build the same entry at
+    once the first rename wins and the others' copies are discarded.
+
+    :param cache_dir: Directory holding the cache entries
+    :type cache_dir: str
+    :param key: Cache key from index_cache_key
+    :type key: str
+    :param vector_store: The FAISS vector store to save
+    :param source: Path of the PDF the index was built from
+    :type source: str
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    vector_store.save_local(tmp_dir, INDEX_NAME)
+    save_mapped_docstore(tmp_dir, vector_store)
+    with open(os.path.join(tmp_dir, META_FILE), "w") as meta_file:
+        json.dump({"source": os.path.abspath(source), "key": key}, meta_file)
+
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Already saved, by an earlier run or another process
+        shutil.rmtree(tmp_dir)
+
+    remove_stale_entries(cache_dir, key, source)
+
+
+def remove_stale_entries(cache_dir: str, key: str, source: str):
+    """Delete cache entries built with the same settings from an older version of the same source PDF
+
+    :param cache_dir: Directory holding the cache entries
+    :type cache_dir: str
+    :param key: Cache key of the current entry, which is kept
+    :type key: str
+    :param source: Path of the PDF the current entry was built from
+    :type source: str
+    """
+    source = os.path.abspath(source)
+    settings_hash = key.split("-")[0]
+
+    for entry in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, entry, META_FILE)
+        if entry == key or not entry.startswith(settings_hash + "-") or not os.path.exists(meta_path):
+            continue
+
+        with open(meta_path, "r") as meta_file:
+            meta = json.load(meta_file)
+
+        if meta.get("source") == source:
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
@@ -0,0 +1,115 @@
+import logging
+import math
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+logger = logging.getLogger("langchain_examples")
+
+# flat keeps full float32 vectors and searches them all, ivf searches the nprobe closest clusters,
+# ivfpq also compresses each vector to PQ_M 4-bit codes searched with faiss's fast scan kernels
+INDEX_TYPES = ("flat", "ivf", "ivfpq")
+
+# Below this many vectors a flat search is already fast and clustering has too little to train on
+MIN_IVF_VECTORS = 1000
+# Clusters searched per query, a higher value trades latency for recall
+NPROBE = 16
+# Sub vectors per vector in an ivfpq index, each stored as a 4-bit code
+PQ_M = 128
+
+
+def index_factory_string(index_type: str, vectors: int, dimension: int, reduce_dim: int = None) -> str:
+    """Describe the index for faiss.index_factory, e.g PCA256,IVF400,PQ128x4fs
+
+    :param index_type: One of INDEX_TYPES
+    :type index_type: str
+    :param vectors: Number of vectors the index is trained on
+    :type vectors: int
+    :param dimension: Dimension of the embeddings
+    :type dimension: int
+    :param reduce_dim: Reduce the vectors to this many dimensions with PCA first, None to keep them
+    :type reduce_dim: int
+    :return: The faiss index factory string
+    :rtype: str
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type}, expected one of {', '.join(INDEX_TYPES)}")
+
+    prefix = ""
+    if reduce_dim is not None and reduce_dim < dimension:
+        prefix = f"PCA{reduce_dim},"
+        dimension = reduce_dim
+
+    if index_type != "flat" and vectors < MIN_IVF_VECTORS:
+        logger.warning(f"Only {vectors} vectors, building a flat index instead of {index_type}")
+        index_type = "flat"
+
+    if index_type == "flat":
+        return prefix + "Flat"
+
+    # Around 4 * sqrt(n) clusters, with the 39 training points per cluster faiss asks for
+    nlist = max(1, min(int(4 * math.sqrt(vectors)), vectors // 39))
+
+    if index_type == "ivf":
+        return f"{prefix}IVF{nlist},Flat"
+
+    # Product quantisation needs the dimension to split evenly into pq_m sub vectors, 4-bit fast scan
+    # codes train in seconds where 8-bit codes take minutes on high dimensional embeddings
+    pq_m = max(m for m in range(2, min(PQ_M, dimension) + 1, 2) if dimension % m == 0)
+    return f"{prefix}IVF{nlist},PQ{pq_m}x4fs"
+
+
+def build_faiss_index(vectors: np.ndarray, index_type: str = "flat", reduce_dim: int = None):
+    """Train and fill a faiss index
+
+    :param vectors: float32 array of shape (n, dimension)
+    :param index_type: One of INDEX_TYPES
+    :type index_type: str
+    :param reduce_dim: Reduce the vectors to this many dimensions with PCA first, None to keep them
+    :type reduce_dim: int
+    :return: The faiss index
+    """
+    description = index_factory_string(index_type, vectors.shape[0], vectors.shape[1], reduce_dim)
+    index = faiss.index_factory(vectors.shape[1], description)
+
+    if not index.is_trained:
+        index.train(vectors)
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = NPROBE
+        if isinstance(index, faiss.IndexIVFFlat):
+            # Lets retrieve_for_sections reconstruct vectors for MMR
+            ivf.set_direct_map_type(faiss.DirectMap.Array)
+
+    index.add(vectors)
+    return index
+
+
+def build_vector_store(docs: list, embeddings, index_type: str = "flat", reduce_dim: int = None, vectors=None):
+    """Embed documents into a langchain FAISS store backed by the chosen index type
+
+    :param docs: The Documents to index
+    :type docs: list
+    :param embeddings: The Embeddings used for the documents and later queries
+    :param index_type: One of INDEX_TYPES
+    :type index_type: str
+    :param reduce_dim: Reduce the vectors to this many dimensions with PCA first, None to keep them
+    :type reduce_dim: int
+    :param vectors: The embeddings of docs if they are already known, None to embed them
+    :return: The FAISS vector store
+    """
+    if vectors is None:
+        vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+
+    index = build_faiss_index(np.asarray(vectors, dtype=np.float32), index_type, reduce_dim)
+
+    ids = [str(i) for i in range(len(docs))]
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, docs))),
+        index_to_docstore_id=dict(enumerate(ids)),
+    )
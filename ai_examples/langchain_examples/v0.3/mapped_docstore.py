@@ -0,0 +1,90 @@
+import json
+import mmap
+import os
+from collections.abc import Mapping
+
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+# The documents of a saved index as JSON records one after another, and the byte offset of each record
+DOCSTORE_FILE = "docstore.bin"
+OFFSETS_FILE = "docstore.offsets.npy"
+
+
+def save_mapped_docstore(entry_dir: str, vector_store):
+    """Write the documents of a FAISS store in index order, for MappedDocstore to open
+
+    :param entry_dir: Directory the index is saved in
+    :type entry_dir: str
+    :param vector_store: The FAISS vector store
+    """
+    offsets = [0]
+    with open(os.path.join(entry_dir, DOCSTORE_FILE), "wb") as docstore_file:
+        for position in range(vector_store.index.ntotal):
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[position])
+            record = {"id": doc.id, "page_content": doc.page_content, "metadata": doc.metadata}
+            offsets.append(offsets[-1] + docstore_file.write(json.dumps(record).encode("utf-8")))
+
+    np.save(os.path.join(entry_dir, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+
+
+def has_mapped_docstore(entry_dir: str) -> bool:
+    """Whether the entry was saved with save_mapped_docstore, entries saved before it only have the pickle"""
+    return os.path.exists(os.path.join(entry_dir, OFFSETS_FILE))
+
+
+class PositionIds(Mapping):
+    """index_to_docstore_id for a MappedDocstore, the docstore id of each vector is its position in the index
+
+    :param count: Number of vectors in the index
+    :type count: int
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.count:
+            raise KeyError(position)
+        return str(position)
+
+    def __iter__(self):
+        return iter(range(self.count))
+
+    def __len__(self):
+        return self.count
+
+
+class MappedDocstore(Docstore):
+    """Read only docstore over the files written by save_mapped_docstore, memory mapped rather than unpickled.
+
+    Opening it reads nothing, a search decodes the one record it returns. The pages are shared
+    through the page cache, so every worker process opening the same entry uses one copy.
+
+    :param entry_dir: Directory the index is saved in
+    :type entry_dir: str
+    """
+
+    def __init__(self, entry_dir: str):
+        self._offsets = np.load(os.path.join(entry_dir, OFFSETS_FILE), mmap_mode="r")
+
+        with open(os.path.join(entry_dir, DOCSTORE_FILE), "rb") as docstore_file:
+            # mmap can not map an empty file, an index with no documents has nothing to read anyway
+            self._data = b"" if self._offsets[-1] == 0 else mmap.mmap(docstore_file.fileno(), 0,
+                                                                       access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def search(self, search: str):
+        """Return the Document with docstore id search, from PositionIds, or a message if there is none"""
+        try:
+            position = int(search)
+        except ValueError:
+            position = -1
+        if not 0 <= position < len(self):
+            return f"ID {search} not found."
+
+        record = json.loads(self._data[self._offsets[position]:self._offsets[position + 1]])
+        return Document(**record)
@@ -0,0 +1,199 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+
+import pypdf
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents import Document
+
+from index_cache import file_sha256
+
+logger = logging.getLogger("langchain_examples")
+
+# Default location for extracted page text, kept next to this script. Read when a PDF is loaded rather than
+# bound as a default argument, so it can be pointed elsewhere, e.g a temporary folder in tests and benchmarks,
+# or set to None to turn the cache off
+PAGE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "pages")
+# Least recently used entries are evicted once the cache holds more than this many bytes
+MAX_PAGE_CACHE_BYTES = 512 * 1024 * 1024
+
+# Stands for PAGE_CACHE_DIR as a default argument, None already means no cache
+_DEFAULT_CACHE_DIR = object()
+
+# Threads reading the rest of a PDF into the cache after its caller stopped early, see wait_for_page_cache
+_finishing = set()
+_finishing_lock = threading.Lock()
+
+
+def page_cache_path(cache_dir: str, pdf_path: str) -> str:
+    """Path of the cache entry for a PDF, keyed by its content hash and the pypdf version
+    since a different pypdf may extract different text
+
+    :param cache_dir: Directory holding the cache entries
+    :type cache_dir: str
+    :param pdf_path: Path to the PDF
+    :type pdf_path: str
+    :return: Path of the gzipped JSON lines entry, one line per page
+    :rtype: str
+    """
+    return os.path.join(cache_dir, f"{file_sha256(pdf_path)}-pypdf{pypdf.__version__}.jsonl.gz")
+
+
+def iter_pdf_pages(pdf_path: str, cache_dir: str = _DEFAULT_CACHE_DIR):
+    """Yield the pages of a PDF one at a time, using the cached text and metadata when the file is unchanged.
+
+    Only the page being read is held in memory, both when parsing with pypdf and when reading
+    the cache. A parsed PDF is cached once every page has been read. If the caller stops early,
+    e.g at its token limit, the whole PDF is read into the cache on a background thread instead,
+    so the next load of the file is a cache hit however much of it this one read.
+
+    :param pdf_path: Path to the PDF
+    :type pdf_path: str
+    :param cache_dir: Directory holding the cache entries, PAGE_CACHE_DIR if not given, None to always parse the PDF
+    :type cache_dir: str
+    :return: A generator of one Document per page, as yielded by PyPDFLoader.lazy_load
+    """
+    if cache_dir is _DEFAULT_CACHE_DIR:
+        cache_dir = PAGE_CACHE_DIR
+    if cache_dir is None:
+        yield from PyPDFLoader(pdf_path).lazy_load()
+        return
+
+    entry_path = page_cache_path(cache_dir, pdf_path)
+
+    if os.path.exists(entry_path):
+        try:
+            # Touched so eviction removes the least recently used entries
+            os.utime(entry_path)
+        except FileNotFoundError:
+            # Evicted by another process since
+            pass
+
+        with gzip.open(entry_path, "rt", encoding="utf-8") as entry_file:
+            for line in entry_file:
+                page = json.loads(line)
+                # The same file may have been cached from a different path
+                yield Document(page_content=page["text"], metadata={**page["metadata"], "source": pdf_path})
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+    os.close(file_descriptor)
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as entry_file:
+            for page in PyPDFLoader(pdf_path).lazy_load():
+                entry_file.write(json.dumps({"text": page.page_content, "metadata": page.metadata},
+                                            separators=(",", ":")) + "\n")
+                yield page
+
+        # Renamed into place so a parallel parse of the same file never reads a partial entry
+        os.replace(tmp_path, entry_path)
+    except GeneratorExit:
+        # Stopped early, the pypdf reader may be closed along with this generator so a new one reads the file
+        cache_in_background(pdf_path, cache_dir)
+        raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    evict_page_cache(cache_dir)
+
+
+def cache_in_background(pdf_path: str, cache_dir: str):
+    """Read every page of a PDF into the cache on a background thread, see wait_for_page_cache
+
+    :param pdf_path: Path to the PDF
+    :type pdf_path: str
+    :param cache_dir: Directory holding the cache entries
+    :type cache_dir: str
+    """
+    def cache():
+        try:
+            for _ in iter_pdf_pages(pdf_path, cache_dir):
+                pass
+        except Exception as e:
+            # The pages the caller read were fine, the next load parses the file again
+            logger.warning(f"Could not cache the pages of {pdf_path}: {e}")
+        finally:
+            with _finishing_lock:
+                _finishing.discard(threading.current_thread())
+
+    finisher = threading.Thread(target=cache, name=f"page-cache-{os.path.basename(pdf_path)}")
+    with _finishing_lock:
+        _finishing.add(finisher)
+    try:
+        finisher.start()
+    except RuntimeError:
+        # Closed as the interpreter shuts down, when no new threads can start
+        with _finishing_lock:
+            _finishing.discard(finisher)
+
+
+def wait_for_page_cache(timeout: float = None):
+    """Wait for the PDFs being read into the cache in the background to be saved
+
+    The threads are not daemons, so the interpreter also waits for them before it exits.
+
+    :param timeout: Most seconds to wait for each PDF, None to wait until they are saved
+    :type timeout: float
+    """
+    with _finishing_lock:
+        finishing = list(_finishing)
+
+    for finisher in finishing:
+        finisher.join(timeout)
+
+
+def evict_page_cache(cache_dir: str, max_bytes: int = None):
+    """Remove the least recently used entries until the cache is no bigger than max_bytes
+
+    :param cache_dir: Directory holding the cache entries
+    :type cache_dir: str
+    :param max_bytes: Largest total size of the entries, None for MAX_PAGE_CACHE_BYTES
+    :type max_bytes: int
+    :return: The number of entries removed
+    :rtype: int
+    """
+    if max_bytes is None:
+        max_bytes = MAX_PAGE_CACHE_BYTES
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        # Temporary files belong to parses still running
+        if entry.name.endswith(".jsonl.gz") and not entry.name.startswith(".tmp-"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, entry_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(entry_path)
+            removed += 1
+        except FileNotFoundError:
+            # Removed by another process evicting at the same time
+            pass
+        total -= size
+
+    return removed
+
+
+def load_pdf_pages(pdf_path: str, cache_dir: str = _DEFAULT_CACHE_DIR) -> list:
+    """Load every page of a PDF, see iter_pdf_pages
+
+    :param pdf_path: Path to the PDF
+    :type pdf_path: str
+    :param cache_dir: Directory holding the cache entries, PAGE_CACHE_DIR if not given, None to always parse the PDF
+    :type cache_dir: str
+    :return: One Document per page, as returned by PyPDFLoader.load
+    :rtype: list
+    """
+    return list(iter_pdf_pages(pdf_path, cache_dir))
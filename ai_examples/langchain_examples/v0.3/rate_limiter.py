@@ -0,0 +1,147 @@
+import threading
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Requests and tokens per minute allowed for each model, from the OpenAI usage tier of the account.
+# Models that are not listed, such as the offline fakes, are not limited.
+RATE_LIMITS = {
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200_000},
+    "text-embedding-ada-002": {"rpm": 3_000, "tpm": 1_000_000},
+    "text-embedding-3-small": {"rpm": 3_000, "tpm": 1_000_000},
+}
+
+# Tokens charged up front for a chat answer, the actual count from the response's usage is reconciled after
+COMPLETION_TOKEN_ESTIMATE = 1_000
+
+
+class ModelRateLimiter:
+    """Token buckets for the requests per minute and tokens per minute budgets of one model.
+
+    Each call takes one request and its estimated tokens from the buckets, waiting until both
+    have refilled enough. The buckets start full and refill continuously, so a burst can use a
+    whole minute's budget at once and the long run rate never goes past the limits.
+
+    :param rpm: Requests per minute
+    :type rpm: int
+    :param tpm: Tokens per minute
+    :type tpm: int
+    :param clock: Monotonic clock in seconds, replaceable in tests
+    :param sleep: Function used to wait, replaceable in tests
+    """
+
+    def __init__(self, rpm: int, tpm: int, clock=time.monotonic, sleep=time.sleep):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = now - self._updated
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+        self._updated = now
+
+    def acquire(self, tokens: int) -> int:
+        """Wait until a request of this many tokens fits in the budgets, then charge it
+
+        :param tokens: Estimated tokens used by the request
+        :type tokens: int
+        :return: The tokens charged, pass them to reconcile once the actual count is known
+        :rtype: int
+        """
+        # A request bigger than a minute's budget would never fit, it waits for a full bucket instead
+        tokens = min(tokens, self.tpm)
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return tokens
+
+                wait_time = max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+
+            self.sleep(wait_time)
+
+    def reconcile(self, charged: int, actual: int):
+        """Refund an over estimate, or charge an under estimate, once the actual token count is known
+
+        :param charged: Tokens charged by acquire, or the estimate passed to it
+        :type charged: int
+        :param actual: Tokens the response's usage reports
+        :type actual: int
+        """
+        charged = min(charged, self.tpm)
+
+        with self._lock:
+            self._refill()
+            # The bucket may go below zero, later calls then wait for the debt to be paid off
+            self._tokens = min(self.tpm, self._tokens + charged - actual)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model: str):
+    """Return the limiter shared by every call to a model in this process
+
+    :param model: The model name
+    :type model: str
+    :return: The ModelRateLimiter, or None if the model has no limits in RATE_LIMITS
+    """
+    if model not in RATE_LIMITS:
+        return None
+
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = ModelRateLimiter(**RATE_LIMITS[model])
+        return _limiters[model]
+
+
+def rate_limited(limiter, tokens: int, func):
+    """Wrap func so each call, including each retry, first takes its request and tokens from limiter
+
+    :param limiter: A ModelRateLimiter or None for no limit
+    :param tokens: Estimated tokens used by one call
+    :type tokens: int
+    :param func: The function making the API call
+    :return: The wrapped function
+    """
+    if limiter is None:
+        return func
+
+    def call(*args, **kwargs):
+        limiter.acquire(tokens)
+        return func(*args, **kwargs)
+
+    return call
+
+
+class UsageCallback(BaseCallbackHandler):
+    """Collects the token usage reported by chat model responses, for reconciling the estimate"""
+
+    def __init__(self):
+        self.total_tokens = None
+
+    def on_llm_end(self, response, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+
+        if "total_tokens" not in usage:
+            # Chat models that only report usage on the message, e.g when streaming
+            for generations in response.generations:
+                for generation in generations:
+                    message_usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                    if message_usage:
+                        usage = message_usage
+
+        if "total_tokens" in usage:
+            self.total_tokens = (self.total_tokens or 0) + usage["total_tokens"]
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Default location for the response cache database, kept next to this script
+RESPONSE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "responses.sqlite")
+
+# Responses older than this are treated as missing, and the least recently used are evicted past the size limit
+RESPONSE_CACHE_TTL = 30 * 24 * 60 * 60
+MAX_CACHED_RESPONSES = 10_000
+
+
+def response_cache_key(model: str, temperature, prompt: str, context_texts: list) -> str:
+    """Hash everything that decides the model's answer
+
+    :param model: The chat model name
+    :type model: str
+    :param temperature: The sampling temperature
+    :param prompt: The fully rendered prompt
+    :type prompt: str
+    :param context_texts: The retrieved criteria texts sent with the prompt
+    :type context_texts: list
+    :return: The hex digest used as the cache key
+    :rtype: str
+    """
+    key = json.dumps({"model": model, "temperature": temperature, "prompt": prompt, "context": context_texts})
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Persistent exact match cache of model answers, backed by SQLite.
+
+    Answers at temperature > 0 are samples rather than the only possible answer, set
+    cache_sampled=False to only cache deterministic (temperature 0) calls.
+
+    :param cache_path: Path of the SQLite database
+    :type cache_path: str
+    :param ttl: Seconds an answer stays valid
+    :type ttl: int
+    :param max_entries: Number of answers kept before the least recently used are evicted
+    :type max_entries: int
+    :param cache_sampled: Cache answers given at temperature > 0
+    :type cache_sampled: bool
+    """
+
+    def __init__(self, cache_path: str = RESPONSE_CACHE_PATH, ttl: int = RESPONSE_CACHE_TTL,
+                 max_entries: int = MAX_CACHED_RESPONSES, cache_sampled: bool = True):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_sampled = cache_sampled
+
+        if cache_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+
+        # The connection is shared between the worker threads in process_multiple_assessments
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._connection.commit()
+
+    def enabled_for(self, temperature) -> bool:
+        return self.cache_sampled or not temperature
+
+    def get(self, key: str):
+        """Return the cached answer for key, or None if it is missing or has expired"""
+        now = time.time()
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response FROM responses WHERE key = ? AND created > ?", (key, now - self.ttl)
+            ).fetchone()
+
+            if row is not None:
+                self._connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                self._connection.commit()
+
+        return None if row is None else row[0]
+
+    def put(self, key: str, response: str):
+        now = time.time()
+
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, now, now))
+            self._connection.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._connection.commit()
@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+
+
+class NDJSONResultsWriter:
+    """Write one compact JSON record per line, flushed as each record is written.
+
+    Records are written as soon as they are passed in, so nothing is held in memory and
+    readers can consume the file while a batch is still running. Writes are serialised so
+    the writer can be shared by worker threads.
+
+    :param output_path: Path of the .ndjson file
+    :type output_path: str
+    :param append: Add to an existing file instead of replacing it
+    :type append: bool
+    """
+
+    def __init__(self, output_path: str, append: bool = False):
+        self.output_path = output_path
+        self.records_written = 0
+        self._lock = threading.Lock()
+        self._file = open(output_path, "a" if append else "w", encoding="utf-8")
+
+    def write(self, record: dict):
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.records_written += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class JSONArrayResultsWriter(NDJSONResultsWriter):
+    """Write records as a JSON array, one compact record per line.
+
+    The closing bracket is only written by close(), until then the file is a valid
+    JSON array prefix that can be read incrementally.
+    """
+
+    def __init__(self, output_path: str, append: bool = False):
+        if append:
+            raise ValueError("JSON array results can not be appended to, use an .ndjson file")
+
+        super().__init__(output_path)
+        self._file.write("[\n")
+        self._file.flush()
+
+    def write(self, record: dict):
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            self._file.write((",\n" if self.records_written else "") + line)
+            self._file.flush()
+            self.records_written += 1
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.write("\n]\n")
+                self._file.close()
+
+
+def open_results_writer(output_path: str, append: bool = False):
+    """Open a writer for output_path, .json gives a JSON array, anything else NDJSON
+
+    :param output_path: Path of the results file
+    :type output_path: str
+    :param append: Add to an existing NDJSON file instead of replacing it
+    :type append: bool
+    :return: The results writer
+    """
+    if os.path.splitext(output_path)[1].lower() == ".json":
+        return JSONArrayResultsWriter(output_path, append)
+
+    return NDJSONResultsWriter(output_path, append)
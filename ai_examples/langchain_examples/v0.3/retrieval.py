@@ -0,0 +1,109 @@
+import faiss
+import numpy as np
+from langchain_community.vectorstores.utils import DistanceStrategy, maximal_marginal_relevance
+
+from spans import span
+
+# Criteria chunks fetched for each assessment section, and the most kept after merging
+SECTION_K = 4
+MAX_CRITERIA_DOCS = 16
+
+# Balance between relevance (1) and diversity (0) when merging with MMR
+MMR_LAMBDA = 0.5
+
+
+def candidate_vectors(vector_store, ids: list) -> list:
+    """Return the stored vectors for MMR, re-embedding the chunk texts when the index cannot give them back.
+
+    Only flat indexes hold the exact vectors, compressed and PCA reduced indexes (see index_types.py)
+    either return an approximation or do not support reconstruct at all.
+
+    :param vector_store: The FAISS store returned by embed_criteria
+    :param ids: Positions of the chunks in the faiss index
+    :type ids: list
+    :return: One vector per id
+    :rtype: list
+    """
+    index = vector_store.index
+    direct_map = isinstance(index, faiss.IndexIVFFlat) and index.direct_map.type != faiss.DirectMap.NoMap
+    if isinstance(index, faiss.IndexFlat) or direct_map:
+        return [index.reconstruct(int(i)) for i in ids]
+
+    texts = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]).page_content for i in ids]
+    vectors = np.asarray(vector_store.embeddings.embed_documents(texts), dtype=np.float32)
+    if vector_store._normalize_L2:
+        faiss.normalize_L2(vectors)
+    return list(vectors)
+
+
+def embed_sections(vector_store, section_texts: list) -> np.ndarray:
+    """Embed the sections of an assessment in one embed_documents call, the result can be passed to
+    retrieve_for_sections for every criteria index built with the same embeddings
+
+    :param vector_store: A FAISS store whose embeddings are used
+    :param section_texts: Texts of the assessment sections
+    :type section_texts: list
+    :return: float32 array with one row per section
+    """
+    with span("embed"):
+        return np.asarray(vector_store.embeddings.embed_documents(section_texts), dtype=np.float32)
+
+
+def retrieve_for_sections(vector_store, section_texts: list, k: int = SECTION_K,
+                          max_docs: int = MAX_CRITERIA_DOCS, mmr: bool = False, queries: np.ndarray = None) -> list:
+    """Retrieve criteria for every section of an assessment with one embedding call and one search.
+
+    All sections are embedded in a single embed_documents call and searched as one query matrix,
+    instead of embedding the whole assessment as a single oversized query. Chunks found by more
+    than one section are kept once, at their best rank.
+
+    :param vector_store: The FAISS store returned by embed_criteria
+    :param section_texts: Texts of the assessment sections, e.g the chunks from process_assessment
+    :type section_texts: list
+    :param k: Criteria chunks fetched per section
+    :type k: int
+    :param max_docs: Most criteria chunks returned
+    :type max_docs: int
+    :param mmr: Choose the chunks by maximal marginal relevance to the whole assessment rather than
+        by best distance, which favours criteria covering different skills
+    :type mmr: bool
+    :param queries: The sections already embedded by embed_sections, None to embed them
+    :return: Criteria Documents, most relevant first
+    :rtype: list
+    """
+    if not section_texts or vector_store.index.ntotal == 0:
+        return []
+
+    if queries is None:
+        queries = embed_sections(vector_store, section_texts)
+    if vector_store._normalize_L2:
+        # Normalised in a copy, the caller's queries may be searched against other stores
+        queries = queries.copy()
+        faiss.normalize_L2(queries)
+
+    with span("retrieve"):
+        return search_sections(vector_store, queries, k, max_docs, mmr)
+
+
+def search_sections(vector_store, queries: np.ndarray, k: int, max_docs: int, mmr: bool) -> list:
+    """Search the index with the embedded sections, see retrieve_for_sections"""
+    scores, indices = vector_store.index.search(queries, min(k, vector_store.index.ntotal))
+
+    # Lower is better for L2 distances, higher for inner product
+    if vector_store.distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD):
+        scores = -scores
+
+    best = {}
+    for section_scores, section_indices in zip(scores, indices):
+        for score, i in zip(section_scores, section_indices):
+            if i != -1 and (i not in best or score < best[i]):
+                best[i] = score
+
+    ranked = sorted(best, key=best.get)
+
+    if mmr and len(ranked) > max_docs:
+        candidates = candidate_vectors(vector_store, ranked)
+        chosen = maximal_marginal_relevance(queries.mean(axis=0), candidates, MMR_LAMBDA, max_docs)
+        ranked = [ranked[j] for j in chosen]
+
+    return [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in ranked[:max_docs]]
@@ -0,0 +1,65 @@
+import re
+
+# Words left out when matching a skill name to a section heading
+STOP_WORDS = {"and", "of", "the", "for", "to", "in"}
+# Share of words a section heading must have in common with a skill name to belong to it
+SECTION_MATCH = 0.4
+
+
+def heading_words(heading: str) -> set:
+    """The words of a skill name or heading, cut to their first six letters so "Communicating" and
+    "Communication" or "Function" and "Functional" match"""
+    return {word[:6] for word in re.findall(r"[a-z0-9]+", heading.lower()) if word not in STOP_WORDS}
+
+
+def match_skill(section: str, skills: list):
+    """Find the skill a section heading is about, headings are worded differently in the criteria,
+    the assessments and response_structure.json, e.g "Programming and Build." for "Programming & Build
+    (Software Engineering)"
+
+    :param section: The section heading, as set in the chunk metadata by chunk_documents
+    :type section: str
+    :param skills: The skill names
+    :type skills: list
+    :return: The skill with the most words in common, or None if none has SECTION_MATCH of them
+    """
+    words = heading_words(section or "")
+    best, best_match = None, SECTION_MATCH
+
+    for skill in skills:
+        skill_words = heading_words(skill)
+        match = len(words & skill_words) / len(words | skill_words) if skill_words else 0
+        if match >= best_match:
+            best, best_match = skill, match
+
+    return best
+
+
+def summarise_skills(skills: dict) -> dict:
+    """Work out the summary of response_structure.json from the scored skills, rather than asking the model
+
+    :param skills: The result of each skill keyed by name, a skill that failed holds an error instead
+    :type skills: dict
+    :return: overall_score, the mean moderated_score, and its score_calculation, with the skills left out
+        listed as unscored_skills
+    :rtype: dict
+    """
+    scores = {}
+    unscored = []
+    for skill, result in skills.items():
+        try:
+            scores[skill] = float(result["moderated_score"])
+        except (KeyError, TypeError, ValueError):
+            unscored.append(skill)
+
+    if not scores:
+        summary = {"overall_score": None, "score_calculation": "No skills were scored"}
+    else:
+        overall = round(sum(scores.values()) / len(scores), 2)
+        terms = "+".join(f"{score:g}" for score in scores.values())
+        summary = {"overall_score": overall, "score_calculation": f"({terms})/{len(scores)} = {overall:g}"}
+
+    if unscored:
+        summary["unscored_skills"] = unscored
+
+    return summary
@@ -0,0 +1,329 @@
+import contextvars
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from results_writer import NDJSONResultsWriter
+
+# Stages of an assessment, in pipeline order, each is timed as a span inside the "assessment" span
+STAGES = ("load", "split", "embed", "retrieve", "generate", "parse")
+
+PROMETHEUS_PREFIX = "criteria_measure"
+
+# The span the current thread is inside, None when no SpanRecorder is tracing it
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """Wall time, token counts and retries of one stage of one assessment"""
+
+    def __init__(self, recorder, stage: str, assessment: str, attributes: dict):
+        self.recorder = recorder
+        self.stage = stage
+        self.assessment = assessment
+        self.attributes = attributes
+        self.tokens = {}
+        self.retries = 0
+        self.error = None
+        self.start = time.time()
+        self.seconds = 0.0
+        # Time spent in span_iter stages read from inside this one
+        self.nested_seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "assessment": self.assessment,
+            "stage": self.stage,
+            "start": self.start,
+            "seconds": self.seconds,
+            "tokens": self.tokens,
+            "retries": self.retries,
+            "error": self.error,
+            **self.attributes,
+        }
+
+
+@contextmanager
+def span(stage: str, **attributes):
+    """Time the code inside the block as a stage of the assessment being traced.
+
+    Does nothing outside SpanRecorder.assessment, so library code can be instrumented
+    whether or not anything is recording.
+
+    :param stage: Name of the stage, see STAGES
+    :type stage: str
+    :param attributes: Extra fields exported with the span
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    current = Span(parent.recorder, stage, parent.assessment, attributes)
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.seconds = time.perf_counter() - start
+        _current_span.reset(token)
+        current.recorder.record(current)
+
+
+def span_iter(stage: str, items, **attributes):
+    """Time a lazy stage, such as pages parsed as they are read, as one span of the time spent
+    producing its items.
+
+    Time spent in a span_iter stage that this one reads from counts toward that stage only,
+    so chained generators, e.g split reading from load, are timed separately. Closing the
+    generator early closes items and records the span.
+
+    :param stage: Name of the stage, see STAGES
+    :type stage: str
+    :param items: The iterable producing the items
+    :param attributes: Extra fields exported with the span
+    :return: A generator of the items
+    """
+    iterator = iter(items)
+    parent = _current_span.get()
+    if parent is None:
+        try:
+            yield from iterator
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+        return
+
+    current = Span(parent.recorder, stage, parent.assessment, attributes)
+    try:
+        while True:
+            token = _current_span.set(current)
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            except BaseException as e:
+                current.error = type(e).__name__
+                raise
+            finally:
+                current.seconds += time.perf_counter() - start
+                _current_span.reset(token)
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+        parent.nested_seconds += current.seconds
+        current.seconds -= current.nested_seconds
+        current.recorder.record(current)
+
+
+def add_tokens(**tokens):
+    """Add token counts, e.g prompt=1200, to the current span"""
+    current = _current_span.get()
+    if current is not None:
+        with current.recorder.lock:
+            for kind, count in tokens.items():
+                current.tokens[kind] = current.tokens.get(kind, 0) + count
+
+
+def record_retry():
+    """Count a retried API call against the current span"""
+    current = _current_span.get()
+    if current is not None:
+        with current.recorder.lock:
+            current.retries += 1
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest rank percentile of values, e.g fraction=0.95 for p95"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)] if ordered else 0.0
+
+
+class MemorySpanExporter:
+    """Keep the spans as dicts, used to send spans recorded in a parsing process back to the batch"""
+
+    def __init__(self):
+        self.spans = []
+
+    def write(self, record: dict):
+        self.spans.append(record)
+
+    def close(self, summary: dict):
+        pass
+
+
+class JSONLinesSpanExporter:
+    """Write each span as a JSON line as soon as it ends, and the batch summary as the last line
+
+    :param output_path: Path of the .jsonl file
+    :type output_path: str
+    """
+
+    def __init__(self, output_path: str):
+        self._writer = NDJSONResultsWriter(output_path)
+
+    def write(self, record: dict):
+        self._writer.write(record)
+
+    def close(self, summary: dict):
+        self._writer.write({"summary": summary})
+        self._writer.close()
+
+
+class PrometheusSpanExporter:
+    """Write the batch summary in the Prometheus text format when the batch ends, e.g for the
+    node_exporter textfile collector. The file is replaced in one rename so it is never read half written.
+
+    :param output_path: Path of the .prom file
+    :type output_path: str
+    """
+
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+
+    def write(self, record: dict):
+        pass
+
+    def close(self, summary: dict):
+        seconds = f"{PROMETHEUS_PREFIX}_stage_seconds"
+        lines = [f"# HELP {seconds} Wall time of each stage of an assessment", f"# TYPE {seconds} summary"]
+        for stage, stats in summary.items():
+            lines.append(f'{seconds}{{stage="{stage}",quantile="0.5"}} {stats["p50"]}')
+            lines.append(f'{seconds}{{stage="{stage}",quantile="0.95"}} {stats["p95"]}')
+            lines.append(f'{seconds}_sum{{stage="{stage}"}} {stats["seconds"]}')
+            lines.append(f'{seconds}_count{{stage="{stage}"}} {stats["count"]}')
+
+        for name, help_text, key in (("tokens", "Tokens used by each stage", "tokens"),
+                                     ("retries", "API calls retried by each stage", "retries"),
+                                     ("errors", "Spans of each stage that raised", "errors")):
+            metric = f"{PROMETHEUS_PREFIX}_stage_{name}_total"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            for stage, stats in summary.items():
+                if key == "tokens":
+                    lines += [f'{metric}{{stage="{stage}",kind="{kind}"}} {count}'
+                              for kind, count in sorted(stats["tokens"].items())]
+                else:
+                    lines.append(f'{metric}{{stage="{stage}"}} {stats[key]}')
+
+        directory = os.path.dirname(os.path.abspath(self.output_path))
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        with os.fdopen(file_descriptor, "w") as prom_file:
+            prom_file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.output_path)
+
+
+def open_span_exporter(output_path: str):
+    """Open an exporter for output_path, .prom gives the Prometheus text format, anything else JSON lines
+
+    :param output_path: Path of the spans file
+    :type output_path: str
+    :return: The span exporter
+    """
+    if os.path.splitext(output_path)[1].lower() == ".prom":
+        return PrometheusSpanExporter(output_path)
+
+    return JSONLinesSpanExporter(output_path)
+
+
+class SpanRecorder:
+    """Collects the spans of a batch of assessments and summarises them per stage.
+
+    Only the per stage durations are kept in memory, the spans themselves go to the exporter.
+    The recorder is shared by the worker threads scoring the batch.
+
+    :param exporter: Where spans are written, see open_span_exporter, None to only summarise them
+    """
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self.lock = threading.Lock()
+        self._seconds = {}
+        self._tokens = {}
+        self._retries = {}
+        self._errors = {}
+
+    @contextmanager
+    def assessment(self, assessment: str):
+        """Trace the stages run inside the block as spans of one assessment
+
+        :param assessment: Path of the assessment PDF
+        :type assessment: str
+        """
+        # span() takes the recorder and the assessment from the span it is opened in
+        root = Span(self, "assessment", assessment, {})
+        token = _current_span.set(root)
+        try:
+            with span("assessment") as assessment_span:
+                yield assessment_span
+        finally:
+            _current_span.reset(token)
+
+    def record(self, current):
+        """Add a finished Span, or the dict of one recorded by another process"""
+        record = current if isinstance(current, dict) else current.to_dict()
+        stage = record["stage"]
+
+        with self.lock:
+            self._seconds.setdefault(stage, []).append(record["seconds"])
+            stage_tokens = self._tokens.setdefault(stage, {})
+            for kind, count in record["tokens"].items():
+                stage_tokens[kind] = stage_tokens.get(kind, 0) + count
+            self._retries[stage] = self._retries.get(stage, 0) + record["retries"]
+            self._errors[stage] = self._errors.get(stage, 0) + (record["error"] is not None)
+
+            if self.exporter is not None:
+                self.exporter.write(record)
+
+    def summary(self) -> dict:
+        """Per stage count, p50, p95 and max wall time in seconds, with total seconds, tokens, retries and errors
+
+        :return: The summary keyed by stage, in pipeline order
+        :rtype: dict
+        """
+        with self.lock:
+            stages = [stage for stage in ("assessment",) + STAGES if stage in self._seconds]
+            stages += sorted(set(self._seconds) - set(stages))
+
+            return {
+                stage: {
+                    "count": len(self._seconds[stage]),
+                    "p50": percentile(self._seconds[stage], 0.5),
+                    "p95": percentile(self._seconds[stage], 0.95),
+                    "max": max(self._seconds[stage]),
+                    "seconds": sum(self._seconds[stage]),
+                    "tokens": dict(self._tokens[stage]),
+                    "retries": self._retries[stage],
+                    "errors": self._errors[stage],
+                }
+                for stage in stages
+            }
+
+    def format_summary(self) -> str:
+        lines = [f"{'stage':>10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'tokens':>8} {'retries':>8}"]
+        for stage, stats in self.summary().items():
+            lines.append(f"{stage:>10} {stats['count']:>6} {stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} "
+                         f"{stats['max'] * 1000:>9.1f} {sum(stats['tokens'].values()):>8} {stats['retries']:>8}")
+        return "\n".join(lines)
+
+    def close(self) -> dict:
+        """Write the summary to the exporter and return it"""
+        summary = self.summary()
+        if self.exporter is not None:
+            self.exporter.close(summary)
+        return summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
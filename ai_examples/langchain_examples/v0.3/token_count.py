@@ -0,0 +1,52 @@
+import logging
+from functools import lru_cache
+
+import tiktoken
+
+logger = logging.getLogger("langchain_examples")
+
+# Encoding used for model names tiktoken does not know, such as the offline fakes
+DEFAULT_ENCODING = "cl100k_base"
+
+# tiktoken downloads its BPE files on first use, without them token counts are estimated
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Get the tiktoken encoding for a model, loaded once per process.
+
+    :param model: The model name, e.g gpt-4o-mini or text-embedding-ada-002
+    :type model: str
+    :return: The encoding or None if the BPE files are not available
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning(f"tiktoken encoding unavailable for {model}, estimating tokens: {e}")
+        return None
+
+
+def count_tokens_batch(texts: list, model: str) -> list:
+    """Count the tokens in each text, encoding the whole list in one multi-threaded tiktoken call
+
+    :param texts: The texts to count
+    :type texts: list
+    :param model: The model whose encoding is used
+    :type model: str
+    :return: The token count of each text, in the same order
+    :rtype: list
+    """
+    encoding = get_encoding(model)
+
+    if encoding is None:
+        return [len(text) // CHARS_PER_TOKEN + 1 for text in texts]
+
+    return [len(tokens) for tokens in encoding.encode_batch(texts, disallowed_special=())]
+
+
+def count_tokens(text: str, model: str) -> int:
+    return count_tokens_batch([text], model)[0]
@@ -0,0 +1,259 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from results_writer import open_results_writer
+
+# Seconds a claimed assessment stays leased to a worker, a worker that stops renewing it loses it
+LEASE_SECONDS = 300
+# Seconds between lease renewals, well inside LEASE_SECONDS so a busy worker never loses its claims
+HEARTBEAT_SECONDS = 60
+# Times an assessment is claimed before it is left failed, counting claims whose lease ran out
+MAX_ATTEMPTS = 3
+
+
+def parse_shard(shard: str) -> tuple:
+    """Parse a shard given as i/n, e.g 0/4 for the first of four shards
+
+    :param shard: The shard, i counts from 0
+    :type shard: str
+    :return: (i, n)
+    :rtype: tuple
+    """
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Expected a shard as i/n, e.g 0/4, got {shard}")
+
+    if not 0 <= index < count:
+        raise ValueError(f"Shard {shard} is out of range, i must be from 0 to n - 1")
+
+    return index, count
+
+
+def shard_paths(paths: list, index: int, count: int) -> list:
+    """The paths in shard index of count, every machine given the same paths gets a different share
+
+    :param paths: The assessment PDF paths, in any order
+    :type paths: list
+    :param index: The shard, from 0 to count - 1
+    :type index: int
+    :param count: The number of shards
+    :type count: int
+    :return: Every count-th path of the sorted paths, starting at index
+    :rtype: list
+    """
+    return sorted(paths)[index::count]
+
+
+def worker_id() -> str:
+    """Name this process in the queue, unique across the machines sharing it"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Assessments shared out between worker processes through a SQLite database on a shared filesystem.
+
+    A worker claims a few assessments at a time, each leased to it for lease_seconds and renewed by
+    its heartbeat while it works. Assessments whose worker finished them are done, those whose
+    worker died are claimed again once their lease runs out, and one claimed max_attempts times
+    without finishing is left failed.
+
+    Claims are made in an immediate transaction, so two workers never hold the same assessment.
+    SQLite's rollback journal is used rather than WAL, which needs shared memory on one machine, and
+    the filesystem must support POSIX locks.
+
+    :param queue_path: Path of the SQLite database
+    :type queue_path: str
+    :param lease_seconds: Seconds a claim lasts without a heartbeat
+    :type lease_seconds: float
+    :param max_attempts: Claims of an assessment before it is left failed
+    :type max_attempts: int
+    :param clock: Wall clock in seconds, shared by every machine, replaceable in tests
+    """
+
+    def __init__(self, queue_path: str, lease_seconds: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS,
+                 clock=time.time):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.clock = clock
+
+        os.makedirs(os.path.dirname(os.path.abspath(queue_path)), exist_ok=True)
+
+        # The connection is shared between the scoring threads and the heartbeat
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(queue_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=DELETE")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS work ("
+            "path TEXT PRIMARY KEY, status TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, error TEXT)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS work_status ON work (status, lease_until)")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            # Takes the write lock up front so a claim can not race another worker's
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def add(self, paths: list) -> int:
+        """Queue assessments, those already in the queue are left as they are so every worker can add the cohort
+
+        :param paths: The assessment PDF paths
+        :type paths: list
+        :return: The number newly queued
+        :rtype: int
+        """
+        with self._transaction() as connection:
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO work (path) VALUES (?)", [(path,) for path in paths])
+            return connection.total_changes - before
+
+    def claim(self, worker: str, limit: int) -> list:
+        """Lease up to limit pending assessments, or ones whose lease has run out, to worker
+
+        :param worker: The worker id, see worker_id
+        :type worker: str
+        :param limit: Most assessments claimed
+        :type limit: int
+        :return: The claimed paths, empty once there is nothing left to claim
+        :rtype: list
+        """
+        now = self.clock()
+
+        with self._transaction() as connection:
+            # Expired leases that have used up their attempts are given up on
+            connection.execute(
+                "UPDATE work SET status = 'failed', worker = NULL, error = 'Lease expired' "
+                "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, self.max_attempts)
+            )
+            paths = [row[0] for row in connection.execute(
+                "SELECT path FROM work WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) "
+                "ORDER BY rowid LIMIT ?", (now, limit)
+            )]
+            connection.executemany(
+                "UPDATE work SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE path = ?", [(worker, now + self.lease_seconds, path) for path in paths]
+            )
+
+        return paths
+
+    def renew(self, worker: str) -> int:
+        """Extend the leases held by worker, returns how many it holds"""
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE work SET lease_until = ? WHERE worker = ? AND status = 'leased'",
+                (self.clock() + self.lease_seconds, worker)
+            ).rowcount
+
+    def finish(self, worker: str, path: str, error: str = None):
+        """Record a claimed assessment as done, or as failed with its error
+
+        A failed assessment is queued again until it has been claimed max_attempts times.
+
+        :param worker: The worker id that claimed it
+        :type worker: str
+        :param path: The assessment PDF path
+        :type path: str
+        :param error: The error, None if the assessment was scored
+        :type error: str
+        """
+        with self._transaction() as connection:
+            if error is None:
+                # Done even if the lease had run out and another worker holds it now, its result is as good
+                connection.execute("UPDATE work SET status = 'done', worker = ?, error = NULL WHERE path = ?",
+                                   (worker, path))
+            else:
+                connection.execute(
+                    "UPDATE work SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                    "worker = NULL, lease_until = NULL, error = ? WHERE path = ? AND worker = ?",
+                    (self.max_attempts, error, path, worker)
+                )
+
+    def release(self, worker: str):
+        """Hand back every assessment worker holds without counting the claim, e.g when it is stopped"""
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE work SET status = 'pending', worker = NULL, lease_until = NULL, attempts = attempts - 1 "
+                "WHERE worker = ? AND status = 'leased'", (worker,)
+            )
+
+    def counts(self) -> dict:
+        """Number of assessments in each status, pending, leased, done and failed"""
+        with self._lock:
+            return dict(self._connection.execute("SELECT status, COUNT(*) FROM work GROUP BY status"))
+
+    @contextmanager
+    def heartbeat(self, worker: str, interval: float = HEARTBEAT_SECONDS):
+        """Renew the leases of worker every interval seconds on a background thread while the block runs
+
+        :param worker: The worker id
+        :type worker: str
+        :param interval: Seconds between renewals
+        :type interval: float
+        """
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(interval):
+                self.renew(worker)
+
+        thread = threading.Thread(target=beat, name=f"heartbeat-{worker}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def merge_results(results_paths: list, output_path: str) -> int:
+    """Merge the NDJSON results of several workers into one output, one record per assessment.
+
+    An assessment scored by more than one worker, e.g after a lease ran out, keeps its last
+    successful record, and the index of each record is its position in the sorted assessments.
+
+    :param results_paths: The workers' NDJSON results files
+    :type results_paths: list
+    :param output_path: Path of the merged file, .json for a JSON array, anything else NDJSON
+    :type output_path: str
+    :return: The number of assessments written
+    :rtype: int
+    """
+    records = {}
+    for results_path in sorted(results_paths):
+        with open(results_path, "r", encoding="utf-8") as results_file:
+            for line in results_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                previous = records.get(record["assessment"])
+                if previous is None or "error" in previous or "error" not in record:
+                    records[record["assessment"]] = record
+
+    with open_results_writer(output_path) as results_writer:
+        for index, assessment in enumerate(sorted(records)):
+            results_writer.write({**records[assessment], "index": index})
+
+    return len(records)
@@ -0,0 +1,1138 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from langchain_core.outputs import LLMResult
+
+# criteria_measure.py lives in a versioned folder that is not a package, it is run as a script
+CRITERIA_MEASURE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "ai_examples", "langchain_examples", "v0.3"
+)
+sys.path.insert(0, CRITERIA_MEASURE_DIR)
+
+import criteria_measure  # noqa: E402
+from batch_embedding import BatchedEmbeddings, call_with_retry, pack_batches  # noqa: E402
+from batch_journal import BatchAbortedError, BatchJournal  # noqa: E402
+from chunking import chunk_documents  # noqa: E402
+from context_packing import merge_overlapping_chunks, pack_context  # noqa: E402
+from criteria_registry import CriteriaRegistry, find_criteria_pdfs  # noqa: E402
+from embedding_cache import CachedEmbeddings  # noqa: E402
+import index_cache  # noqa: E402
+from index_cache import load_cached_index, save_cached_index  # noqa: E402
+from index_types import build_vector_store  # noqa: E402
+from mapped_docstore import MappedDocstore  # noqa: E402
+import pdf_cache  # noqa: E402
+from rate_limiter import ModelRateLimiter, UsageCallback  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+from retrieval import retrieve_for_sections  # noqa: E402
+from spans import STAGES, SpanRecorder, open_span_exporter, span  # noqa: E402
+from work_queue import WorkQueue, merge_results, shard_paths  # noqa: E402
+from fakes import (SYNTHETIC_EVIDENCE, SYNTHETIC_SKILLS, FakeChatModel, HashEmbeddings, canned_response,  # noqa: E402
+                   canned_skill_response, echo_batch, fake_chat_model, write_synthetic_pdf)
+
+# ---- Constant Definitions ----
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ai_examples", "langchain_examples", "data")
+CRITERIA_PDF = os.path.join(DATA_DIR, "criteria", "lead", "LeadAssessmentRequirements.pdf")
+ASSESSMENT_PDF = os.path.join(DATA_DIR, "assessment", "lead", "ChaswickJohnLeadSoftwareEngineer.pdf")
+SENIOR_ASSESSMENT_PDF = os.path.join(DATA_DIR, "assessment", "senior", "SmithMauriceSeniorSoftwareEngineer.pdf")
+SCORING_SYSTEM = {"4": "Does not meet criteria", "7": "Fully meets criteria"}
+
+
+@pytest.fixture(scope="session")
+def session_page_cache_dir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("pages"))
+
+
+@pytest.fixture(autouse=True)
+def page_cache_dir(session_page_cache_dir, monkeypatch):
+    """Keep the pages cached by the tests out of the page cache next to criteria_measure.py"""
+    monkeypatch.setattr(pdf_cache, "PAGE_CACHE_DIR", session_page_cache_dir)
+    return session_page_cache_dir
+
+
+class CountingEmbeddings(HashEmbeddings):
+    """Deterministic fake embeddings that count the texts sent to embed_documents"""
+
+    embedded_texts = 0
+
+    def embed_documents(self, texts):
+        self.embedded_texts += len(texts)
+        return super().embed_documents(texts)
+
+
+class TestEmbedCriteria:
+    def test_warm_start_makes_no_embedding_calls(self, tmp_path):
+        embeddings = CountingEmbeddings(size=8)
+
+        cold = criteria_measure.embed_criteria(CRITERIA_PDF, embeddings, cache_dir=str(tmp_path))
+        cold_calls = embeddings.embedded_texts
+
+        warm = criteria_measure.embed_criteria(CRITERIA_PDF, embeddings, cache_dir=str(tmp_path))
+
+        assert cold_calls > 0
+        assert embeddings.embedded_texts == cold_calls
+        assert warm.index.ntotal == cold.index.ntotal
+
+    def test_memory_mapped_index_is_not_unpickled(self, tmp_path, monkeypatch):
+        embeddings = CountingEmbeddings(size=8)
+        loaded = criteria_measure.embed_criteria(CRITERIA_PDF, embeddings, cache_dir=str(tmp_path))
+
+        def no_unpickling(*args, **kwargs):
+            raise AssertionError("The docstore was unpickled")
+
+        monkeypatch.setattr(index_cache.pickle, "load", no_unpickling)
+        mapped = criteria_measure.embed_criteria(CRITERIA_PDF, embeddings, cache_dir=str(tmp_path), mmap=True)
+
+        sections = ["Technical skills", "Delivery and ownership"]
+        assert isinstance(mapped.docstore, MappedDocstore)
+        assert retrieve_for_sections(mapped, sections) == retrieve_for_sections(loaded, sections)
+        assert mapped.docstore.search(str(mapped.index.ntotal)) == f"ID {mapped.index.ntotal} not found."
+
+    @pytest.mark.parametrize(
+        "chunk_size, test_id",
+        [
+            (criteria_measure.CHUNK_SIZE, "Criteria Measure: Test 1 - Same settings hit the cache"),
+            (criteria_measure.CHUNK_SIZE * 2, "Criteria Measure: Test 2 - Changed chunk size misses the cache"),
+        ],
+    )
+    def test_cache_key_tracks_settings(self, chunk_size, test_id):
+        expected = criteria_measure.index_cache_key(
+            CRITERIA_PDF, criteria_measure.CHUNK_SIZE, criteria_measure.OVERLAP, "model"
+        )
+        key = criteria_measure.index_cache_key(CRITERIA_PDF, chunk_size, criteria_measure.OVERLAP, "model")
+
+        assert (key == expected) is (chunk_size == criteria_measure.CHUNK_SIZE), test_id
+
+    def test_stale_entry_is_removed(self, tmp_path):
+        embeddings = CountingEmbeddings(size=8)
+        pdf_path = tmp_path / "criteria.pdf"
+        cache_dir = tmp_path / "cache"
+
+        with open(CRITERIA_PDF, "rb") as pdf_file:
+            pdf_bytes = pdf_file.read()
+
+        pdf_path.write_bytes(pdf_bytes)
+        criteria_measure.embed_criteria(str(pdf_path), embeddings, cache_dir=str(cache_dir))
+
+        # Appending a comment after %%EOF changes the hash but still parses as the same PDF
+        pdf_path.write_bytes(pdf_bytes + b"\n% updated\n")
+        criteria_measure.embed_criteria(str(pdf_path), embeddings, cache_dir=str(cache_dir))
+
+        assert len([entry for entry in os.listdir(cache_dir) if not entry.startswith(".")]) == 1
+
+
+class TestProcessMultipleAssessments:
+    def test_concurrent_results_match_serial_order(self):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        assessment_pdfs = [ASSESSMENT_PDF] * 5
+
+        serial = criteria_measure.process_multiple_assessments(
+            criteria_vector, assessment_pdfs, SCORING_SYSTEM, max_concurrency=1, llm=fake_chat_model()
+        )
+        concurrent = criteria_measure.process_multiple_assessments(
+            criteria_vector, assessment_pdfs, SCORING_SYSTEM, max_concurrency=4, llm=fake_chat_model()
+        )
+
+        assert concurrent == serial
+        assert serial[0].endswith(",") and not serial[-1].endswith(",")
+
+    def test_process_pool_parsing_matches_threaded_parsing(self):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        assessment_pdfs = [ASSESSMENT_PDF] * 3
+
+        threaded = criteria_measure.process_multiple_assessments(
+            criteria_vector, assessment_pdfs, SCORING_SYSTEM, max_concurrency=2, llm=fake_chat_model()
+        )
+        pooled = criteria_measure.process_multiple_assessments(
+            criteria_vector, assessment_pdfs, SCORING_SYSTEM, max_concurrency=2, llm=fake_chat_model(),
+            parse_workers=2
+        )
+
+        assert pooled == threaded
+
+    def test_assessments_are_parsed_a_bounded_window_ahead(self, tmp_path, monkeypatch):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        parse_assessments = criteria_measure.parse_assessments
+        pulled = []
+
+        def counted(*args, **kwargs):
+            for parsed_assessment in parse_assessments(*args, **kwargs):
+                pulled.append(parsed_assessment)
+                yield parsed_assessment
+
+        monkeypatch.setattr(criteria_measure, "parse_assessments", counted)
+        lookahead = []
+        criteria_measure.process_multiple_assessments(
+            criteria_vector, [ASSESSMENT_PDF] * 12, SCORING_SYSTEM, max_concurrency=2, llm=fake_chat_model(),
+            output_path=str(tmp_path / "results.ndjson"), on_result=lambda record: lookahead.append(len(pulled))
+        )
+
+        assert len(lookahead) == 12
+        # Twice max_concurrency waiting or being scored, and the next one pulled to be submitted
+        assert max(parsed - scored for scored, parsed in enumerate(lookahead)) <= 2 * 2 + 1
+
+    @pytest.mark.parametrize(
+        "file_name, test_id",
+        [
+            ("results.ndjson", "Results: Test 1 - One JSON record per line"),
+            ("results.json", "Results: Test 2 - JSON array"),
+        ],
+    )
+    def test_results_are_streamed_to_file(self, tmp_path, file_name, test_id):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        output_path = tmp_path / file_name
+
+        returned = criteria_measure.process_multiple_assessments(
+            criteria_vector, [ASSESSMENT_PDF] * 3, SCORING_SYSTEM, max_concurrency=2, llm=fake_chat_model(),
+            output_path=str(output_path)
+        )
+
+        text = output_path.read_text()
+        records = json.loads(text) if file_name.endswith(".json") else [json.loads(line) for line in text.splitlines()]
+
+        assert returned is None, test_id
+        assert sorted(record["index"] for record in records) == [0, 1, 2], test_id
+        assert all(record["skills"] and record["summary"] for record in records), test_id
+
+
+class TestBatchJournal:
+    @pytest.fixture
+    def assessment_pdfs(self, tmp_path):
+        paths = [str(tmp_path / f"assessment{i}.pdf") for i in range(3)]
+        for seed, path in enumerate(paths):
+            write_synthetic_pdf(path, pages=1, seed=seed)
+        return paths
+
+    @pytest.mark.parametrize(
+        "cached, test_id",
+        [
+            (False, "Batch Journal: Test 1 - Failed assessment is scored again"),
+            (True, "Batch Journal: Test 2 - Failed answer is not served from the response cache"),
+        ],
+    )
+    def test_resume_only_scores_unfinished_assessments(self, tmp_path, assessment_pdfs, cached, test_id):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        journal_path = str(tmp_path / "journal.ndjson")
+        # With the default settings __main__ uses
+        response_cache = ResponseCache(str(tmp_path / "responses.sqlite")) if cached else None
+
+        # The second answer is not JSON, so parse_response raises for the second assessment
+        first_llm = FakeChatModel(responses=[canned_response(), "no JSON here", canned_response()])
+        with BatchJournal(journal_path) as journal:
+            first = criteria_measure.process_multiple_assessments(
+                criteria_vector, assessment_pdfs, SCORING_SYSTEM, llm=first_llm, journal=journal,
+                response_cache=response_cache
+            )
+
+        resumed_llm = FakeChatModel(responses=[canned_response()] * 3)
+        with BatchJournal(journal_path) as journal:
+            resumed = criteria_measure.process_multiple_assessments(
+                criteria_vector, assessment_pdfs, SCORING_SYSTEM, llm=resumed_llm, journal=journal,
+                response_cache=response_cache
+            )
+
+        assert "ValueError" in json.loads(first[1].rstrip(","))[0]["error"], test_id
+        assert first[0] == resumed[0] and first[2] == resumed[2], test_id
+        assert json.loads(resumed[1].rstrip(","))[0]["skills"], test_id
+        assert resumed_llm.i == 1, test_id
+
+    def test_batch_stops_past_max_failures(self, tmp_path, assessment_pdfs):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+
+        with BatchJournal(str(tmp_path / "journal.ndjson")) as journal, pytest.raises(BatchAbortedError):
+            criteria_measure.process_multiple_assessments(
+                criteria_vector, assessment_pdfs, SCORING_SYSTEM, llm=FakeChatModel(responses=["no JSON here"]),
+                journal=journal, max_failures=1
+            )
+
+        assert len(journal.failed) == 2 and not journal.completed
+
+    def test_half_written_entry_is_dropped(self, tmp_path):
+        journal_path = tmp_path / "journal.ndjson"
+        with BatchJournal(str(journal_path)) as journal:
+            journal.record_done("done", {"skills": []})
+        with open(journal_path, "a") as journal_file:
+            journal_file.write('{"key": "cut off", "sta')
+
+        with BatchJournal(str(journal_path)) as journal:
+            journal.record_failure("failed", "assessment.pdf", "ValueError")
+
+        with BatchJournal(str(journal_path)) as journal:
+            assert journal.get("done") == {"skills": []}
+            assert journal.failed == {"failed": "ValueError"}
+
+
+class TestBatchFile:
+    def test_batch_results_are_ingested_in_request_order(self, tmp_path):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        requests_path = str(tmp_path / "requests.jsonl")
+        results_path = str(tmp_path / "results.jsonl")
+        output_path = str(tmp_path / "output.ndjson")
+        assessment_pdfs = [ASSESSMENT_PDF, SENIOR_ASSESSMENT_PDF, ASSESSMENT_PDF]
+
+        criteria_measure.write_batch_requests(criteria_vector, assessment_pdfs, SCORING_SYSTEM, requests_path,
+                                              max_concurrency=2, llm=fake_chat_model())
+        echo_batch(requests_path, results_path)
+
+        with open(requests_path) as requests_file:
+            requests = [json.loads(line) for line in requests_file]
+        with open(results_path) as results_file:
+            results = [json.loads(line) for line in results_file]
+
+        # Results come back out of order, one answer is not JSON and the last request has no result
+        results[1]["response"]["body"]["choices"][0]["message"]["content"] = "no JSON here"
+        with open(results_path, "w") as results_file:
+            results_file.writelines(json.dumps(result) + "\n" for result in reversed(results[:2]))
+
+        written, errors = criteria_measure.ingest_batch_results(requests_path, results_path, output_path)
+        with open(output_path) as output_file:
+            records = sorted((json.loads(line) for line in output_file), key=lambda record: record["index"])
+
+        assert [request["custom_id"] for request in requests] == ["assessment-0", "assessment-1", "assessment-2"]
+        assert all(request["url"] == "/v1/chat/completions" for request in requests)
+        assert "Chaswick" in requests[0]["body"]["messages"][0]["content"]
+        assert (written, errors) == (3, 2)
+        assert [record["assessment"] for record in records] == assessment_pdfs
+        assert records[0]["skills"] and records[0]["citations"] and records[0]["tokens"]
+        assert "ValueError" in records[1]["error"] and records[2]["error"] == "No result in the batch output"
+
+    def test_batch_error_file_is_ingested_after_earlier_results(self, tmp_path):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        requests_path = str(tmp_path / "requests.jsonl")
+        results_path = str(tmp_path / "results.jsonl")
+        errors_path = str(tmp_path / "errors.jsonl")
+        output_path = str(tmp_path / "output.ndjson")
+
+        criteria_measure.write_batch_requests(criteria_vector, [ASSESSMENT_PDF, SENIOR_ASSESSMENT_PDF],
+                                              SCORING_SYSTEM, requests_path, llm=fake_chat_model())
+        echo_batch(requests_path, results_path)
+        with open(results_path) as results_file:
+            results = [json.loads(line) for line in results_file]
+
+        # The first request is answered twice and a line has a custom_id the request file does not have,
+        # the second request failed and is only in the error file
+        with open(results_path, "w") as results_file:
+            results_file.writelines(json.dumps(result) + "\n"
+                                    for result in [results[0], results[0], {**results[0], "custom_id": "other-0"}])
+        with open(errors_path, "w") as errors_file:
+            errors_file.write(json.dumps({"custom_id": "assessment-1", "response": None,
+                                          "error": {"code": "batch_expired", "message": "Expired"}}) + "\n")
+        with open(output_path, "w") as output_file:
+            output_file.write(json.dumps({"index": 0, "assessment": "watched.pdf", "skills": {}}) + "\n")
+
+        written, errors = criteria_measure.ingest_batch_results(requests_path, results_path, output_path, errors_path,
+                                                                append=True)
+        with open(output_path) as output_file:
+            records = [json.loads(line) for line in output_file]
+
+        assert (written, errors) == (2, 3)
+        assert [record["assessment"] for record in records] == ["watched.pdf", ASSESSMENT_PDF, SENIOR_ASSESSMENT_PDF]
+        assert records[1]["skills"] and records[2]["error"] == "batch_expired: Expired"
+
+
+    @pytest.mark.parametrize(
+        "stray, test_id",
+        [
+            (True, "Batch File: Test 1 - Assessment outside every grade folder"),
+            (False, "Batch File: Test 2 - Assessment that is not a PDF"),
+        ],
+    )
+    def test_assessment_that_fails_to_render_is_ingested_as_an_error(self, tmp_path, stray, test_id):
+        registry = CriteriaRegistry(find_criteria_pdfs(os.path.join(DATA_DIR, "criteria")),
+                                    lambda pdf: criteria_measure.embed_criteria(pdf, CountingEmbeddings(size=8),
+                                                                                cache_dir=None))
+        if stray:
+            bad_pdf = str(tmp_path / "stray.pdf")
+            write_synthetic_pdf(bad_pdf, pages=1)
+        else:
+            bad_pdf = str(tmp_path / "assessment" / "lead" / "broken.pdf")
+            os.makedirs(os.path.dirname(bad_pdf))
+            with open(bad_pdf, "wb") as pdf_file:
+                pdf_file.write(b"not a PDF")
+        requests_path = str(tmp_path / "requests.jsonl")
+        results_path = str(tmp_path / "results.jsonl")
+        output_path = str(tmp_path / "output.ndjson")
+
+        counts = criteria_measure.write_batch_requests(registry, [ASSESSMENT_PDF, bad_pdf, SENIOR_ASSESSMENT_PDF],
+                                                       SCORING_SYSTEM, requests_path, max_concurrency=2,
+                                                       llm=fake_chat_model())
+        echo_batch(requests_path, results_path)
+        written, errors = criteria_measure.ingest_batch_results(requests_path, results_path, output_path)
+        with open(output_path) as output_file:
+            records = sorted((json.loads(line) for line in output_file), key=lambda record: record["index"])
+
+        assert counts == (2, 1), test_id
+        assert (written, errors) == (3, 1), test_id
+        assert records[0]["skills"] and records[2]["skills"], test_id
+        assert records[1]["assessment"] == bad_pdf, test_id
+        expected = "ValueError: No grade folder" if stray else "PdfStreamError"
+        assert records[1]["error"].startswith(expected), test_id
+
+
+class TestSkillScorer:
+    def test_skills_are_scored_separately_and_summarised_locally(self):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        assessment_docs = criteria_measure.process_assessment(ASSESSMENT_PDF)
+        whole = criteria_measure.AssessmentScorer(criteria_vector, SCORING_SYSTEM, fake_chat_model()).score(
+            assessment_docs)
+
+        # The second skill's answer is not JSON
+        llm = FakeChatModel(responses=[canned_skill_response(4), "no JSON here", canned_skill_response(6),
+                                       canned_skill_response(7), canned_skill_response(4)])
+        scorer = criteria_measure.SkillScorer(criteria_vector, SCORING_SYSTEM, llm, max_concurrency=1)
+        result = scorer.score(assessment_docs)
+        response = criteria_measure.parse_response(result)
+        skills = scorer.skills()
+
+        assert list(response["skills"]) == skills
+        assert "error" in response["skills"][skills[1]]
+        scored = (skills[0], skills[2], skills[3])
+        assert [response["skills"][skill]["moderated_score"] for skill in scored] == [4, 6, 7]
+        assert response["summary"] == {"overall_score": 5.67, "score_calculation": "(4+6+7)/3 = 5.67",
+                                       "unscored_skills": [skills[1]]}
+        assert llm.i == 4
+        # Each call only carries the chunks under its skill's heading
+        assert all(report["assessment_before"] < whole["tokens"]["assessment_before"]
+                   for report in result["tokens"].values())
+
+    def test_assessment_with_an_unscored_skill_is_journalled_as_failed(self, tmp_path):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        llm = FakeChatModel(responses=[canned_skill_response(4), "no JSON here", canned_skill_response(6),
+                                       canned_skill_response(7), canned_skill_response(4)])
+        output_path = str(tmp_path / "results.ndjson")
+        journal_path = str(tmp_path / "journal.ndjson")
+        response_cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+
+        with BatchJournal(journal_path) as journal:
+            criteria_measure.process_multiple_assessments(criteria_vector, [ASSESSMENT_PDF], SCORING_SYSTEM, llm=llm,
+                                                          output_path=output_path, journal=journal, per_skill=True,
+                                                          response_cache=response_cache)
+            completed, failed = dict(journal.completed), list(journal.failed.values())
+
+        with open(output_path) as output_file:
+            [record] = [json.loads(line) for line in output_file]
+
+        # The scored skills are written, but the assessment is scored again when the batch is resumed
+        assert record["error"].startswith("Skills not scored: ")
+        assert len(record["summary"]["unscored_skills"]) == 1
+        assert completed == {} and len(failed) == 1
+
+        # Only the unscored skill is sent to the model again, the others come from the response cache
+        resumed_llm = FakeChatModel(responses=[canned_skill_response(5)] * 2)
+        with BatchJournal(journal_path) as journal:
+            criteria_measure.process_multiple_assessments(criteria_vector, [ASSESSMENT_PDF], SCORING_SYSTEM,
+                                                          llm=resumed_llm, output_path=output_path, journal=journal,
+                                                          append=True, per_skill=True, response_cache=response_cache)
+            assert len(journal.completed) == 1
+
+        with open(output_path) as output_file:
+            resumed = [json.loads(line) for line in output_file][-1]
+
+        assert "error" not in resumed and "unscored_skills" not in resumed["summary"]
+        assert resumed_llm.i == 1
+
+
+class TestCriteriaRegistry:
+    def test_least_recently_used_index_is_evicted(self):
+        registry = CriteriaRegistry({"lead": "lead.pdf", "senior": "senior.pdf", "principal": "principal.pdf"},
+                                    lambda pdf: f"index of {pdf}", max_resident=2)
+
+        assert registry.get("lead") == "index of lead.pdf"
+        registry.get("senior")
+        registry.get("lead")
+        registry.get("principal")
+
+        assert registry.resident == ["lead", "principal"]
+        assert registry.loads == 3
+
+        registry.get("senior")
+
+        assert registry.resident == ["principal", "senior"]
+        assert registry.loads == 4
+
+    def test_mixed_grades_are_scored_against_their_own_criteria(self):
+        criteria_pdfs = find_criteria_pdfs(os.path.join(DATA_DIR, "criteria"))
+        loaded = []
+
+        def load_index(criteria_pdf):
+            loaded.append(criteria_pdf)
+            return criteria_measure.embed_criteria(criteria_pdf, CountingEmbeddings(size=8), cache_dir=None)
+
+        registry = CriteriaRegistry(criteria_pdfs, load_index, max_resident=1)
+        results = criteria_measure.process_multiple_assessments(
+            registry, [ASSESSMENT_PDF, SENIOR_ASSESSMENT_PDF, SENIOR_ASSESSMENT_PDF], SCORING_SYSTEM,
+            llm=fake_chat_model()
+        )
+
+        assert sorted(criteria_pdfs) == ["lead", "senior"]
+        assert registry.grade_for(SENIOR_ASSESSMENT_PDF) == "senior"
+        assert loaded == [criteria_pdfs["lead"], criteria_pdfs["senior"]]
+        assert len(results) == 3 and all(json.loads(result.rstrip(","))[0]["skills"] for result in results)
+
+
+    def test_assessment_outside_every_grade_folder_fails_alone(self, tmp_path):
+        registry = CriteriaRegistry(find_criteria_pdfs(os.path.join(DATA_DIR, "criteria")),
+                                    lambda pdf: criteria_measure.embed_criteria(pdf, CountingEmbeddings(size=8),
+                                                                                cache_dir=None))
+        stray_pdf = str(tmp_path / "stray.pdf")
+        write_synthetic_pdf(stray_pdf, pages=1)
+        output_path = str(tmp_path / "results.ndjson")
+
+        with BatchJournal(str(tmp_path / "journal.ndjson")) as journal:
+            criteria_measure.process_multiple_assessments(registry, [stray_pdf, ASSESSMENT_PDF], SCORING_SYSTEM,
+                                                          llm=fake_chat_model(), output_path=output_path,
+                                                          journal=journal)
+            failed = list(journal.failed.values())
+
+        with open(output_path) as output_file:
+            records = sorted((json.loads(line) for line in output_file), key=lambda record: record["index"])
+
+        assert records[0]["error"].startswith("ValueError: No grade folder")
+        assert records[1]["skills"]
+        assert len(failed) == 1
+
+    def test_grades_share_one_parse_and_embedding(self, monkeypatch):
+        embeddings = CountingEmbeddings(size=8)
+        registry = CriteriaRegistry(find_criteria_pdfs(os.path.join(DATA_DIR, "criteria")),
+                                    lambda pdf: criteria_measure.embed_criteria(pdf, embeddings, cache_dir=None))
+        for grade in registry.grades:
+            registry.get(grade)
+        criteria_texts = embeddings.embedded_texts
+
+        parsed = []
+        process_assessment = criteria_measure.process_assessment
+        monkeypatch.setattr(criteria_measure, "process_assessment",
+                            lambda path: parsed.append(path) or process_assessment(path))
+
+        llm = FakeChatModel(responses=[canned_response()] * 3)
+        records = criteria_measure.process_multiple_grades(registry, [ASSESSMENT_PDF], SCORING_SYSTEM, llm=llm)
+
+        assert parsed == [ASSESSMENT_PDF]
+        assert embeddings.embedded_texts - criteria_texts == len(process_assessment(ASSESSMENT_PDF))
+        assert list(records[0]["grades"]) == ["lead", "senior"]
+        assert all(result["skills"] for result in records[0]["grades"].values())
+        assert llm.i == 2
+
+
+class TestWatchAssessments:
+    def test_only_new_and_changed_pdfs_are_scored(self, tmp_path):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        folder = tmp_path / "assessments"
+        folder.mkdir()
+        output_path = str(tmp_path / "results.ndjson")
+
+        def add_pdf(name, seed, age=60):
+            path = str(folder / name)
+            write_synthetic_pdf(path, pages=1, seed=seed)
+            os.utime(path, (time.time() - age, time.time() - age))
+            return path
+
+        add_pdf("first.pdf", seed=0)
+        add_pdf("second.pdf", seed=1)
+
+        def between_scans(seconds):
+            # Rewritten with the same content, a new PDF, and one still being copied
+            add_pdf("first.pdf", seed=0, age=30)
+            add_pdf("third.pdf", seed=2)
+            add_pdf("copying.pdf", seed=3, age=0)
+
+        llm = FakeChatModel(responses=[canned_response()] * 5)
+        with BatchJournal(str(tmp_path / "journal.ndjson")) as journal:
+            criteria_measure.watch_assessments(criteria_vector, str(folder), SCORING_SYSTEM, journal, output_path,
+                                               llm=llm, max_scans=2, sleep=between_scans)
+
+        with open(output_path) as output_file:
+            records = [json.loads(line) for line in output_file]
+
+        assert [os.path.basename(record["assessment"]) for record in records] == ["first.pdf", "second.pdf",
+                                                                                   "third.pdf"]
+        assert llm.i == 3
+
+
+class TestWorkQueue:
+    def test_expired_lease_is_claimed_again_until_attempts_run_out(self, tmp_path):
+        now = [0.0]
+        with WorkQueue(str(tmp_path / "queue.db"), lease_seconds=10, max_attempts=2, clock=lambda: now[0]) as queue:
+            assert queue.add(["a.pdf", "b.pdf"]) == 2
+            assert queue.add(["a.pdf"]) == 0
+
+            assert queue.claim("one", 1) == ["a.pdf"]
+            assert queue.claim("two", 5) == ["b.pdf"]
+            queue.finish("two", "b.pdf")
+
+            # Worker one dies, its lease runs out and worker two takes a.pdf over
+            now[0] = 11
+            assert queue.claim("two", 5) == ["a.pdf"]
+
+            now[0] = 22
+            assert queue.claim("two", 5) == []
+            assert queue.counts() == {"done": 1, "failed": 1}
+
+    def test_workers_share_the_queue_without_duplicates(self, tmp_path):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        paths = []
+        for seed in range(6):
+            paths.append(str(tmp_path / f"assessment-{seed}.pdf"))
+            write_synthetic_pdf(paths[-1], pages=1, seed=seed)
+        queue_path = str(tmp_path / "queue.db")
+        with WorkQueue(queue_path) as queue:
+            queue.add(paths)
+
+        llm = FakeChatModel(responses=[canned_response()] * 7)
+
+        def work(worker):
+            with WorkQueue(queue_path) as queue, BatchJournal(str(tmp_path / f"journal-{worker}.ndjson")) as journal:
+                criteria_measure.process_queue(criteria_vector, queue, SCORING_SYSTEM, worker,
+                                               str(tmp_path / f"results-{worker}.ndjson"), journal, batch_size=1,
+                                               llm=llm)
+
+        workers = [threading.Thread(target=work, args=(worker,)) for worker in ("one", "two")]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        merged = merge_results([str(tmp_path / f"results-{worker}.ndjson") for worker in ("one", "two")],
+                               str(tmp_path / "results.json"))
+        with open(tmp_path / "results.json") as results_file:
+            records = json.load(results_file)
+
+        assert merged == 6
+        assert [record["assessment"] for record in records] == sorted(paths)
+        assert all(record["skills"] for record in records)
+        with WorkQueue(queue_path) as queue:
+            assert queue.counts() == {"done": 6}
+        # Each assessment was scored by one worker only
+        scored = [line for worker in ("one", "two") for line in open(tmp_path / f"results-{worker}.ndjson")]
+        assert len(scored) == 6
+
+    def test_failed_assessments_are_counted_apart_from_scored_ones(self, tmp_path):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        broken_pdf = str(tmp_path / "broken.pdf")
+        with open(broken_pdf, "wb") as pdf_file:
+            pdf_file.write(b"not a PDF")
+
+        with WorkQueue(str(tmp_path / "queue.db")) as queue, \
+                BatchJournal(str(tmp_path / "journal.ndjson")) as journal:
+            queue.add([ASSESSMENT_PDF, broken_pdf])
+            counts = criteria_measure.process_queue(criteria_vector, queue, SCORING_SYSTEM, "one",
+                                                    str(tmp_path / "results.ndjson"), journal, llm=fake_chat_model())
+
+            # The broken PDF is claimed again until it has used up its attempts, and counted once
+            assert counts == (1, 1)
+            assert len(journal.completed) == 1 and len(journal.failed) == 1
+            assert queue.counts() == {"done": 1, "failed": 1}
+
+    def test_queue_retry_is_not_served_the_failed_answer(self, tmp_path):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        llm = FakeChatModel(responses=["no JSON here", canned_response(), canned_response()])
+
+        with WorkQueue(str(tmp_path / "queue.db")) as queue, \
+                BatchJournal(str(tmp_path / "journal.ndjson")) as journal:
+            queue.add([ASSESSMENT_PDF])
+            counts = criteria_measure.process_queue(criteria_vector, queue, SCORING_SYSTEM, "one",
+                                                    str(tmp_path / "results.ndjson"), journal, llm=llm,
+                                                    response_cache=ResponseCache(str(tmp_path / "responses.sqlite")))
+
+            # The first attempt fails and the retry asks the model again
+            assert counts == (1, 0)
+            assert queue.counts() == {"done": 1}
+            assert llm.i == 2
+
+    def test_shards_cover_every_assessment_once(self):
+        paths = [f"{name}.pdf" for name in "fbdeca"]
+        shards = [shard_paths(paths, index, 4) for index in range(4)]
+
+        assert sorted(path for shard in shards for path in shard) == sorted(paths)
+        assert shards[0] == ["a.pdf", "e.pdf"]
+
+
+class TestSpans:
+    @pytest.mark.parametrize(
+        "parse_workers, test_id",
+        [
+            (None, "Spans: Test 1 - Assessments parsed on the scoring threads"),
+            (2, "Spans: Test 2 - Spans sent back from the parsing processes"),
+        ],
+    )
+    def test_every_stage_is_traced(self, tmp_path, parse_workers, test_id):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        spans_path = tmp_path / "spans.jsonl"
+
+        with SpanRecorder(open_span_exporter(str(spans_path))) as recorder:
+            criteria_measure.process_multiple_assessments(
+                criteria_vector, [ASSESSMENT_PDF] * 3, SCORING_SYSTEM, max_concurrency=2, llm=fake_chat_model(),
+                parse_workers=parse_workers, recorder=recorder
+            )
+
+        records = [json.loads(line) for line in spans_path.read_text().splitlines()]
+        summary = records[-1]["summary"]
+
+        assert all(summary[stage]["count"] == 3 for stage in ("assessment",) + STAGES), test_id
+        assert summary["generate"]["tokens"]["prompt"] > 0 and summary["generate"]["tokens"]["completion"] > 0
+        assert summary["assessment"]["p50"] <= summary["assessment"]["p95"] <= summary["assessment"]["max"]
+        assert {record["assessment"] for record in records[:-1]} == {ASSESSMENT_PDF}, test_id
+
+    def test_retries_are_counted_and_exported_to_prometheus(self, tmp_path):
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        outcomes = [openai.APITimeoutError(request=request), "answer"]
+
+        def flaky():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        prom_path = tmp_path / "spans.prom"
+        with SpanRecorder(open_span_exporter(str(prom_path))) as recorder:
+            with recorder.assessment(ASSESSMENT_PDF), span("generate"):
+                call_with_retry(flaky, sleep=lambda seconds: None)
+
+        metrics = prom_path.read_text()
+
+        assert 'criteria_measure_stage_retries_total{stage="generate"} 1' in metrics
+        assert 'criteria_measure_stage_seconds_count{stage="assessment"} 1' in metrics
+        assert 'criteria_measure_stage_seconds{stage="generate",quantile="0.95"}' in metrics
+
+
+class TestCachedEmbeddings:
+    def test_repeat_texts_are_served_from_cache(self, tmp_path):
+        cache_path = str(tmp_path / "embeddings.sqlite")
+        texts = ["programming and build", "service support", "programming and build"]
+
+        first_run = CountingEmbeddings(size=8)
+        first = CachedEmbeddings(first_run, cache_path).embed_documents(texts)
+
+        second_run = CountingEmbeddings(size=8)
+        second = CachedEmbeddings(second_run, cache_path).embed_documents(texts)
+
+        assert first_run.embedded_texts == 2
+        assert second_run.embedded_texts == 0
+        for first_vector, second_vector in zip(first, second):
+            assert second_vector == pytest.approx(first_vector, rel=1e-6)
+
+    def test_least_recently_used_vectors_are_evicted(self, tmp_path):
+        embeddings = CachedEmbeddings(CountingEmbeddings(size=8), str(tmp_path / "embeddings.sqlite"), max_entries=2)
+
+        embeddings.embed_documents(["one", "two"])
+        embeddings.embed_query("one")
+        embeddings.embed_documents(["three"])
+        embeddings.embed_documents(["one", "two"])
+
+        assert embeddings.embeddings.embedded_texts == 4
+
+
+class TestBatchedEmbeddings:
+    @pytest.mark.parametrize(
+        "token_counts, expected_batches, test_id",
+        [
+            ([10, 10, 10], [range(0, 2), range(2, 3)], "Batching: Test 1 - Batches split at the token limit"),
+            ([30, 5], [range(0, 1), range(1, 2)], "Batching: Test 2 - Oversized text gets its own batch"),
+            ([], [], "Batching: Test 3 - No texts, no batches"),
+        ],
+    )
+    def test_pack_batches(self, token_counts, expected_batches, test_id):
+        assert pack_batches(token_counts, max_batch_tokens=20) == expected_batches, test_id
+
+    def test_vectors_are_merged_in_order(self):
+        texts = [f"criteria chunk {i}" for i in range(50)]
+        embeddings = CountingEmbeddings(size=8)
+
+        batched = BatchedEmbeddings(embeddings, max_batch_tokens=20, max_concurrency=4).embed_documents(texts)
+
+        assert batched == embeddings.embed_documents(texts)
+
+    def test_retry_waits_for_server_hint(self):
+        request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+        rate_limited = openai.RateLimitError(
+            "rate limited", response=httpx.Response(429, headers={"retry-after": "3"}, request=request), body=None
+        )
+        outcomes = [rate_limited, ["vector"]]
+        waits = []
+
+        def flaky():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        assert call_with_retry(flaky, sleep=waits.append) == ["vector"]
+        assert len(waits) == 1 and 3 <= waits[0] <= 4
+
+
+class FakeClock:
+    """Monotonic clock that only moves when sleep is called"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimiter:
+    def test_requests_wait_for_the_bucket_to_refill(self):
+        clock = FakeClock()
+        limiter = ModelRateLimiter(rpm=2, tpm=1_000_000, clock=clock, sleep=clock.sleep)
+
+        for _ in range(3):
+            limiter.acquire(10)
+
+        assert clock.sleeps == [pytest.approx(30.0)]
+
+    def test_usage_reconciles_the_estimate(self):
+        clock = FakeClock()
+        limiter = ModelRateLimiter(rpm=1_000, tpm=1_000, clock=clock, sleep=clock.sleep)
+
+        charged = limiter.acquire(1_000)
+        limiter.reconcile(charged, 200)
+        limiter.acquire(800)
+        assert clock.sleeps == []
+
+        limiter.acquire(100)
+        assert sum(clock.sleeps) == pytest.approx(6.0)
+
+    def test_usage_is_read_from_the_response(self):
+        usage = UsageCallback()
+        response = LLMResult(generations=[[]], llm_output={"token_usage": {"total_tokens": 1234}})
+
+        usage.on_llm_end(response)
+
+        assert usage.total_tokens == 1234
+
+
+class TestLoadPrompt:
+    def test_prompt_is_recompiled_only_when_files_change(self, tmp_path):
+        template_file = tmp_path / "prompt.txt"
+        template_file.write_text("Criteria: {context} Scoring: {scoring_system} Assessment: {input}")
+
+        first = criteria_measure.load_prompt(str(template_file), None)
+        unchanged = criteria_measure.load_prompt(str(template_file), None)
+
+        stat = os.stat(template_file)
+        os.utime(template_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        changed = criteria_measure.load_prompt(str(template_file), None)
+
+        assert unchanged is first
+        assert changed is not first
+
+
+class TestPdfPageCache:
+    def test_unchanged_pdf_is_not_parsed_again(self, tmp_path, monkeypatch):
+        parsed = pdf_cache.load_pdf_pages(ASSESSMENT_PDF, str(tmp_path))
+
+        def fail_to_parse(pdf_path):
+            pytest.fail(f"{pdf_path} was parsed again")
+
+        monkeypatch.setattr(pdf_cache, "PyPDFLoader", fail_to_parse)
+        cached = pdf_cache.load_pdf_pages(ASSESSMENT_PDF, str(tmp_path))
+
+        assert [page.page_content for page in cached] == [page.page_content for page in parsed]
+        assert [page.metadata for page in cached] == [page.metadata for page in parsed]
+
+    def test_pdf_read_in_part_is_cached_in_the_background(self, tmp_path):
+        pages = pdf_cache.iter_pdf_pages(CRITERIA_PDF, str(tmp_path))
+        next(pages)
+        pages.close()
+        pdf_cache.wait_for_page_cache()
+
+        assert os.listdir(tmp_path) == [os.path.basename(pdf_cache.page_cache_path(str(tmp_path), CRITERIA_PDF))]
+        cached = pdf_cache.load_pdf_pages(CRITERIA_PDF, str(tmp_path))
+        parsed = pdf_cache.load_pdf_pages(CRITERIA_PDF, cache_dir=None)
+        assert [page.page_content for page in cached] == [page.page_content for page in parsed]
+
+
+    def test_least_recently_used_entries_are_evicted(self, tmp_path):
+        pdf_paths = [str(tmp_path / f"assessment{seed}.pdf") for seed in range(3)]
+        for seed, pdf_path in enumerate(pdf_paths):
+            write_synthetic_pdf(pdf_path, pages=2, seed=seed)
+        cache_dir = str(tmp_path / "pages")
+
+        for age, pdf_path in zip((30, 20, 10), pdf_paths):
+            pdf_cache.load_pdf_pages(pdf_path, cache_dir)
+            entry_path = pdf_cache.page_cache_path(cache_dir, pdf_path)
+            os.utime(entry_path, (time.time() - age, time.time() - age))
+        # Reading the oldest entry makes it the most recently used
+        pdf_cache.load_pdf_pages(pdf_paths[0], cache_dir)
+
+        kept = [os.path.getsize(pdf_cache.page_cache_path(cache_dir, pdf_path)) for pdf_path in pdf_paths[::2]]
+        assert pdf_cache.evict_page_cache(cache_dir, max_bytes=sum(kept)) == 1
+        assert not os.path.exists(pdf_cache.page_cache_path(cache_dir, pdf_paths[1]))
+
+    def test_default_cache_dir_is_read_when_loading(self, page_cache_dir):
+        pdf_cache.load_pdf_pages(ASSESSMENT_PDF)
+
+        assert os.path.exists(pdf_cache.page_cache_path(page_cache_dir, ASSESSMENT_PDF))
+
+
+class TestProcessAssessment:
+    def test_large_pdf_is_read_only_up_to_the_token_limit(self, tmp_path, monkeypatch):
+        pdf_path = str(tmp_path / "portfolio.pdf")
+        write_synthetic_pdf(pdf_path, pages=60)
+        pages_read = []
+
+        def counted(*args, **kwargs):
+            for page in pdf_cache.iter_pdf_pages(*args, **kwargs):
+                pages_read.append(page)
+                yield page
+
+        monkeypatch.setattr(criteria_measure, "iter_pdf_pages", counted)
+        assessment_docs = criteria_measure.process_assessment(pdf_path, token_limit=2000)
+        assert 0 < len(pages_read) < 60
+
+        all_docs = chunk_documents(pdf_cache.load_pdf_pages(pdf_path, cache_dir=None), criteria_measure.MODEL_NAME,
+                                   criteria_measure.CHUNK_SIZE)
+
+        texts = [doc.page_content for doc in assessment_docs]
+        assert texts == [doc.page_content for doc in all_docs[:len(texts)]]
+        assert sum(criteria_measure.count_tokens(text, criteria_measure.MODEL_NAME) for text in texts) > 2000
+        assert sum(criteria_measure.count_tokens(text, criteria_measure.MODEL_NAME) for text in texts[:-1]) <= 2000
+
+
+    def test_each_skill_keeps_a_budget_of_its_own(self, monkeypatch):
+        evidence = "\n".join(f"• {SYNTHETIC_EVIDENCE} ({line})" for line in range(30))
+        pages = [Document(page_content=f"Service Support\n{evidence}", metadata={"page": page}) for page in range(20)]
+        pages.append(Document(page_content=f"Functional & Non-Functional Testing\n{evidence}", metadata={"page": 20}))
+        monkeypatch.setattr(criteria_measure, "iter_pdf_pages", lambda pdf_path: iter(pages))
+
+        def section_tokens(assessment_docs):
+            tokens = {}
+            for doc in assessment_docs:
+                tokens[doc.metadata["section"]] = (tokens.get(doc.metadata["section"], 0)
+                                                   + criteria_measure.count_tokens(doc.page_content,
+                                                                                   criteria_measure.MODEL_NAME))
+            return tokens
+
+        whole_document = section_tokens(criteria_measure.process_assessment("portfolio.pdf", token_limit=2000))
+        per_skill = section_tokens(criteria_measure.process_assessment("portfolio.pdf", token_limit=2000,
+                                                                       skills=SYNTHETIC_SKILLS))
+
+        # The skill on the last page is cut off by one budget for the whole document, but has its own budget
+        assert list(whole_document) == ["Service Support"]
+        assert list(per_skill) == ["Service Support", "Functional & Non-Functional Testing"]
+        assert per_skill["Service Support"] == whole_document["Service Support"]
+
+    def test_pdf_over_the_token_limit_is_cached_after_one_call(self, tmp_path, monkeypatch):
+        pdf_path = str(tmp_path / "portfolio.pdf")
+        # A seed of its own, the other tests' PDFs may already be in the session's page cache
+        write_synthetic_pdf(pdf_path, pages=60, seed=18)
+        parses = []
+
+        class CountingLoader(pdf_cache.PyPDFLoader):
+            def lazy_load(self):
+                parses.append(self.file_path)
+                yield from super().lazy_load()
+
+        monkeypatch.setattr(pdf_cache, "PyPDFLoader", CountingLoader)
+        first = criteria_measure.process_assessment(pdf_path, token_limit=2000)
+        pdf_cache.wait_for_page_cache()
+        second = criteria_measure.process_assessment(pdf_path, token_limit=2000)
+        criteria_measure.process_assessment(pdf_path)
+
+        # The part read by the first call, then the whole file read into the cache in the background
+        assert parses == [pdf_path, pdf_path]
+        assert len(pdf_cache.load_pdf_pages(pdf_path)) == 60
+        assert [doc.page_content for doc in second] == [doc.page_content for doc in first]
+
+
+class TestChunkDocuments:
+    def test_chunks_follow_skill_headings(self):
+        pages = pdf_cache.load_pdf_pages(CRITERIA_PDF, cache_dir=None)
+        chunks = chunk_documents(pages, criteria_measure.MODEL_NAME, chunk_tokens=300)
+        character_chunks = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100).split_documents(pages)
+
+        assert len(chunks) < len(character_chunks)
+        assert all(chunk.page_content.startswith(chunk.metadata["section"]) for chunk in chunks)
+        assert {chunk.metadata["section"] for chunk in chunks} >= {
+            "Programming and Build.", "Service Support", "Communication between technical and non-technical"
+        }
+        # The table of contents only repeats the headings
+        assert not any("...." in chunk.page_content for chunk in chunks)
+
+    @pytest.mark.parametrize(
+        "chunk_tokens, test_id",
+        [
+            (40, "Chunk Documents: Test 1 - Long sections are split between lines"),
+            (1000, "Chunk Documents: Test 2 - Levels of a skill are joined up to the budget"),
+        ],
+    )
+    def test_chunks_fit_the_budget(self, chunk_tokens, test_id):
+        lines = ["DDaT pay framework", "", "Service Support", "You can maintain and support services.",
+                 "Developing (4)"]
+        lines += [f"• Bullet {i} of the developing level description." for i in range(12)]
+        lines += ["Accomplished (7)", "• The accomplished level description.", "", "Service Design",
+                  "Designs services."]
+        pages = [Document(page_content="\n".join(lines), metadata={"page": 0})]
+
+        chunks = chunk_documents(pages, criteria_measure.MODEL_NAME, chunk_tokens=chunk_tokens)
+        counts = [criteria_measure.count_tokens(chunk.page_content, criteria_measure.MODEL_NAME) for chunk in chunks]
+
+        assert [chunk.metadata["section"] for chunk in chunks][-1] == "Service Design", test_id
+        assert all(chunk.page_content.startswith(chunk.metadata["section"]) for chunk in chunks), test_id
+        if chunk_tokens < 1000:
+            assert len(chunks) > 3 and max(counts) <= chunk_tokens + 1, test_id
+        else:
+            assert [chunk.metadata["section"] for chunk in chunks] == ["DDaT pay framework", "Service Support",
+                                                                  "Service Design"], test_id
+
+
+class TestContextPacking:
+    def test_overlap_is_sent_once(self):
+        text = " ".join(f"Programming and Build evidence {i}." for i in range(40))
+        docs = RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=50).create_documents([text])
+
+        merged = "".join(merge_overlapping_chunks([doc.page_content for doc in docs], 50))
+
+        assert merged == text.strip()
+
+    @pytest.mark.parametrize(
+        "token_budget, truncated, test_id",
+        [
+            (100_000, False, "Packing: Test 1 - Everything fits"),
+            (1_000, True, "Packing: Test 2 - Assessment truncated to the budget"),
+        ],
+    )
+    def test_context_fits_budget(self, token_budget, truncated, test_id):
+        assessment_texts = [doc.page_content for doc in criteria_measure.process_assessment(ASSESSMENT_PDF)]
+        criteria_docs = criteria_measure.process_assessment(CRITERIA_PDF)[:4]
+
+        packed = pack_context(assessment_texts, criteria_docs, criteria_measure.MODEL_NAME, token_budget, 0.4, 200)
+        report = packed["report"]
+
+        assert report["overhead"] + report["assessment_after"] + report["criteria_after"] <= token_budget, test_id
+        assert report["assessment_truncated"] is truncated, test_id
+        if truncated:
+            assert report["saved"] > 0, test_id
+        else:
+            assert report["criteria_dropped"] == 0 and len(packed["criteria_docs"]) == 4, test_id
+
+
+class TestRetrieveForSections:
+    @pytest.mark.parametrize(
+        "mmr, test_id",
+        [
+            (False, "Retrieval: Test 1 - Merged by best distance"),
+            (True, "Retrieval: Test 2 - Merged by MMR"),
+        ],
+    )
+    def test_sections_are_searched_together(self, mmr, test_id):
+        embeddings = CountingEmbeddings(size=8)
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, embeddings, cache_dir=None)
+        sections = [doc.page_content for doc in criteria_measure.process_assessment(ASSESSMENT_PDF)]
+
+        embeddings.embedded_texts = 0
+        docs = retrieve_for_sections(criteria_vector, sections, k=4, max_docs=6, mmr=mmr)
+
+        assert embeddings.embedded_texts == len(sections), test_id
+        assert len(docs) == 6, test_id
+        assert len({doc.page_content for doc in docs}) == len(docs), test_id
+
+    def test_every_section_contributes_its_closest_criteria(self):
+        embeddings = CountingEmbeddings(size=8)
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, embeddings, cache_dir=None)
+        sections = [doc.page_content for doc in criteria_measure.process_assessment(ASSESSMENT_PDF)]
+
+        retrieved = {doc.page_content for doc in retrieve_for_sections(criteria_vector, sections, max_docs=100)}
+
+        for section in sections:
+            closest = criteria_vector.similarity_search_by_vector(embeddings.embed_query(section), k=1)[0]
+            assert closest.page_content in retrieved
+
+
+class TestResponseCache:
+    @pytest.mark.parametrize(
+        "temperature, cache_sampled, expected_calls, test_id",
+        [
+            (0.7, True, 1, "Response Cache: Test 1 - Repeat prompt served from cache"),
+            (0.7, False, 2, "Response Cache: Test 2 - Sampled answers not cached when opted out"),
+            (0, False, 1, "Response Cache: Test 3 - Deterministic answers always cached"),
+        ],
+    )
+    def test_repeat_assessment_is_not_sent_again(self, tmp_path, temperature, cache_sampled, expected_calls,
+                                                 test_id):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        assessment_docs = criteria_measure.process_assessment(ASSESSMENT_PDF)
+        response_cache = ResponseCache(str(tmp_path / "responses.sqlite"), cache_sampled=cache_sampled)
+        llm = fake_chat_model(temperature=temperature)
+
+        first = criteria_measure.AssessmentScorer(criteria_vector, SCORING_SYSTEM, llm,
+                                                  response_cache=response_cache).score(assessment_docs)
+        second = criteria_measure.AssessmentScorer(criteria_vector, SCORING_SYSTEM, llm,
+                                                   response_cache=response_cache).score(assessment_docs)
+
+        assert second["answer"] == first["answer"], test_id
+        assert [first["cached"], second["cached"]].count(False) == expected_calls, test_id
+
+    def test_answer_that_does_not_parse_is_not_cached(self, tmp_path):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        assessment_docs = criteria_measure.process_assessment(ASSESSMENT_PDF)
+        response_cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+        llm = FakeChatModel(responses=["no JSON here", canned_response(), canned_response()])
+        scorer = criteria_measure.AssessmentScorer(criteria_vector, SCORING_SYSTEM, llm, response_cache=response_cache)
+
+        bad = scorer.score(assessment_docs)
+        with pytest.raises(ValueError):
+            criteria_measure.parse_response(bad)
+
+        # The bad answer was not kept, so the model is asked again
+        good = scorer.score(assessment_docs)
+        assert not good["cached"] and criteria_measure.parse_response(good)["skills"]
+        assert scorer.score(assessment_docs)["cached"]
+        assert llm.i == 2
+
+    def test_bad_answer_already_in_the_cache_is_asked_again(self, tmp_path, monkeypatch):
+        criteria_vector = criteria_measure.embed_criteria(CRITERIA_PDF, CountingEmbeddings(size=8), cache_dir=None)
+        assessment_docs = criteria_measure.process_assessment(ASSESSMENT_PDF)
+        response_cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+
+        # Cached the way answers were before they were checked
+        with monkeypatch.context() as patch:
+            patch.setattr(criteria_measure, "is_json_object_answer", lambda answer: True)
+            bad_llm = FakeChatModel(responses=["no JSON here"] * 2)
+            criteria_measure.AssessmentScorer(criteria_vector, SCORING_SYSTEM, bad_llm,
+                                              response_cache=response_cache).score(assessment_docs)
+
+        result = criteria_measure.AssessmentScorer(criteria_vector, SCORING_SYSTEM, fake_chat_model(),
+                                                   response_cache=response_cache).score(assessment_docs)
+
+        assert not result["cached"] and criteria_measure.parse_response(result)["skills"]
+
+    def test_expired_answer_is_not_returned(self, tmp_path):
+        response_cache = ResponseCache(str(tmp_path / "responses.sqlite"), ttl=-1)
+        response_cache.put("key", "answer")
+
+        assert response_cache.get("key") is None
+
+
+class TestIndexTypes:
+    @pytest.mark.parametrize(
+        "index_type, reduce_dim, test_id",
+        [
+            ("ivf", None, "Index Types: Test 1 - IVF index saved and memory mapped"),
+            ("ivfpq", 16, "Index Types: Test 2 - PCA reduced IVF-PQ index saved and memory mapped"),
+        ],
+    )
+    def test_compact_index_round_trip(self, tmp_path, index_type, reduce_dim, test_id):
+        embeddings = CountingEmbeddings(size=32)
+        docs = [Document(page_content=f"criteria chunk {i}", metadata={"page": i % 7}) for i in range(1200)]
+
+        vector_store = build_vector_store(docs, embeddings, index_type, reduce_dim)
+        save_cached_index(str(tmp_path), "settings-key", vector_store, CRITERIA_PDF)
+        mapped = load_cached_index(str(tmp_path), "settings-key", embeddings, mmap=True)
+
+        query = embeddings.embed_query("criteria chunk 42")
+        assert mapped.index.ntotal == len(docs), test_id
+        assert mapped.similarity_search_by_vector(query, k=1)[0].page_content == "criteria chunk 42", test_id
+        assert len(retrieve_for_sections(mapped, ["criteria chunk 1", "criteria chunk 2"], max_docs=3, mmr=True)) == 3